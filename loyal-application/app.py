@@ -1,12 +1,19 @@
 import os
-import requests
+import threading
 import psycopg2
+import requests
 import schedule
 import time
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import logging
-import base64
 import json
+from psycopg2.extras import execute_values
+from db import create_connection, get_connection
+from http_client import CircuitOpenError, McrmClient, ListmonkClient, backoff_delay
+from rate_limiter import RateLimitExceeded, create_rate_limit_table
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -49,6 +56,27 @@ DB_PORT = os.getenv('DB_PORT')
 DB_NAME = os.getenv('DB_NAME')
 DB_USER = os.getenv('DB_USER')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
+# Сколько начислений фиксировать в БД одним UPDATE
+BONUS_STATUS_BATCH_SIZE = int(os.getenv('BONUS_STATUS_BATCH_SIZE', '50'))
+# Параллельное начисление бонусов: потоков и максимум запросов в секунду к MCRM (0 - без ограничения)
+BONUS_WORKERS = int(os.getenv('BONUS_WORKERS', '8'))
+BONUS_MAX_RPS = float(os.getenv('BONUS_MAX_RPS', '20'))
+# Инкрементальная синхронизация: запрашиваются только подписчики, изменённые после отметки
+# (с перекрытием на расхождение часов); полная сверка списка - раз в FULL_SYNC_INTERVAL_HOURS
+FULL_SYNC_INTERVAL_HOURS = float(os.getenv('FULL_SYNC_INTERVAL_HOURS', '24'))
+SYNC_OVERLAP_SECONDS = float(os.getenv('SYNC_OVERLAP_SECONDS', '300'))
+SYNC_STATE_NAME = f"listmonk_list_{LIST_ID}"
+# Размер страницы listmonk: столько подписчиков одновременно в памяти и в одной пачке запросов к БД
+LISTMONK_PER_PAGE = int(os.getenv('LISTMONK_PER_PAGE', '500'))
+# Параллельная загрузка страниц после первой: потоков и повторов одной страницы
+LISTMONK_FETCH_WORKERS = int(os.getenv('LISTMONK_FETCH_WORKERS', '4'))
+LISTMONK_PAGE_RETRIES = int(os.getenv('LISTMONK_PAGE_RETRIES', '3'))
+# Ключ advisory-блокировки: одновременно начисление выполняет только один экземпляр планировщика
+BONUS_LOCK_KEY = 7010022
+
+# HTTP-клиенты с постоянными сессиями
+listmonk_client = ListmonkClient(LISTMONK_API_URL, LISTMONK_API_USER, LISTMONK_API_TOKEN)
+mcrm_client = McrmClient(bonus_url=MCRM_API_URL_BONUS, api_token=MCRM_API_TOKEN)
 
 # Логирование используемых параметров
 logger.info(f"Используемый MCRM_API_URL_BONUS: {MCRM_API_URL_BONUS}")
@@ -71,6 +99,19 @@ def init_db():
                 bonus_added BOOLEAN DEFAULT FALSE
             )
         ''')
+        # Отметка о начатом начислении; не снятая отметка без bonus_added - исход неизвестен
+        cursor.execute('ALTER TABLE subscribers ADD COLUMN IF NOT EXISTS bonus_claimed_at TIMESTAMP')
+        # Отметки инкрементальной синхронизации со списками listmonk
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                name TEXT PRIMARY KEY,
+                watermark TIMESTAMPTZ,
+                full_sync_at TIMESTAMPTZ,
+                updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Общее состояние лимитеров запросов (начисления идут через лимитер MCRM)
+        create_rate_limit_table(cursor)
         conn.commit()
         cursor.close()
         conn.close()
@@ -78,171 +119,225 @@ def init_db():
     except psycopg2.Error as e:
         logger.error(f"Ошибка инициализации базы данных: {e}")
 
-# Получение подписчиков из listmonk
-def get_subscribers():
-    # Формирование заголовка Basic Auth
-    auth_string = f"{LISTMONK_API_USER}:{LISTMONK_API_TOKEN}"
-    auth_encoded = base64.b64encode(auth_string.encode()).decode()
-    headers = {
-        'Authorization': f'Basic {auth_encoded}',
-        'Content-Type': 'application/json'
-    }
+# Запрос одной страницы с проверкой структуры ответа: (подписчики, поле data ответа).
+# Повторы HTTP-клиента отключены: страницу повторяет только fetch_page_with_retries
+def fetch_page(params):
+    response = listmonk_client.list_subscribers(params, retries=0)
+    response.raise_for_status()
+    data = response.json()
+    
+    # Логирование структуры ответа
+    logger.debug(f"Ответ API listmonk (страница {params['page']}): {json.dumps(data, indent=2)}")
+    
+    # Проверка структуры ответа
+    if not isinstance(data, dict) or 'data' not in data:
+        raise ValueError("Некорректная структура ответа: поле 'data' отсутствует или ответ не является JSON")
+    
+    subscribers_data = data.get('data', {})
+    if not isinstance(subscribers_data, dict):
+        raise ValueError(f"Поле 'data' не является словарем: {type(subscribers_data)}")
+    
+    subscribers = subscribers_data.get('results', [])
+    if not isinstance(subscribers, list):
+        raise ValueError(f"Поле 'data.results' не является списком: {type(subscribers)}")
+    return subscribers, subscribers_data
+
+# Страница с повторами: сбой одной страницы не прерывает всю загрузку
+def fetch_page_with_retries(params, retries=LISTMONK_PAGE_RETRIES):
+    attempt = 0
+    while True:
+        try:
+            return fetch_page(params)
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt, getattr(e, 'response', None))
+            logger.warning(f"Повтор загрузки страницы {params['page']} через {delay:.2f} с: {e}")
+            attempt += 1
+            time.sleep(delay)
+
+# Постраничное получение подписчиков из listmonk (генератор); query - SQL-выражение listmonk
+# для отбора изменённых. Первая страница даёт total, остальные загружаются параллельно
+# (не больше workers потоков и 2 * workers страниц впереди) и выдаются по порядку.
+# Ошибка страницы после исчерпания повторов выбрасывается после уже выданных страниц
+def get_subscribers(query=None, per_page=LISTMONK_PER_PAGE, workers=LISTMONK_FETCH_WORKERS):
     params = {
         'list_id': LIST_ID,
         'status': 'enabled',
-        'page': 1
+        'page': 1,
+        'per_page': per_page
     }
-    all_subscribers = []
+    if query:
+        params.update({'query': query, 'order_by': 'updated_at', 'order': 'asc'})
     
-    try:
-        while True:
-            response = requests.get(LISTMONK_API_URL, headers=headers, params=params)
-            response.raise_for_status()
-            data = response.json()
-            
-            # Логирование структуры ответа
-            logger.debug(f"Ответ API listmonk (страница {params['page']}): {json.dumps(data, indent=2)}")
-            
-            # Проверка структуры ответа
-            if not isinstance(data, dict) or 'data' not in data:
-                logger.error("Некорректная структура ответа: поле 'data' отсутствует или ответ не является JSON")
-                return all_subscribers
-            
-            subscribers_data = data.get('data', {})
-            if not isinstance(subscribers_data, dict):
-                logger.error(f"Поле 'data' не является словарем: {type(subscribers_data)}")
-                return all_subscribers
-            
-            subscribers = subscribers_data.get('results', [])
-            if not isinstance(subscribers, list):
-                logger.error(f"Поле 'data.results' не является списком: {type(subscribers)}")
-                return all_subscribers
-                
-            all_subscribers.extend(subscribers)
-            
-            # Проверка пагинации
-            if 'next' not in subscribers_data or not subscribers_data['next']:
-                break
-            params['page'] += 1
+    subscribers, subscribers_data = fetch_page_with_retries(params)
+    yield subscribers
+    
+    total = subscribers_data.get('total')
+    if not isinstance(total, int):
+        # Старые версии listmonk без total: последовательно, пока есть next
+        while subscribers_data.get('next'):
+            params = {**params, 'page': params['page'] + 1}
             logger.info(f"Обработка следующей страницы: {params['page']}")
-            
-        return all_subscribers
-    except ValueError as e:
-        logger.error(f"Ошибка разбора JSON ответа: {e}")
-        return all_subscribers
-    except Exception as e:
-        logger.error(f"Ошибка получения подписчиков: {e}")
-        return all_subscribers
-
-# Сохранение подписчика в базу данных
-def save_subscriber(uid, phone):
+            subscribers, subscribers_data = fetch_page_with_retries(params)
+            yield subscribers
+        return
+    
+    pages = -(-total // per_page)
+    if pages <= 1:
+        return
+    logger.info(f"Подписчиков в списке: {total}, страниц: {pages}, потоков загрузки: {workers}")
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='listmonk-page')
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
+        next_pages = iter(range(2, pages + 1))
+        in_flight = deque()
+
+        def submit_next():
+            page = next(next_pages, None)
+            if page is not None:
+                in_flight.append(executor.submit(fetch_page_with_retries, {**params, 'page': page}))
+
+        for _ in range(2 * workers):
+            submit_next()
+        while in_flight:
+            subscribers, _ = in_flight.popleft().result()
+            submit_next()
+            yield subscribers
+    finally:
+        # При ошибке или остановке потребителя не ждём ещё не начатые страницы
+        executor.shutdown(wait=True, cancel_futures=True)
+
+# Сохранение пачки подписчиков одним INSERT (уже сохранённые пропускаются)
+def save_subscribers(subscribers):
+    with get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
+        execute_values(cursor, '''
             INSERT INTO subscribers (uid, phone, bonus_added)
-            VALUES (%s, %s, %s)
+            VALUES %s
             ON CONFLICT (uid) DO NOTHING
-        ''', (uid, phone, False))
+        ''', [(uid, phone, False) for uid, phone in subscribers], page_size=1000)
         conn.commit()
         cursor.close()
-        conn.close()
-        logger.info(f"Подписчик {uid} сохранен в базе данных")
-    except ValueError as e:
-        logger.error(f"Ошибка сохранения подписчика {uid}: {e}")
-    except Exception as e:
-        logger.error(f"Ошибка сохранения {uid}: {e}")
+    logger.info(f"Подписчиков сохранено в базе данных: {len(subscribers)}")
 
-# Проверка статуса начисления бонусов
-def check_bonus_status(uid):
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-        )
+# Захват UID для начисления одним запросом: отмечаются только те, кому бонус не начислен
+# и начисление не начиналось, поэтому каждый UID уходит в MCRM не больше одного раза
+def claim_bonus_uids(uids):
+    with get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT bonus_added FROM subscribers WHERE uid = %s', (uid,))
-        result = cursor.fetchone()
+        cursor.execute('''
+            UPDATE subscribers SET bonus_claimed_at = CURRENT_TIMESTAMP
+            WHERE uid = ANY(%s) AND NOT bonus_added AND bonus_claimed_at IS NULL
+            RETURNING uid
+        ''', (list(uids),))
+        claimed = {row[0] for row in cursor.fetchall()}
+        cursor.execute('''
+            SELECT COUNT(*) FROM subscribers
+            WHERE uid = ANY(%s) AND NOT bonus_added AND bonus_claimed_at IS NOT NULL
+        ''', (list(uids),))
+        unresolved = cursor.fetchone()[0] - len(claimed)
+        conn.commit()
         cursor.close()
-        conn.close()
-        return result[0] if result else False
-    except ValueError as e:
-        logger.error(f"Ошибка проверки статуса бонусов для {uid}: {e}")
-        return False
+    if unresolved:
+        logger.warning(f"Подписчиков с неизвестным исходом прошлого начисления (сверка: reconcile_bonuses.py): {unresolved}")
+    return claimed
+
+# Снятие отметки, если запрос к MCRM заведомо не начислил бонус: UID будет обработан в следующем запуске
+def release_bonus_uids(uids):
+    if not uids:
+        return
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE subscribers SET bonus_claimed_at = NULL WHERE uid = ANY(%s) AND NOT bonus_added', (list(uids),))
+            conn.commit()
+            cursor.close()
     except Exception as e:
-        logger.error(f"Ошибка проверки статуса бонусов для {uid}: {e}")
-        return False
+        logger.error(f"Ошибка снятия отметки начисления для {uids}: {e}")
 
-# Обновление статуса начисления бонусов
-def update_bonus_status(uid):
+# Обновление статуса начисления бонусов для пачки UID
+def update_bonus_statuses(uids):
+    if not uids:
+        return
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        cursor = conn.cursor()
-        cursor.execute('UPDATE subscribers SET bonus_added = %s WHERE uid = %s', (True, uid))
-        conn.commit()
-        cursor.close()
-        conn.close()
-        logger.info(f"Статус бонусов обновлен для {uid}")
-    except ValueError as e:
-        logger.error(f"Ошибка обновления статуса бонусов для {uid}: {e}")
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE subscribers SET bonus_added = %s WHERE uid = ANY(%s)', (True, list(uids)))
+            conn.commit()
+            cursor.close()
+        logger.info(f"Статус бонусов обновлен для {len(uids)} подписчиков")
     except Exception as e:
-        logger.error(f"Ошибка обновления статуса бонусов для {uid}: {e}")
+        logger.error(f"Ошибка обновления статуса бонусов для {uids}: {e}")
+
+# Равномерный интервал между запросами всех потоков (не больше max_rps в секунду)
+class RatePacer:
+    def __init__(self, max_rps):
+        self.interval = 1 / max_rps if max_rps > 0 else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
 
-# Начисление бонусов через MCRM API
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+bonus_pacer = RatePacer(BONUS_MAX_RPS)
+
+# Начисление бонусов через MCRM API. Результат: 'credited', 'failed' - бонус точно не начислен
+# (ответ с ошибкой или запрос не отправлялся), 'unknown' - запрос мог дойти до MCRM
 def add_bonus(phone, uid):
-    headers = {
-        'x-api-key': MCRM_API_TOKEN,
-        'Content-Type': 'application/json'
-    }
-    payload = {
-        'number': phone,
-        'sum': BONUS_SUM,
-        'comment': 'MAIL SUBSCRIBE'
-    }
-    
     try:
-        logger.debug(f"Отправка запроса к MCRM API: URL={MCRM_API_URL_BONUS}, headers={{'x-api-key': '***', 'Content-Type': 'application/json'}}, payload={payload}")
-        response = requests.post(MCRM_API_URL_BONUS, headers=headers, json=payload)
+        bonus_pacer.wait()
+        logger.debug(f"Отправка запроса к MCRM API: URL={MCRM_API_URL_BONUS}, number={phone}, sum={BONUS_SUM}")
+        response = mcrm_client.add_bonus(phone, BONUS_SUM, 'MAIL SUBSCRIBE')
         response.raise_for_status()
         logger.info(f"Бонусы начислены для телефона {phone}, UID: {uid}")
-        return True
-    except ValueError as e:
+        return 'credited'
+    except requests.HTTPError as e:
         logger.error(f"Ошибка начисления бонусов для телефона {phone}: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            logger.error(f"Код ответа: {e.response.status_code}, Текст ответа: {e.response.text}")
-        return False
+        logger.error(f"Код ответа: {e.response.status_code}, Текст ответа: {e.response.text}")
+        # 504 от прокси не означает, что MCRM не выполнил запрос
+        return 'unknown' if e.response.status_code == 504 else 'failed'
+    except (requests.ConnectTimeout, CircuitOpenError, RateLimitExceeded) as e:
+        logger.error(f"Запрос начисления бонусов для телефона {phone} не отправлен: {e}")
+        return 'failed'
     except Exception as e:
-        logger.error(f"Ошибка начисления бонусов для телефона {phone}: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            logger.error(f"Код ответа: {e.response.status_code}, Текст ответа: {e.response.text}")
-        return False
+        logger.error(f"Неизвестен результат начисления бонусов для телефона {phone}: {e}")
+        return 'unknown'
 
-# Основная функция обработки
-def process_subscribers():
-    logger.info("Начало обработки подписчиков")
-    
-    # Получение подписчиков
-    subscribers = get_subscribers()
-    if not subscribers:
-        logger.warning("Список подписчиков пуст или не удалось получить данные")
-        return
-    
-    # Обработка каждого подписчика
+# Параллельное начисление по захваченным UID; статусы фиксируются пачками по BONUS_STATUS_BATCH_SIZE
+def credit_bonuses(pending, workers=BONUS_WORKERS):
+    outcomes = Counter()
+    added, failed = [], []
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bonus') as executor:
+        futures = {executor.submit(add_bonus, phone, uid): uid for uid, phone in pending}
+        for future in as_completed(futures):
+            uid = futures[future]
+            outcome = future.result()
+            outcomes[outcome] += 1
+            if outcome == 'credited':
+                added.append(uid)
+                if len(added) >= BONUS_STATUS_BATCH_SIZE:
+                    update_bonus_statuses(added)
+                    added = []
+            elif outcome == 'failed':
+                failed.append(uid)
+            else:
+                logger.warning(f"Начисление для UID={uid} не будет повторено автоматически, сверка с MCRM: reconcile_bonuses.py --uids {uid}")
+    update_bonus_statuses(added)
+    release_bonus_uids(failed)
+    logger.info(f"Начисление бонусов завершено за {time.monotonic() - started:.1f} с: {dict(outcomes)}")
+    return outcomes
+
+# Подтверждённые подписчики LIST_ID с телефоном: [(uid, phone)] без повторов uid
+def confirmed_subscribers(subscribers):
+    confirmed = {}
     for subscriber in subscribers:
         if not isinstance(subscriber, dict):
             logger.error(f"Подписчик не является словарем: {subscriber}")
@@ -263,26 +358,132 @@ def process_subscribers():
         if not uid or not phone or status != 'enabled' or not is_confirmed:
             logger.debug(f"Пропущен подписчик: UID={uid}, phone={phone}, status={status}, confirmed={is_confirmed}")
             continue
-            
-        # Сохранение подписчика в БД
-        save_subscriber(uid, phone)
-        
-        # Проверка статуса бонусов
-        if check_bonus_status(uid):
-            logger.debug(f"Бонусы уже начислены для UID={uid}")
-            continue
-            
-        # Начисление бонусов
-        if add_bonus(phone, uid):
-            update_bonus_status(uid)
+        confirmed[uid] = phone
+    return list(confirmed.items())
+
+# Отметка последней синхронизации: (watermark, full_sync_at) или (None, None)
+def load_sync_state():
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT watermark, full_sync_at FROM sync_state WHERE name = %s', (SYNC_STATE_NAME,))
+        row = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+    return row if row else (None, None)
+
+# Сохранение отметки после успешной обработки; время полной сверки - только после полной
+def save_sync_state(watermark, full):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO sync_state (name, watermark, full_sync_at, updated_at)
+                VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (name) DO UPDATE
+                SET watermark = EXCLUDED.watermark,
+                    full_sync_at = COALESCE(EXCLUDED.full_sync_at, sync_state.full_sync_at),
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (SYNC_STATE_NAME, watermark, watermark if full else None))
+            conn.commit()
+            cursor.close()
+    except Exception as e:
+        logger.error(f"Ошибка сохранения отметки синхронизации: {e}")
+
+# Отбор подписчиков, изменённых с момента since: сам подписчик или его подписка на LIST_ID
+# (подтверждение подписки меняет только subscriber_lists)
+def changed_since_query(since):
+    since = since.isoformat()
+    return (f"(subscribers.updated_at >= '{since}' OR subscribers.id IN ("
+            f"SELECT subscriber_id FROM subscriber_lists WHERE list_id = {LIST_ID} AND updated_at >= '{since}'))")
+
+# Обработка одной страницы: сохранение, захват UID и начисление. False - ошибка БД, продолжать нельзя
+def process_page(subscribers, totals):
+    totals['fetched'] += len(subscribers)
+    confirmed = confirmed_subscribers(subscribers)
+    if not confirmed:
+        return True
+    totals['confirmed'] += len(confirmed)
+
+    # Сохранение страницы и захват UID для начисления - по одному запросу
+    try:
+        save_subscribers(confirmed)
+        claimed = claim_bonus_uids(uid for uid, _ in confirmed)
+    except Exception as e:
+        # Без статусов нельзя начислять: бонус мог быть уже начислен
+        logger.error(f"Ошибка синхронизации подписчиков с базой данных: {e}")
+        return False
+
+    pending = [(uid, phone) for uid, phone in confirmed if uid in claimed]
+    logger.info(f"Страница: подписчиков {len(subscribers)}, подтверждённых {len(confirmed)}, к начислению {len(pending)}")
+    if pending:
+        totals.update(credit_bonuses(pending))
+    return True
+
+# Основная функция обработки
+def process_subscribers():
+    logger.info("Начало обработки подписчиков")
+    started_at = datetime.now(timezone.utc)
+
+    # Выбор режима: полная сверка без отметки или по расписанию, иначе только изменения
+    try:
+        watermark, full_sync_at = load_sync_state()
+    except Exception as e:
+        logger.error(f"Ошибка чтения отметки синхронизации: {e}")
+        return
+    full = watermark is None or full_sync_at is None or \
+        started_at - full_sync_at >= timedelta(hours=FULL_SYNC_INTERVAL_HOURS)
+    if full:
+        logger.info("Полная сверка списка подписчиков")
+        query = None
+    else:
+        since = watermark - timedelta(seconds=SYNC_OVERLAP_SECONDS)
+        logger.info(f"Инкрементальная синхронизация: изменения с {since.isoformat()}")
+        query = changed_since_query(since)
+    
+    # Страницы обрабатываются по мере получения: память ограничена размером страницы
+    totals = Counter()
+    complete = False
+    try:
+        for subscribers in get_subscribers(query):
+            if not process_page(subscribers, totals):
+                break
         else:
-            logger.warning(f"Не удалось начислить бонусы для UID={uid}")
+            complete = True
+    except ValueError as e:
+        logger.error(f"Ошибка разбора JSON ответа: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка получения подписчиков: {e}")
+
+    logger.info(f"Обработка подписчиков завершена: {dict(totals)}")
+    # Отметка сдвигается, только если получены и обработаны все страницы
+    if complete:
+        save_sync_state(started_at, full)
+    else:
+        logger.warning("Обработаны не все страницы, отметка синхронизации не изменена")
+
+# Запуск обработки под advisory-блокировкой: если другой экземпляр ещё работает, запуск пропускается
+def run_process_subscribers():
+    try:
+        conn = create_connection()
+    except Exception as e:
+        logger.error(f"Ошибка подключения к базе данных: {e}")
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', (BONUS_LOCK_KEY,))
+        if not cursor.fetchone()[0]:
+            logger.info("Обработка подписчиков уже выполняется другим экземпляром")
+            return
+        process_subscribers()
+    finally:
+        # Блокировка сессии снимается при закрытии соединения
+        conn.close()
 
 # Точка входа
 def main():
     init_db()
-    process_subscribers()  # Выполнить сразу при запуске
-    schedule.every(1).hours.do(process_subscribers)
+    run_process_subscribers()  # Выполнить сразу при запуске
+    schedule.every(1).hours.do(run_process_subscribers)
     
     logger.info("Скрипт запущен, ожидание выполнения по расписанию")
     while True:
@@ -0,0 +1,215 @@
+import atexit
+import os
+import queue
+import threading
+import time
+import logging
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from db import get_connection
+from metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+# Параметры буферизованной записи журналов
+AUDIT_LOG_BATCH_SIZE = int(os.getenv("AUDIT_LOG_BATCH_SIZE", "200"))
+AUDIT_LOG_FLUSH_INTERVAL = float(os.getenv("AUDIT_LOG_FLUSH_INTERVAL", "1"))  # секунд
+AUDIT_LOG_QUEUE_SIZE = int(os.getenv("AUDIT_LOG_QUEUE_SIZE", "10000"))
+AUDIT_LOG_POLICY = os.getenv("AUDIT_LOG_POLICY", "drop")  # drop - отбросить запись, block - подождать место в очереди
+AUDIT_LOG_BLOCK_TIMEOUT = float(os.getenv("AUDIT_LOG_BLOCK_TIMEOUT", "0.05"))  # секунд ожидания при политике block
+AUDIT_LOG_MAX_FIELD = int(os.getenv("AUDIT_LOG_MAX_FIELD", "8192"))  # обрезка длинных заголовков и ответов
+
+# Колонки таблиц журналов в порядке вставки
+AUDIT_TABLES = {
+    "requests_log": ("method", "path", "headers", "remote_addr", "serial", "event", "error_message"),
+    "serial_processing_log": ("original_serial", "cleaned_serial", "error_message"),
+    "mcrm_requests_log": ("url", "number", "status_code", "response", "error_message"),
+    "listmonk_requests_log": ("url", "payload", "status_code", "response", "error_message"),
+}
+
+# Ширина колонок VARCHAR (см. log_partitions.LOG_TABLES), остальные текстовые обрезаются по AUDIT_LOG_MAX_FIELD
+AUDIT_COLUMN_WIDTHS = {
+    "method": 10,
+    "path": 255,
+    "remote_addr": 45,
+    "serial": 255,
+    "event": 100,
+    "original_serial": 255,
+    "cleaned_serial": 255,
+    "url": 255,
+    "number": 255,
+}
+AUDIT_INTEGER_COLUMNS = {"status_code"}
+
+
+# Значение приводится к типу колонки: нестроковые данные из запроса (список, число в event)
+# записываются как строка, а не как ARRAY, и не длиннее колонки - иначе падает вся пачка
+def _coerce(column, value):
+    if value is None:
+        return None
+    if column in AUDIT_INTEGER_COLUMNS:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    if not isinstance(value, str):
+        value = str(value)
+    width = AUDIT_COLUMN_WIDTHS.get(column)
+    if width is not None:
+        return value[:width]
+    if len(value) > AUDIT_LOG_MAX_FIELD:
+        return value[:AUDIT_LOG_MAX_FIELD] + "...[обрезано]"
+    return value
+
+
+# Буфер записей журналов: запрос только кладёт строку в очередь,
+# фоновый поток пишет пачками через многострочный INSERT
+class BufferedLogWriter:
+    def __init__(self, batch_size, flush_interval, queue_size, policy, block_timeout):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._stats = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "flushes": 0}
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                # После fork поток родителя не существует, очередь может содержать его записи
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+                self._thread.start()
+                self._pid = pid
+
+    def write(self, table, data):
+        columns = AUDIT_TABLES.get(table)
+        if columns is None:
+            logger.error(f"Неизвестная таблица журнала: {table}")
+            return False
+        self._ensure_started()
+        row = tuple(_coerce(column, data.get(column)) for column in columns)
+        try:
+            if self.policy == "block":
+                self._queue.put((table, row), timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait((table, row))
+        except queue.Full:
+            with self._lock:
+                self._stats["dropped"] += 1
+            logger.warning(f"Очередь журналов переполнена, запись в {table} отброшена")
+            return False
+        with self._lock:
+            self._stats["enqueued"] += 1
+        return True
+
+    def _run(self):
+        pending = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            timeout = max(0, deadline - time.monotonic())
+            try:
+                pending.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+            stopping = self._stop.is_set()
+            if len(pending) >= self.batch_size or time.monotonic() >= deadline or stopping:
+                if stopping:
+                    pending.extend(self._drain())
+                if pending:
+                    self._flush(pending)
+                    pending = []
+                deadline = time.monotonic() + self.flush_interval
+                if stopping:
+                    return
+
+    def _drain(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                return rows
+
+    def _insert(self, cursor, conn, table, rows):
+        query = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+            sql.Identifier(table),
+            sql.SQL(", ").join(map(sql.Identifier, AUDIT_TABLES[table]))
+        )
+        execute_values(cursor, query.as_string(conn), rows, page_size=self.batch_size)
+
+    def _flush(self, pending):
+        batches = {}
+        for table, row in pending:
+            batches.setdefault(table, []).append(row)
+        try:
+            with observe_stage("db_audit_log"), get_connection() as conn:
+                cursor = conn.cursor()
+                for table, rows in batches.items():
+                    self._insert(cursor, conn, table, rows)
+                conn.commit()
+                cursor.close()
+            with self._lock:
+                self._stats["written"] += len(pending)
+                self._stats["flushes"] += 1
+            logger.debug(f"Записано строк журналов: {len(pending)}")
+        except Exception as e:
+            logger.error(f"Ошибка пакетной записи журналов ({len(pending)} строк), запись по таблицам: {e}")
+            for table, rows in batches.items():
+                self._flush_table(table, rows)
+            with self._lock:
+                self._stats["flushes"] += 1
+
+    # Запасной путь: пачка одной таблицы, при ошибке - построчно, чтобы одна
+    # плохая строка не отбрасывала весь буфер
+    def _flush_table(self, table, rows):
+        try:
+            with get_connection() as conn:
+                cursor = conn.cursor()
+                self._insert(cursor, conn, table, rows)
+                conn.commit()
+                cursor.close()
+            with self._lock:
+                self._stats["written"] += len(rows)
+            return
+        except Exception as e:
+            if len(rows) == 1:
+                with self._lock:
+                    self._stats["failed"] += 1
+                logger.error(f"Ошибка записи строки журнала {table}: {e}, row={rows[0]}")
+                return
+            logger.error(f"Ошибка записи журнала {table} ({len(rows)} строк), запись построчно: {e}")
+        for row in rows:
+            self._flush_table(table, [row])
+
+    def close(self, timeout=5):
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize()
+        stats["policy"] = self.policy
+        return stats
+
+
+audit_log = BufferedLogWriter(
+    AUDIT_LOG_BATCH_SIZE,
+    AUDIT_LOG_FLUSH_INTERVAL,
+    AUDIT_LOG_QUEUE_SIZE,
+    AUDIT_LOG_POLICY,
+    AUDIT_LOG_BLOCK_TIMEOUT
+)
+# Дописываем буфер при штатном завершении процесса
+atexit.register(audit_log.close)
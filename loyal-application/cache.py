@@ -0,0 +1,184 @@
+import json
+import threading
+import time
+import logging
+from collections import OrderedDict
+from psycopg2 import sql
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+# Как часто (в количестве записей) чистить просроченные строки общего кэша
+SHARED_CLEANUP_EVERY = 500
+
+
+# Сохранённый ответ API: повторяет нужную часть интерфейса requests.Response
+class CachedResponse:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+# LRU-кэш ответов с TTL; при shared=True промахи дополнительно ищутся
+# в таблице http_cache, чтобы воркеры gunicorn пользовались результатами друг друга
+class ResponseCache:
+    def __init__(self, name, maxsize, shared=False):
+        self.name = name
+        self.maxsize = maxsize
+        self.shared = shared
+        self._items = OrderedDict()  # key -> (CachedResponse, expires_at, negative)
+        self._lock = threading.Lock()
+        self._sets = 0
+        self._stats = {"hits": 0, "negative_hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                response, expires_at, negative = item
+                if expires_at > now:
+                    self._items.move_to_end(key)
+                    self._stats["hits"] += 1
+                    if negative:
+                        self._stats["negative_hits"] += 1
+                    return response
+                del self._items[key]
+
+        if self.shared:
+            item = self._shared_get(key)
+            if item is not None:
+                response, ttl, negative = item
+                self._local_set(key, response, ttl, negative)
+                with self._lock:
+                    self._stats["hits"] += 1
+                    self._stats["shared_hits"] += 1
+                    if negative:
+                        self._stats["negative_hits"] += 1
+                return response
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def set(self, key, response, ttl, negative=False):
+        cached = CachedResponse(response.status_code, response.text)
+        self._local_set(key, cached, ttl, negative)
+        if self.shared:
+            self._shared_set(key, cached, ttl, negative)
+        return cached
+
+    def _local_set(self, key, response, ttl, negative):
+        with self._lock:
+            self._items[key] = (response, time.monotonic() + ttl, negative)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def _shared_get(self, key):
+        try:
+            with get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql.SQL("""
+                    SELECT status_code, response, negative, EXTRACT(EPOCH FROM expires_at - CURRENT_TIMESTAMP)
+                    FROM http_cache
+                    WHERE cache_name = %s AND key = %s AND expires_at > CURRENT_TIMESTAMP
+                """), (self.name, key))
+                row = cursor.fetchone()
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Ошибка чтения общего кэша {self.name}: {e}")
+            return None
+        if row is None:
+            return None
+        status_code, text, negative, ttl = row
+        return CachedResponse(status_code, text), float(ttl), negative
+
+    def _shared_set(self, key, response, ttl, negative):
+        with self._lock:
+            self._sets += 1
+            cleanup = self._sets % SHARED_CLEANUP_EVERY == 0
+        try:
+            with get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql.SQL("""
+                    INSERT INTO http_cache (cache_name, key, status_code, response, negative, expires_at)
+                    VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+                    ON CONFLICT (cache_name, key) DO UPDATE
+                    SET status_code = EXCLUDED.status_code, response = EXCLUDED.response,
+                        negative = EXCLUDED.negative, expires_at = EXCLUDED.expires_at
+                """), (self.name, key, response.status_code, response.text, negative, ttl))
+                if cleanup:
+                    cursor.execute(sql.SQL("DELETE FROM http_cache WHERE expires_at < CURRENT_TIMESTAMP"))
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Ошибка записи в общий кэш {self.name}: {e}")
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._items)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else 0
+        stats["shared"] = self.shared
+        return stats
+
+
+# Недавно обработанные ключи с TTL: отсекает дубликаты до любых сетевых запросов.
+# Ключ считается обработанным только после успеха; пока идёт первая обработка,
+# он в наборе in-flight (в пределах процесса), и повтор получает отказ, а не успех
+class RecentKeys:
+    RECENT = "recent"
+    IN_FLIGHT = "in_flight"
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> expires_at
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._stats = {"duplicates": 0, "in_flight_rejected": 0, "added": 0}
+
+    # Захват ключа на время обработки: RECENT - уже успешно обработан, IN_FLIGHT - обрабатывается
+    # сейчас, None - захвачен, вызывающий обязан вызвать finish
+    def claim(self, key):
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._items.get(key)
+            if expires_at is not None and expires_at > now:
+                self._stats["duplicates"] += 1
+                return self.RECENT
+            if key in self._in_flight:
+                self._stats["in_flight_rejected"] += 1
+                return self.IN_FLIGHT
+            self._in_flight.add(key)
+            return None
+
+    # Завершение обработки: при успехе ключ запоминается на ttl, при ошибке повтор допускается сразу
+    def finish(self, key, success):
+        with self._lock:
+            self._in_flight.discard(key)
+            if not success:
+                return
+            self._items[key] = time.monotonic() + self.ttl
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+            self._stats["added"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._items)
+            stats["in_flight"] = len(self._in_flight)
+        return stats
@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import psycopg2
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Конфиг для PostgreSQL
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = os.getenv("DB_PORT", "5432")
+DB_NAME = os.getenv("DB_NAME", "webhook_db")
+DB_USER = os.getenv("DB_USER", "webhook_user")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "your_postgres_password")
+
+# Параметры пула соединений (на один процесс воркера)
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "4"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))  # секунд ожидания свободного соединения
+DB_POOL_CHECK_INTERVAL = float(os.getenv("DB_POOL_CHECK_INTERVAL", "30"))  # проверка соединения, простаивавшего дольше
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Пул соединений с ограничением размера, таймаутом ожидания и проверкой живости
+class ConnectionPool:
+    def __init__(self, maxconn, timeout, check_interval, **conn_kwargs):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._conn_kwargs = conn_kwargs
+        self._idle = []  # (conn, время возврата в пул)
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "peak_in_use": 0,
+            "wait_time_total": 0.0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._conn_kwargs)
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"Нет свободных соединений в пуле за {self.timeout} с (max={self.maxconn})")
+                waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._in_use)
+            if waited:
+                self._stats["waits"] += 1
+                self._stats["wait_time_total"] += time.monotonic() - started
+
+        try:
+            if conn is not None and not self._is_healthy(conn, last_used):
+                logger.warning("Соединение из пула не прошло проверку, переподключение")
+                self._close_quietly(conn)
+                with self._cond:
+                    self._stats["discarded"] += 1
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            self._close_quietly(conn)
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed:
+                self._size -= 1
+                self._stats["discarded"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "max": self.maxconn,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "saturation": round(self._in_use / self.maxconn, 3) if self.maxconn else 0,
+            })
+        waits = stats.pop("wait_time_total")
+        stats["avg_wait_ms"] = round(waits * 1000 / stats["waits"], 2) if stats["waits"] else 0
+        return stats
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# Пулы, унаследованные от родителя при fork. Держим ссылки, чтобы сборщик мусора
+# не закрыл чужие сокеты и не оборвал соединения родительского процесса.
+_inherited_pools = []
+
+
+# Пул создаётся лениво в каждом процессе (безопасно для fork в gunicorn)
+def get_pool():
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            if _pool is not None:
+                _inherited_pools.append(_pool)
+            _pool = ConnectionPool(
+                DB_POOL_MAX,
+                DB_POOL_TIMEOUT,
+                DB_POOL_CHECK_INTERVAL,
+                host=DB_HOST,
+                port=DB_PORT,
+                dbname=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD
+            )
+            _pool_pid = pid
+            logger.info(f"Создан пул соединений PostgreSQL: pid={pid}, max={DB_POOL_MAX}, timeout={DB_POOL_TIMEOUT}")
+    return _pool
+
+
+# Отдельное соединение вне пула (для LISTEN и других долгоживущих сессий)
+def create_connection():
+    return psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+
+
+# Получение соединения из пула; по выходе незавершённая транзакция откатывается
+@contextmanager
+def get_connection():
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+
+# Статистика пула текущего процесса
+def pool_stats():
+    if _pool is None or _pool_pid != os.getpid():
+        return {"max": DB_POOL_MAX, "size": 0, "in_use": 0, "idle": 0, "saturation": 0}
+    return _pool.stats()
@@ -25,4 +25,20 @@ proc_name = "stable"
 
 # Буферизация вывода для реального времени
 capture_output = True
-enable_stdio_inheritance = True
\ No newline at end of file
+enable_stdio_inheritance = True
+
+
+# Метрики Prometheus в multiprocess-режиме: каталог очищается при старте мастера,
+# файлы завершившихся воркеров помечаются, чтобы их gauge не учитывались
+def on_starting(server):
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
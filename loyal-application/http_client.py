@@ -0,0 +1,389 @@
+import asyncio
+import base64
+import os
+import random
+import threading
+import time
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import CIRCUIT_REJECTED, CIRCUIT_STATE
+from rate_limiter import get_limiter, is_congested
+
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Общие параметры HTTP-клиента
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))  # секунд
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))  # секунд
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))  # повторов сверх первой попытки
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.2"))  # секунд
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "3"))  # секунд
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))  # соединений на хост
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# Параметры автоматических выключателей (circuit breaker) на каждый внешний API
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))  # доля ошибок для размыкания
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))  # последних вызовов в окне
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))  # минимум вызовов в окне для решения
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))  # время до пробного вызова
+CIRCUIT_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", "1"))  # одновременных пробных вызовов
+
+
+# Пауза перед повтором: экспоненциальная с полным джиттером, Retry-After учитывается
+def backoff_delay(attempt, response=None):
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        return min(HTTP_BACKOFF_MAX, float(response.headers['Retry-After']))
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"Выключатель {name} разомкнут, повтор через {retry_after:.0f} с")
+        self.name = name
+        self.retry_after = retry_after
+
+
+# Выключатель по доле ошибок в скользящем окне последних вызовов.
+# Разомкнут - вызовы отклоняются сразу; по истечении CIRCUIT_OPEN_SECONDS
+# пропускается пробный вызов: успех замыкает цепь, ошибка снова размыкает.
+# Состояние хранится в процессе, каждый воркер gunicorn решает сам.
+class CircuitBreaker:
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failure_rate=CIRCUIT_FAILURE_RATE, window=CIRCUIT_WINDOW, min_calls=CIRCUIT_MIN_CALLS,
+                 open_seconds=CIRCUIT_OPEN_SECONDS, half_open_calls=CIRCUIT_HALF_OPEN_CALLS):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._results = deque(maxlen=window)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "rejected": 0}
+        CIRCUIT_STATE.labels(name).set(0)
+
+    def _set_state(self, state):
+        self._state = state
+        CIRCUIT_STATE.labels(self.name).set(self.STATE_VALUES[state])
+
+    def _reject(self, retry_after):
+        self._stats["rejected"] += 1
+        CIRCUIT_REJECTED.labels(self.name).inc()
+        raise CircuitOpenError(self.name, retry_after)
+
+    # Вызывается перед каждой попыткой; разомкнутая цепь отклоняет вызов исключением
+    def allow(self):
+        with self._lock:
+            if self._state == self.OPEN:
+                remaining = self._opened_at + self.open_seconds - time.monotonic()
+                if remaining > 0:
+                    self._reject(remaining)
+                self._set_state(self.HALF_OPEN)
+                self._probes = 0
+                logger.info(f"Выключатель {self.name}: пробный вызов")
+            if self._state == self.HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self._reject(self.open_seconds)
+                self._probes += 1
+
+    # Вызов после allow() не состоялся или прерван не по вине сервера: пробный вызов возвращается
+    def release(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record(self, success):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                if success:
+                    self._results.clear()
+                    self._set_state(self.CLOSED)
+                    logger.info(f"Выключатель {self.name} замкнут")
+                else:
+                    self._open()
+                return
+            if self._state == self.OPEN:
+                return
+            self._results.append(success)
+            calls = len(self._results)
+            if calls >= self.min_calls and self._results.count(False) / calls >= self.failure_rate:
+                self._open()
+
+    def _open(self):
+        failures = self._results.count(False)
+        self._results.clear()
+        self._opened_at = time.monotonic()
+        self._stats["opened"] += 1
+        self._set_state(self.OPEN)
+        logger.warning(f"Выключатель {self.name} разомкнут на {self.open_seconds:.0f} с (ошибок в окне: {failures})")
+
+    def stats(self):
+        with self._lock:
+            calls = len(self._results)
+            stats = dict(self._stats)
+            stats.update({
+                "state": self._state,
+                "calls": calls,
+                "failure_rate": round(self._results.count(False) / calls, 3) if calls else 0
+            })
+        return stats
+
+
+# Выключатели по имени внешнего API, общие для синхронных и асинхронных клиентов процесса
+circuit_breakers = {}
+
+
+def get_breaker(name):
+    if name not in circuit_breakers:
+        circuit_breakers[name] = CircuitBreaker(name)
+    return circuit_breakers[name]
+
+
+def circuit_stats():
+    return {name: breaker.stats() for name, breaker in circuit_breakers.items()}
+
+
+# Ошибка ответа с точки зрения выключателя: сервер недоступен или перегружен
+def is_upstream_failure(status_code):
+    return status_code >= 500 or status_code == 429
+
+
+# Базовый клиент: постоянная сессия на процесс, пул соединений на каждый хост, таймауты и повторы
+class ApiClient:
+    def __init__(self, urls, headers=None, pool_size=HTTP_POOL_SIZE,
+                 timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), retries=HTTP_RETRIES, breaker=None):
+        self.urls = [url for url in urls if url]
+        self.headers = headers or {}
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = breaker
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        pid = os.getpid()
+        if self._session is not None and self._pid == pid:
+            return self._session
+        with self._lock:
+            if self._session is None or self._pid != pid:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                for url in self.urls:
+                    parts = urlsplit(url)
+                    session.mount(
+                        f"{parts.scheme}://{parts.netloc}/",
+                        HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    )
+                self._session = session
+                self._pid = pid
+        return self._session
+
+    # idempotent=False: повторяем только если запрос заведомо не дошёл до сервера
+    # retries переопределяет число повторов клиента, когда повторы выполняет вызывающий код
+    def request(self, method, url, idempotent=True, retries=None, **kwargs):
+        session = self._get_session()
+        kwargs.setdefault('timeout', self.timeout)
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        limiter = get_limiter(urlsplit(url).netloc)
+        while True:
+            # Токен лимитера берётся до выключателя: отказ лимитера не должен занимать пробный вызов
+            if limiter is not None:
+                limiter.acquire()
+            if self.breaker is not None:
+                self.breaker.allow()
+            started = time.monotonic()
+            try:
+                response = session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                self._record(False)
+                if limiter is not None and limiter.observe(isinstance(e, requests.Timeout)):
+                    limiter.decrease()
+                retriable = isinstance(e, requests.ConnectTimeout) or (
+                    idempotent and isinstance(e, (requests.ConnectionError, requests.Timeout))
+                )
+                if not retriable or attempt >= retries:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning(f"Повтор запроса {method} {url} через {delay:.2f} с: {e}")
+            except BaseException:
+                self._release()
+                raise
+            else:
+                self._record(not is_upstream_failure(response.status_code))
+                if limiter is not None and limiter.observe(is_congested(response.status_code, time.monotonic() - started)):
+                    limiter.decrease()
+                retriable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUSES)
+                if not retriable or attempt >= retries:
+                    return response
+                delay = backoff_delay(attempt, response)
+                logger.warning(f"Повтор запроса {method} {url} через {delay:.2f} с: status_code={response.status_code}")
+            attempt += 1
+            time.sleep(delay)
+
+    def _record(self, success):
+        if self.breaker is not None:
+            self.breaker.record(success)
+
+    def _release(self):
+        if self.breaker is not None:
+            self.breaker.release()
+
+
+# Клиент marketingcrm API: поиск клиента и начисление бонусов
+class McrmClient(ApiClient):
+    def __init__(self, user_url=None, bonus_url=None, api_key=None, api_token=None,
+                 pool_size=int(os.getenv("MCRM_HTTP_POOL_SIZE", HTTP_POOL_SIZE))):
+        super().__init__([user_url, bonus_url], pool_size=pool_size, breaker=get_breaker("mcrm"))
+        self.user_url = user_url
+        self.bonus_url = bonus_url
+        self.api_key = api_key
+        self.api_token = api_token
+
+    def get_user(self, number):
+        return self.request('GET', self.user_url, params={"number": number, "api_key": self.api_key})
+
+    def add_bonus(self, number, amount, comment):
+        return self.request(
+            'POST',
+            self.bonus_url,
+            idempotent=False,
+            headers={'x-api-key': self.api_token, 'Content-Type': 'application/json'},
+            json={'number': number, 'sum': amount, 'comment': comment}
+        )
+
+
+# Клиент listmonk API; заголовок Basic Auth формируется один раз
+class ListmonkClient(ApiClient):
+    def __init__(self, url, username, token,
+                 pool_size=int(os.getenv("LISTMONK_HTTP_POOL_SIZE", HTTP_POOL_SIZE))):
+        auth_encoded = base64.b64encode(f"{username}:{token}".encode()).decode()
+        super().__init__([url], headers={'Authorization': f'Basic {auth_encoded}'}, pool_size=pool_size,
+                         breaker=get_breaker("listmonk"))
+        self.url = url
+
+    # listmonk отклоняет повторное создание с тем же email (409), поэтому повтор безопасен
+    def create_subscriber(self, payload):
+        return self.request('POST', self.url, json=payload)
+
+    def list_subscribers(self, params, retries=None):
+        return self.request('GET', self.url, params=params, retries=retries)
+
+    # Поиск подписчика по email (SQL-выражение listmonk, кавычки экранируются)
+    def find_subscriber(self, email):
+        query = "subscribers.email = '{}'".format(email.replace("'", "''"))
+        return self.request('GET', self.url, params={"query": query, "per_page": 1})
+
+
+# Асинхронный вариант клиента (для ASGI-приложения): один httpx.AsyncClient на event loop
+class AsyncApiClient:
+    def __init__(self, headers=None, pool_size=HTTP_POOL_SIZE,
+                 timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), retries=HTTP_RETRIES, breaker=None):
+        self.headers = headers or {}
+        self.pool_size = pool_size
+        self.timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        self.retries = retries
+        self.breaker = breaker
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            )
+        return self._client
+
+    async def request(self, method, url, idempotent=True, **kwargs):
+        client = self._get_client()
+        attempt = 0
+        limiter = get_limiter(urlsplit(url).netloc)
+        while True:
+            # Токен лимитера берётся до выключателя: отказ лимитера или отмена не занимают пробный вызов
+            if limiter is not None:
+                await limiter.acquire_async()
+            if self.breaker is not None:
+                self.breaker.allow()
+            started = time.monotonic()
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                self._record(False)
+                if limiter is not None and limiter.observe(isinstance(e, httpx.TimeoutException)):
+                    await asyncio.to_thread(limiter.decrease)
+                retriable = isinstance(e, (httpx.ConnectTimeout, httpx.ConnectError)) or (
+                    idempotent and isinstance(e, (httpx.NetworkError, httpx.TimeoutException))
+                )
+                if not retriable or attempt >= self.retries:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning(f"Повтор запроса {method} {url} через {delay:.2f} с: {e!r}")
+            except BaseException:
+                # Отмена задачи (CancelledError) или ошибка вне транспорта
+                self._release()
+                raise
+            else:
+                self._record(not is_upstream_failure(response.status_code))
+                if limiter is not None and limiter.observe(is_congested(response.status_code, time.monotonic() - started)):
+                    await asyncio.to_thread(limiter.decrease)
+                retriable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUSES)
+                if not retriable or attempt >= self.retries:
+                    return response
+                delay = backoff_delay(attempt, response)
+                logger.warning(f"Повтор запроса {method} {url} через {delay:.2f} с: status_code={response.status_code}")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _record(self, success):
+        if self.breaker is not None:
+            self.breaker.record(success)
+
+    def _release(self):
+        if self.breaker is not None:
+            self.breaker.release()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class AsyncMcrmClient(AsyncApiClient):
+    def __init__(self, user_url=None, api_key=None,
+                 pool_size=int(os.getenv("MCRM_HTTP_POOL_SIZE", HTTP_POOL_SIZE))):
+        super().__init__(pool_size=pool_size, breaker=get_breaker("mcrm"))
+        self.user_url = user_url
+        self.api_key = api_key
+
+    async def get_user(self, number):
+        return await self.request('GET', self.user_url, params={"number": number, "api_key": self.api_key})
+
+
+class AsyncListmonkClient(AsyncApiClient):
+    def __init__(self, url, username, token,
+                 pool_size=int(os.getenv("LISTMONK_HTTP_POOL_SIZE", HTTP_POOL_SIZE))):
+        auth_encoded = base64.b64encode(f"{username}:{token}".encode()).decode()
+        super().__init__(headers={'Authorization': f'Basic {auth_encoded}'}, pool_size=pool_size,
+                         breaker=get_breaker("listmonk"))
+        self.url = url
+
+    async def create_subscriber(self, payload):
+        return await self.request('POST', self.url, json=payload)
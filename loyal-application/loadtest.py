@@ -0,0 +1,364 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import requests
+from requests.adapters import HTTPAdapter
+from psycopg2 import sql
+from db import get_connection
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Таблицы, в которых считаем строки, записанные за время прогона
+COUNTED_TABLES = [
+    "subscribers",
+    "subscriber_outbox",
+    "retry_queue",
+    "webhook_events",
+    "requests_log",
+    "serial_processing_log",
+    "mcrm_requests_log",
+    "listmonk_requests_log"
+]
+
+# Команды запуска вебхука для --spawn (переменные окружения указывают на заглушки).
+# Журналы gunicorn переопределяются: в gunicorn_config.py путь /app/logs есть только в контейнере
+SPAWN_LOG_ARGS = ["--access-logfile", "{log_dir}/gunicorn_access.log", "--error-logfile", "{log_dir}/gunicorn_error.log"]
+SPAWN_COMMANDS = {
+    "flask": ["gunicorn", "-c", "gunicorn_config.py", *SPAWN_LOG_ARGS, "--bind", "{bind}", "--workers", "{workers}",
+              "webhook:app"],
+    "asgi": ["gunicorn", "-c", "gunicorn_config.py", *SPAWN_LOG_ARGS, "--bind", "{bind}", "--workers", "{workers}",
+             "-k", "uvicorn.workers.UvicornWorker", "webhook_asgi:app"]
+}
+# Диспетчер outbox для --spawn: подписчики уходят в listmonk из subscriber_outbox, а не из запроса
+OUTBOX_COMMAND = [sys.executable, "worker.py", "--outbox"]
+
+
+# Поведение заглушки: задержка с разбросом и доля ошибочных ответов
+class StubBehaviour:
+    def __init__(self, latency, jitter, error_rate, error_status):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hits = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    # Возвращает код ошибки или None, если нужно ответить успешно
+    def simulate(self):
+        delay = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        if delay:
+            time.sleep(delay)
+        failed = random.random() < self.error_rate
+        with self._lock:
+            self.hits += 1
+            if failed:
+                self.errors += 1
+        return self.error_status if failed else None
+
+
+def make_handler(behaviour, respond):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _handle(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            error_status = behaviour.simulate()
+            if error_status:
+                status, payload = error_status, {"error": "stub error"}
+            else:
+                status, payload = respond(self, body)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+# Ответ MCRM: клиент с email, построенным из номера карты
+def mcrm_respond(handler, body):
+    number = parse_qs(urlsplit(handler.path).query).get('number', [''])[0]
+    return 200, {
+        "status": "ok",
+        "user_id": number,
+        "email": f"{number}@loadtest.local",
+        "phone": f"+7{number[-10:]:0>10}",
+        "first_name": "Load",
+        "last_name": "Test",
+        "card_number": number,
+        "balance": 0
+    }
+
+
+_listmonk_ids = itertools.count(1)
+
+
+# Ответ listmonk: подписчик создан
+def listmonk_respond(handler, body):
+    return 200, {"data": {"id": next(_listmonk_ids)}}
+
+
+def start_stub(port, behaviour, respond):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(behaviour, respond))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Число строк, появившихся в таблицах начиная с момента since (по часам БД)
+def count_rows(since):
+    counts = {}
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        for table in COUNTED_TABLES:
+            cursor.execute(sql.SQL("SELECT COUNT(*) FROM {} WHERE timestamp >= %s").format(sql.Identifier(table)), (since,))
+            counts[table] = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+    return counts
+
+
+# Ожидание, пока диспетчер отправит в listmonk всё, что появилось в subscriber_outbox за прогон
+def wait_for_outbox(since, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql.SQL("SELECT COUNT(*) FROM subscriber_outbox WHERE timestamp >= %s"), (since,))
+            pending = cursor.fetchone()[0]
+            conn.commit()
+            cursor.close()
+        if not pending or time.monotonic() >= deadline:
+            return pending
+        time.sleep(0.5)
+
+
+# Полнота конвейера: каждый новый подписчик создан в listmonk ровно одним успешным запросом
+def check_pipeline(stubs, rows):
+    listmonk = stubs["listmonk"]
+    delivered = listmonk.hits - listmonk.errors
+    return {
+        "new_subscribers": rows["subscribers"],
+        "listmonk_created": delivered,
+        "outbox_pending": rows["subscriber_outbox"],
+        "complete": delivered == rows["subscribers"] and rows["subscriber_outbox"] == 0
+    }
+
+
+def db_now():
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("SELECT LOCALTIMESTAMP"))
+        now = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+    return now
+
+
+def wait_for_health(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+# Открытая модель нагрузки: запросы отправляются по расписанию независимо от ответов,
+# задержка считается от запланированного момента (без coordinated omission)
+def run_load(url, rps, duration, concurrency, duplicate_rate, auth, timeout):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount(url, adapter)
+    run_id = str(int(time.time()))[-5:]
+    results = []
+    results_lock = threading.Lock()
+    serials = []
+
+    def send(scheduled, serial):
+        try:
+            response = session.post(url, data={"serial": serial, "event": "cardcreate"}, auth=auth, timeout=timeout)
+            outcome = response.status_code
+        except requests.RequestException as e:
+            outcome = type(e).__name__
+        with results_lock:
+            results.append((time.monotonic() - scheduled, outcome))
+
+    total = int(rps * duration)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(total):
+            scheduled = started + i / rps
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if serials and random.random() < duplicate_rate:
+                serial = random.choice(serials)
+            else:
+                serial = f"{run_id}{i:07d}-1"
+                serials.append(serial)
+            executor.submit(send, scheduled, serial)
+    elapsed = time.monotonic() - started
+    return results, elapsed
+
+
+def build_report(results, elapsed, rps, stubs, rows, pipeline):
+    latencies = sorted(latency for latency, _ in results)
+    outcomes = {}
+    for _, outcome in results:
+        outcomes[str(outcome)] = outcomes.get(str(outcome), 0) + 1
+    failed = sum(count for outcome, count in outcomes.items() if not outcome.startswith('2'))
+    return {
+        "target_rps": rps,
+        "achieved_rps": round(len(results) / elapsed, 1) if elapsed else 0,
+        "requests": len(results),
+        "error_rate": round(failed / len(results), 4) if results else 0,
+        "outcomes": outcomes,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p95": round(percentile(latencies, 95) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+            "max": round(latencies[-1] * 1000, 1) if latencies else 0
+        },
+        "stubs": {name: {"hits": b.hits, "errors": b.errors} for name, b in stubs.items()},
+        "db_rows": rows,
+        "pipeline": pipeline
+    }
+
+
+def print_report(report):
+    print(f"Запросов: {report['requests']}, целевой RPS: {report['target_rps']}, фактический RPS: {report['achieved_rps']}")
+    latency = report['latency_ms']
+    print(f"Задержка, мс: p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} max={latency['max']}")
+    print(f"Доля ошибок: {report['error_rate']:.2%}, ответы: {report['outcomes']}")
+    for name, stats in report['stubs'].items():
+        print(f"Заглушка {name}: запросов={stats['hits']}, ошибок={stats['errors']}")
+    if report['db_rows'] is not None:
+        print("Записано строк в БД: " + ", ".join(f"{table}={count}" for table, count in report['db_rows'].items()))
+    pipeline = report['pipeline']
+    if pipeline is not None:
+        print(f"Конвейер: новых подписчиков={pipeline['new_subscribers']}, создано в listmonk={pipeline['listmonk_created']}, "
+              f"не отправлено из outbox={pipeline['outbox_pending']}")
+        if not pipeline['complete']:
+            print("ВНИМАНИЕ: число созданных в listmonk подписчиков не совпадает с числом новых подписчиков")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /webhook с локальными заглушками MCRM и listmonk")
+    parser.add_argument('--target', default="http://127.0.0.1:5002", help="адрес вебхука")
+    parser.add_argument('--rps', type=float, default=50, help="целевое количество запросов в секунду")
+    parser.add_argument('--duration', type=float, default=30, help="длительность прогона, секунд")
+    parser.add_argument('--concurrency', type=int, default=200, help="максимум одновременных запросов")
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help="доля повторных serial")
+    parser.add_argument('--timeout', type=float, default=30, help="таймаут запроса к вебхуку, секунд")
+    parser.add_argument('--user', default=os.getenv("WEBHOOK_USERNAME"), help="пользователь Basic Auth")
+    parser.add_argument('--password', default=os.getenv("WEBHOOK_PASSWORD"), help="пароль Basic Auth")
+    parser.add_argument('--mcrm-port', type=int, default=18081)
+    parser.add_argument('--mcrm-latency', type=float, default=0.05, help="задержка ответа MCRM, секунд")
+    parser.add_argument('--mcrm-error-rate', type=float, default=0.0)
+    parser.add_argument('--listmonk-port', type=int, default=18082)
+    parser.add_argument('--listmonk-latency', type=float, default=0.05, help="задержка ответа listmonk, секунд")
+    parser.add_argument('--listmonk-error-rate', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.01, help="разброс задержки заглушек, секунд")
+    parser.add_argument('--error-status', type=int, default=503, help="код ошибочного ответа заглушек")
+    parser.add_argument('--spawn', choices=sorted(SPAWN_COMMANDS), help="запустить вебхук с адресами заглушек")
+    parser.add_argument('--workers', type=int, default=2, help="количество воркеров gunicorn для --spawn")
+    parser.add_argument('--log-dir', help="каталог журналов вебхука для --spawn (по умолчанию временный)")
+    parser.add_argument('--outbox-timeout', type=float, default=60, help="ожидание отправки subscriber_outbox, секунд")
+    parser.add_argument('--no-db', action='store_true', help="не считать строки в БД")
+    parser.add_argument('--json', help="сохранить отчёт в файл")
+    args = parser.parse_args()
+
+    stubs = {
+        "mcrm": StubBehaviour(args.mcrm_latency, args.jitter, args.mcrm_error_rate, args.error_status),
+        "listmonk": StubBehaviour(args.listmonk_latency, args.jitter, args.listmonk_error_rate, args.error_status)
+    }
+    servers = [
+        start_stub(args.mcrm_port, stubs["mcrm"], mcrm_respond),
+        start_stub(args.listmonk_port, stubs["listmonk"], listmonk_respond)
+    ]
+    stub_env = {
+        "MCRM_API_URL_USER": f"http://127.0.0.1:{args.mcrm_port}/user",
+        "LISTMONK_API_URL": f"http://127.0.0.1:{args.listmonk_port}/api/subscribers"
+    }
+    logger.info(f"Заглушки запущены: {stub_env}")
+
+    processes = []
+    if args.spawn:
+        bind = urlsplit(args.target).netloc
+        log_dir = args.log_dir or tempfile.mkdtemp(prefix="loadtest_logs_")
+        os.makedirs(log_dir, exist_ok=True)
+        command = [part.format(bind=bind, workers=args.workers, log_dir=log_dir) for part in SPAWN_COMMANDS[args.spawn]]
+        env = {**os.environ, **stub_env, "LOG_DIR": log_dir}
+        processes.append(subprocess.Popen(command, env=env))
+        logger.info(f"Запущен вебхук: {' '.join(command)}, журналы: {log_dir}")
+        processes.append(subprocess.Popen(OUTBOX_COMMAND, env=env))
+        logger.info(f"Запущен диспетчер outbox: {' '.join(OUTBOX_COMMAND)}")
+    else:
+        logger.info("Вебхук и worker.py --outbox должны быть запущены с переменными окружения: " +
+                    " ".join(f"{k}={v}" for k, v in stub_env.items()))
+
+    try:
+        if not wait_for_health(f"{args.target}/health", 30):
+            logger.error(f"Вебхук не отвечает на {args.target}/health")
+            sys.exit(1)
+
+        since = None if args.no_db else db_now()
+        auth = (args.user, args.password) if args.user else None
+        results, elapsed = run_load(f"{args.target}/webhook", args.rps, args.duration, args.concurrency,
+                                    args.duplicate_rate, auth, args.timeout)
+        # Даём буферизованному журналу и воркерам дописать строки, диспетчеру - отправить outbox
+        time.sleep(2)
+        rows, pipeline = None, None
+        if not args.no_db:
+            wait_for_outbox(since, args.outbox_timeout)
+            rows = count_rows(since)
+            pipeline = check_pipeline(stubs, rows)
+        report = build_report(results, elapsed, args.rps, stubs, rows, pipeline)
+        print_report(report)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=30)
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import os
+import re
+import logging
+from datetime import date
+from dotenv import load_dotenv
+from psycopg2 import sql
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Хранение журналов: месяцев, за которые держим партиции, и сколько создаём заранее
+AUDIT_LOG_RETENTION_MONTHS = int(os.getenv("AUDIT_LOG_RETENTION_MONTHS", "6"))
+AUDIT_LOG_PARTITIONS_AHEAD = int(os.getenv("AUDIT_LOG_PARTITIONS_AHEAD", "2"))
+
+# Ключ advisory-блокировки, чтобы DDL партиций не выполнялся из нескольких процессов сразу
+PARTITION_LOCK_KEY = 7010016
+
+# Колонки журналов (id и timestamp добавляются для всех) и индексируемые поля поиска
+LOG_TABLES = {
+    "requests_log": {
+        "columns": """
+            method VARCHAR(10),
+            path VARCHAR(255),
+            headers TEXT,
+            remote_addr VARCHAR(45),
+            serial VARCHAR(255),
+            event VARCHAR(100),
+            error_message TEXT
+        """,
+        "lookup": ["serial"]
+    },
+    "serial_processing_log": {
+        "columns": """
+            original_serial VARCHAR(255),
+            cleaned_serial VARCHAR(255),
+            error_message TEXT
+        """,
+        "lookup": ["cleaned_serial"]
+    },
+    "mcrm_requests_log": {
+        "columns": """
+            url VARCHAR(255),
+            number VARCHAR(255),
+            status_code INTEGER,
+            response TEXT,
+            error_message TEXT
+        """,
+        "lookup": ["number"]
+    },
+    "listmonk_requests_log": {
+        "columns": """
+            url VARCHAR(255),
+            payload TEXT,
+            status_code INTEGER,
+            response TEXT,
+            error_message TEXT
+        """,
+        "lookup": []
+    }
+}
+
+PARTITION_SUFFIX = re.compile(r"_p(\d{4})(\d{2})$")
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month.year}{month.month:02d}"
+
+
+# Тип таблицы: 'p' - секционированная, 'r' - обычная, None - не существует
+def _relkind(cursor, name):
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relnamespace = 'public'::regnamespace", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# Старая несекционированная таблица переименовывается в <table>_legacy вместе с PK и
+# последовательностью; новые id продолжают нумерацию старых
+def _rename_legacy(cursor, table):
+    legacy = f"{table}_legacy"
+    logger.warning(f"Таблица {table} не секционирована, переименовывается в {legacy}")
+    cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(table), sql.Identifier(legacy)))
+    cursor.execute(sql.SQL("ALTER INDEX IF EXISTS {} RENAME TO {}").format(
+        sql.Identifier(f"{table}_pkey"), sql.Identifier(f"{legacy}_pkey")))
+    cursor.execute(sql.SQL("ALTER SEQUENCE IF EXISTS {} RENAME TO {}").format(
+        sql.Identifier(f"{table}_id_seq"), sql.Identifier(f"{legacy}_id_seq")))
+    cursor.execute(sql.SQL("SELECT COALESCE(MAX(id), 0) FROM {}").format(sql.Identifier(legacy)))
+    return cursor.fetchone()[0]
+
+
+# Создание секционированных по месяцам журналов, их индексов и партиций
+def create_log_tables(cursor):
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_KEY,))
+    for table, spec in LOG_TABLES.items():
+        last_id = _rename_legacy(cursor, table) if _relkind(cursor, table) == 'r' else None
+
+        cursor.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {} (
+                id BIGSERIAL,
+                timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                {},
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp)
+        """).format(sql.Identifier(table), sql.SQL(spec["columns"].strip())))
+        if last_id:
+            cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), %s)", (table, last_id))
+
+        # Поиск по serial/number с сортировкой по времени; BRIN по времени почти не занимает места
+        for column in spec["lookup"]:
+            cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} ({}, timestamp)").format(
+                sql.Identifier(f"{table}_{column}_idx"), sql.Identifier(table), sql.Identifier(column)))
+        cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING BRIN (timestamp)").format(
+            sql.Identifier(f"{table}_timestamp_idx"), sql.Identifier(table)))
+
+        # Страховка для строк вне созданных диапазонов
+        cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT").format(
+            sql.Identifier(f"{table}_default"), sql.Identifier(table)))
+    ensure_partitions(cursor)
+
+
+# Партиции на текущий месяц и AUDIT_LOG_PARTITIONS_AHEAD месяцев вперёд
+def ensure_partitions(cursor, months_ahead=AUDIT_LOG_PARTITIONS_AHEAD):
+    current = date.today().replace(day=1)
+    for table in LOG_TABLES:
+        for offset in range(months_ahead + 1):
+            month = add_months(current, offset)
+            name = partition_name(table, month)
+            if _relkind(cursor, name) is not None:
+                continue
+            cursor.execute("SAVEPOINT log_partition")
+            try:
+                cursor.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(
+                    sql.Identifier(name), sql.Identifier(table)), (month, add_months(month, 1)))
+                cursor.execute("RELEASE SAVEPOINT log_partition")
+                logger.info(f"Создана партиция {name}")
+            except Exception as e:
+                # Например, в DEFAULT уже есть строки за этот месяц
+                cursor.execute("ROLLBACK TO SAVEPOINT log_partition")
+                logger.error(f"Ошибка создания партиции {name}: {e}")
+
+
+# Удаление партиций старше срока хранения: DROP TABLE вместо DELETE по всей таблице
+def drop_old_partitions(cursor, retention_months=AUDIT_LOG_RETENTION_MONTHS):
+    cutoff = add_months(date.today().replace(day=1), -retention_months)
+    dropped = []
+    for table in LOG_TABLES:
+        cursor.execute("""
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = %s
+        """, (table,))
+        for (name,) in cursor.fetchall():
+            match = PARTITION_SUFFIX.search(name)
+            if not match:
+                continue
+            month = date(int(match.group(1)), int(match.group(2)), 1)
+            if add_months(month, 1) <= cutoff:
+                cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+                dropped.append(name)
+
+        # Переименованная старая таблица удаляется целиком, когда все её строки старше срока
+        legacy = f"{table}_legacy"
+        if _relkind(cursor, legacy) is not None:
+            cursor.execute(sql.SQL("SELECT MAX(timestamp) FROM {}").format(sql.Identifier(legacy)))
+            newest = cursor.fetchone()[0]
+            if newest is None or newest.date() < cutoff:
+                cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(legacy)))
+                dropped.append(legacy)
+    return dropped
+
+
+# Плановое обслуживание журналов: новые партиции вперёд и удаление устаревших
+def run_log_maintenance():
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (PARTITION_LOCK_KEY,))
+            if not cursor.fetchone()[0]:
+                logger.info("Обслуживание журналов уже выполняется другим процессом")
+                conn.rollback()
+                return
+            ensure_partitions(cursor)
+            dropped = drop_old_partitions(cursor)
+            conn.commit()
+            cursor.close()
+        if dropped:
+            logger.info(f"Удалены устаревшие партиции журналов: {', '.join(dropped)}")
+    except Exception as e:
+        logger.error(f"Ошибка обслуживания партиций журналов: {e}")
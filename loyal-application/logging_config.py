@@ -0,0 +1,170 @@
+import atexit
+import glob
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Параметры логирования
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+LOG_DIR = os.getenv("LOG_DIR", ".")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(100 * 1024 * 1024)))  # 0 - без ограничения размера
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "14"))  # 0 - не удалять старые файлы
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))  # доля записываемых частых сообщений
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+
+# extra для частых строк на пути запроса: logger.info("...", arg, extra=SAMPLED)
+SAMPLED = {"sample_rate": LOG_SAMPLE_RATE}
+
+
+# Файл на каждый день (prefix_YYYYMMDD.log), при превышении размера - prefix_YYYYMMDD.N.log.
+# Файлы не переименовываются, поэтому несколько процессов gunicorn могут писать в них одновременно
+class DailySizeFileHandler(logging.FileHandler):
+    def __init__(self, prefix, directory=LOG_DIR, max_bytes=LOG_MAX_BYTES, retention_days=LOG_RETENTION_DAYS):
+        self.prefix = prefix
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.retention_days = retention_days
+        self._day = datetime.now().strftime("%Y%m%d")
+        self._index = self._free_index(self._day, 0)
+        super().__init__(self._path(self._day, self._index), delay=True)
+
+    def _path(self, day, index):
+        name = f"{self.prefix}_{day}.log" if index == 0 else f"{self.prefix}_{day}.{index}.log"
+        return os.path.abspath(os.path.join(self.directory, name))
+
+    def _free_index(self, day, index):
+        while self.max_bytes:
+            path = self._path(day, index)
+            if not os.path.exists(path) or os.path.getsize(path) < self.max_bytes:
+                break
+            index += 1
+        return index
+
+    def _switch(self, day, index):
+        self.close()
+        self._day = day
+        self._index = self._free_index(day, index)
+        self.baseFilename = self._path(day, self._index)
+
+    def _cleanup(self):
+        if not self.retention_days:
+            return
+        cutoff = time.time() - self.retention_days * 86400
+        for path in glob.glob(os.path.join(self.directory, f"{self.prefix}_*.log")):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def emit(self, record):
+        day = datetime.now().strftime("%Y%m%d")
+        if day != self._day:
+            self._switch(day, 0)
+            self._cleanup()
+        elif self.max_bytes and self.stream is not None and os.fstat(self.stream.fileno()).st_size >= self.max_bytes:
+            self._switch(day, self._index + 1)
+        super().emit(record)
+
+
+# Выборочная запись: сообщение с extra=SAMPLED пропускается с вероятностью 1 - sample_rate
+class SampleFilter(logging.Filter):
+    def filter(self, record):
+        rate = getattr(record, "sample_rate", None)
+        return rate is None or random.random() < rate
+
+
+# Передаёт записи в очередь без блокировки: форматирование и запись в файл
+# выполняет фоновый поток, при переполнении очереди запись отбрасывается
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # Текст сообщения и трассировка снимаются в вызывающем потоке, как в QueueHandler:
+    # аргументы (например, изменяемый dict с payload) к моменту записи могут измениться.
+    # Оформление (время, уровень) по-прежнему выполняет поток записи
+    def prepare(self, record):
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def handle(self, record):
+        _ensure_listener()
+        return super().handle(record)
+
+
+_queue = None
+_handler = None
+_target = None
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+# Поток записи живёт в конкретном процессе; после fork (воркеры gunicorn) запускаем новый
+def _ensure_listener():
+    global _listener, _listener_pid
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+    with _listener_lock:
+        if _listener_pid != pid:
+            _listener = QueueListener(_queue, _target, respect_handler_level=True)
+            _listener.start()
+            _listener_pid = pid
+
+
+# Настройка корневого логгера: запросы только кладут запись в очередь
+def setup_logging(prefix):
+    global _queue, _handler, _target
+    if _handler is not None:
+        return _handler
+    os.makedirs(LOG_DIR, exist_ok=True)
+    _queue = queue.Queue(LOG_QUEUE_SIZE)
+    _target = DailySizeFileHandler(prefix)
+    _target.setFormatter(logging.Formatter(LOG_FORMAT))
+    _handler = NonBlockingQueueHandler(_queue)
+    _handler.addFilter(SampleFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(_handler)
+    atexit.register(stop_logging)
+    return _handler
+
+
+# Дописываем оставшиеся в очереди записи при завершении процесса
+def stop_logging():
+    global _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        _listener_pid = None
+    if _target is not None:
+        _target.close()
+
+
+def logging_stats():
+    if _handler is None:
+        return {}
+    return {"queued": _queue.qsize(), "dropped": _handler.dropped, "file": _target.baseFilename}
@@ -0,0 +1,193 @@
+import functools
+import inspect
+import os
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+    start_http_server
+)
+from prometheus_client.core import GaugeMetricFamily
+from psycopg2 import sql
+from db import get_connection, pool_stats
+
+logger = logging.getLogger(__name__)
+
+# Каталог для файлов метрик воркеров gunicorn; без него метрики считаются в пределах процесса
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Период обновления метрик пула фоновым потоком, секунд
+POOL_METRICS_INTERVAL = float(os.getenv("POOL_METRICS_INTERVAL", "5"))
+
+# Границы гистограмм: от кэш-попаданий (мс) до таймаута чтения HTTP
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+
+REQUESTS = Counter("webhook_requests_total", "Запросы к /webhook по результату", ["outcome"])
+REQUEST_SECONDS = Histogram("webhook_request_seconds", "Время обработки запроса /webhook", buckets=LATENCY_BUCKETS)
+BATCH_SECONDS = Histogram("webhook_batch_seconds", "Время обработки запроса /webhook/batch", buckets=LATENCY_BUCKETS)
+BATCH_SIZE = Histogram("webhook_batch_size", "Количество событий в запросе /webhook/batch",
+                       buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+STAGE_SECONDS = Histogram("webhook_stage_seconds", "Время этапов обработки cardcreate", ["stage"], buckets=LATENCY_BUCKETS)
+
+POOL_SIZE = Gauge("db_pool_connections", "Открытые соединения пула PostgreSQL", multiprocess_mode="livesum")
+POOL_IN_USE = Gauge("db_pool_in_use", "Занятые соединения пула PostgreSQL", multiprocess_mode="livesum")
+POOL_MAX = Gauge("db_pool_max", "Максимальный размер пула PostgreSQL", multiprocess_mode="livesum")
+POOL_TIMEOUTS = Gauge("db_pool_timeouts", "Таймауты ожидания соединения из пула", multiprocess_mode="livesum")
+
+CIRCUIT_STATE = Gauge("circuit_breaker_state", "Состояние выключателя: 0 - замкнут, 1 - проба, 2 - разомкнут",
+                      ["upstream"], multiprocess_mode="livemax")
+CIRCUIT_REJECTED = Counter("circuit_breaker_rejected_total", "Вызовы, отклонённые разомкнутым выключателем", ["upstream"])
+
+RATE_LIMIT_RPS = Gauge("rate_limit_rps", "Текущий общий лимит запросов к внешнему хосту", ["upstream"],
+                       multiprocess_mode="livemax")
+RATE_LIMITED = Counter("rate_limit_rejected_total", "Вызовы, не дождавшиеся токена лимитера", ["upstream"])
+
+
+# Время этапа: with observe_stage("mcrm"): ...
+@contextmanager
+def observe_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+# Декоратор для функций-этапов (в том числе async)
+def timed(stage):
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with observe_stage(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with observe_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Результат запроса по коду ответа и телу
+def request_outcome(status_code, result):
+    if status_code == 202:
+        return "accepted"
+    if status_code < 400:
+        return "duplicate" if result.get("duplicate") else "success"
+    if status_code < 500:
+        return "rejected"
+    return "error"
+
+
+def record_request(started, status_code, result):
+    REQUESTS.labels(request_outcome(status_code, result)).inc()
+    REQUEST_SECONDS.observe(time.perf_counter() - started)
+
+
+# Пакет учитывается по каждому событию, время - отдельной гистограммой
+def record_batch(started, items):
+    for item in items:
+        REQUESTS.labels(request_outcome(item["code"], item)).inc()
+    BATCH_SIZE.observe(len(items))
+    BATCH_SECONDS.observe(time.perf_counter() - started)
+
+
+# Снимок пула текущего процесса; в multiprocess-режиме значения воркеров суммируются
+def record_pool(stats=None):
+    if stats is None:
+        stats = pool_stats()
+    POOL_SIZE.set(stats["size"])
+    POOL_IN_USE.set(stats["in_use"])
+    POOL_MAX.set(stats["max"])
+    POOL_TIMEOUTS.set(stats.get("timeouts", 0))
+
+
+# Пул процесса записывается в gauge фоновым потоком раз в POOL_METRICS_INTERVAL, а не в каждом
+# запросе: в multiprocess-режиме каждый set() - запись в mmap-файл. Повторный вызов заменяет
+# источник статистики (ASGI подставляет пул asyncpg вместо psycopg2)
+_pool_metrics = {"pid": None, "stats": None}
+
+
+def start_pool_metrics(stats=None):
+    _pool_metrics["stats"] = stats
+    if _pool_metrics["pid"] == os.getpid():
+        return
+    _pool_metrics["pid"] = os.getpid()
+
+    def run():
+        while True:
+            try:
+                source = _pool_metrics["stats"]
+                record_pool(source() if source else None)
+            except Exception as e:
+                logger.error(f"Ошибка обновления метрик пула: {e}")
+            time.sleep(POOL_METRICS_INTERVAL)
+
+    threading.Thread(target=run, name="pool-metrics", daemon=True).start()
+
+
+# Глубина и возраст очередей читаются из БД в момент запроса /metrics
+class QueueCollector:
+    def collect(self):
+        depth = GaugeMetricFamily("retry_queue_depth", "Записи в retry_queue", labels=["state"])
+        oldest = GaugeMetricFamily("retry_queue_oldest_age_seconds", "Возраст самой старой записи retry_queue")
+        events = GaugeMetricFamily("webhook_events_pending", "Необработанные события webhook_events")
+        dead_letters = GaugeMetricFamily("dead_letters_rows", "Записи в dead_letters, ожидающие разбора")
+        outbox = GaugeMetricFamily("subscriber_outbox_pending", "Подписчики, ещё не отправленные в listmonk")
+        scrape_error = GaugeMetricFamily("queue_metrics_scrape_error", "Ошибка чтения метрик очередей")
+        try:
+            with get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql.SQL("""
+                    SELECT COUNT(*) FILTER (WHERE next_attempt_at <= CURRENT_TIMESTAMP),
+                           COUNT(*) FILTER (WHERE next_attempt_at > CURRENT_TIMESTAMP),
+                           COALESCE(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MIN(timestamp)), 0)
+                    FROM retry_queue
+                """))
+                due, scheduled, age = cursor.fetchone()
+                cursor.execute(sql.SQL("SELECT COUNT(*) FROM dead_letters"))
+                dead = cursor.fetchone()[0]
+                cursor.execute(sql.SQL("SELECT COUNT(*) FROM subscriber_outbox"))
+                outbox_pending = cursor.fetchone()[0]
+                cursor.execute(sql.SQL("SELECT COUNT(*) FROM webhook_events WHERE status IN ('pending', 'processing')"))
+                pending = cursor.fetchone()[0]
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Ошибка чтения метрик очередей: {e}")
+            scrape_error.add_metric([], 1)
+            return [scrape_error]
+        depth.add_metric(["due"], due)
+        depth.add_metric(["scheduled"], scheduled)
+        oldest.add_metric([], float(age))
+        events.add_metric([], pending)
+        dead_letters.add_metric([], dead)
+        outbox.add_metric([], outbox_pending)
+        scrape_error.add_metric([], 0)
+        return [depth, oldest, events, dead_letters, outbox, scrape_error]
+
+
+_queue_registry = CollectorRegistry()
+_queue_registry.register(QueueCollector())
+
+
+# Текст для /metrics: метрики всех воркеров плюс состояние очередей
+def render_metrics():
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry) + generate_latest(_queue_registry), CONTENT_TYPE_LATEST
+
+
+# Отдельный /metrics для процессов без HTTP-сервера (worker.py): метрики этапов, выключателей и пула
+# этого процесса. Очереди сюда не входят - их отдаёт /metrics вебхука
+def start_metrics_server(port):
+    start_http_server(port, registry=REGISTRY)
+    logger.info(f"Метрики процесса доступны на порту {port}")
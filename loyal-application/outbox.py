@@ -0,0 +1,201 @@
+import json
+import os
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import requests
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from db import get_connection
+from http_client import CircuitOpenError
+from metrics import observe_stage
+from rate_limiter import RateLimitExceeded
+from webhook import (
+    LISTMONK_API_URL, OUTBOX_NOTIFY_CHANNEL, RetryListener, classify_status, listmonk_client, log_error_to_db,
+    request_error_class, retry_delay
+)
+
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Параметры диспетчера subscriber_outbox
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))  # заданий за один захват
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "4"))  # одновременных запросов к listmonk
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300"))  # захваченное задание скрыто от других диспетчеров
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))  # после этого задание переносится в dead_letters
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "30"))  # максимум секунд ожидания без уведомлений
+
+
+# Захват пачки заданий, у которых подошло next_attempt_at; SKIP LOCKED позволяет
+# запускать несколько диспетчеров, сдвиг next_attempt_at защищает от падения во время отправки
+def claim_outbox_batch(batch_size=None):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("""
+            UPDATE subscriber_outbox
+            SET attempts = attempts + 1,
+                next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE id IN (
+                SELECT id FROM subscriber_outbox
+                WHERE next_attempt_at <= CURRENT_TIMESTAMP
+                ORDER BY next_attempt_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, serial, payload, attempts
+        """), (OUTBOX_LEASE_SECONDS, batch_size or OUTBOX_BATCH_SIZE))
+        rows = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+    return rows
+
+
+# id подписчика listmonk по email; нужен, когда подписчик уже создан предыдущей попыткой
+def find_listmonk_id(email):
+    response = listmonk_client.find_subscriber(email)
+    if response.status_code != 200:
+        return None
+    results = response.json().get('data', {}).get('results') or []
+    return results[0].get('id') if results else None
+
+
+def log_listmonk_error(payload, status_code, response, error_message):
+    log_error_to_db("listmonk_requests_log", {
+        "url": LISTMONK_API_URL,
+        "payload": json.dumps(payload),
+        "status_code": status_code,
+        "response": response,
+        "error_message": error_message
+    })
+
+
+# Отправка одного задания. Результат: (id, serial, attempts, uuid, error_class, error_message),
+# uuid заполнен при успехе, error_class - при ошибке
+def deliver(row):
+    outbox_id, serial, payload, attempts = row
+    try:
+        with observe_stage("listmonk"):
+            response = listmonk_client.create_subscriber(payload)
+        if response.status_code in [200, 201]:
+            data = response.json()
+            uuid = data.get('data', {}).get('id') or data.get('uuid', 'unknown')
+            return outbox_id, serial, attempts, str(uuid), None, None
+        if response.status_code == 409:
+            # Повторная доставка: подписчик создан раньше, но результат не успели зафиксировать
+            uuid = find_listmonk_id(payload['email']) or 'unknown'
+            logger.info(f"Подписчик уже есть в listmonk: outbox_id={outbox_id}, email={payload['email']}, uuid={uuid}")
+            return outbox_id, serial, attempts, str(uuid), None, None
+    except (requests.RequestException, CircuitOpenError, RateLimitExceeded) as e:
+        logger.error(f"Ошибка запроса к listmonk API: outbox_id={outbox_id}, error={e}")
+        log_listmonk_error(payload, None, None, f"listmonk API request error: {str(e)}")
+        return outbox_id, serial, attempts, None, request_error_class(e), f"listmonk API request error: {str(e)}"
+    except Exception as e:
+        logger.error(f"Ошибка отправки в listmonk: outbox_id={outbox_id}, error={e}")
+        return outbox_id, serial, attempts, None, "internal", str(e)
+
+    logger.error(f"Ошибка запроса к listmonk API: outbox_id={outbox_id}, status_code={response.status_code}, response={response.text}")
+    log_listmonk_error(payload, response.status_code, response.text, f"listmonk API error: {response.status_code}")
+    return outbox_id, serial, attempts, None, classify_status(response.status_code), f"listmonk API error: {response.status_code}"
+
+
+# Фиксация результатов пачки одной транзакцией: uuid в subscribers и удаление доставленных,
+# новая попытка с задержкой по классу ошибки, исчерпанные - в dead_letters с stage='outbox'
+# (replay_dead_letters.py возвращает их прямо в subscriber_outbox: строка subscribers уже есть)
+def finish_outbox_batch(results):
+    delivered = [(serial, uuid) for _, serial, _, uuid, _, _ in results if uuid is not None]
+    delivered_ids = [outbox_id for outbox_id, _, _, uuid, _, _ in results if uuid is not None]
+    failed = [result for result in results if result[3] is None]
+    rescheduled = [(outbox_id, error_class, error_message, retry_delay(error_class, attempts - 1))
+                   for outbox_id, _, attempts, _, error_class, error_message in failed if attempts < OUTBOX_MAX_ATTEMPTS]
+    exhausted = [(outbox_id, error_class, error_message)
+                 for outbox_id, _, attempts, _, error_class, error_message in failed if attempts >= OUTBOX_MAX_ATTEMPTS]
+
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        if delivered:
+            execute_values(cursor, """
+                UPDATE subscribers SET uuid = v.uuid
+                FROM (VALUES %s) AS v (serial, uuid)
+                WHERE subscribers.serial = v.serial
+            """, delivered)
+            cursor.execute(sql.SQL("DELETE FROM subscriber_outbox WHERE id = ANY(%s)"), (delivered_ids,))
+        if rescheduled:
+            execute_values(cursor, """
+                UPDATE subscriber_outbox
+                SET error_class = v.error_class, error_message = v.error_message,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => v.delay)
+                FROM (VALUES %s) AS v (id, error_class, error_message, delay)
+                WHERE subscriber_outbox.id = v.id
+            """, rescheduled)
+        if exhausted:
+            execute_values(cursor, """
+                WITH moved AS (
+                    DELETE FROM subscriber_outbox
+                    USING (VALUES %s) AS v (id, error_class, error_message)
+                    WHERE subscriber_outbox.id = v.id
+                    RETURNING subscriber_outbox.timestamp, subscriber_outbox.serial, subscriber_outbox.payload,
+                              subscriber_outbox.attempts, v.error_class AS last_error_class, v.error_message AS last_error
+                )
+                INSERT INTO dead_letters (timestamp, serial, event, stage, context, error_class, error_message, retry_count)
+                SELECT timestamp, serial, 'cardcreate', 'outbox', jsonb_build_object('listmonk_payload', payload),
+                       last_error_class, last_error, attempts
+                FROM moved
+            """, exhausted)
+        conn.commit()
+        cursor.close()
+
+    if exhausted:
+        logger.warning(f"Исчерпаны попытки отправки в listmonk, задания перенесены в dead_letters: {[row[0] for row in exhausted]}")
+    return len(delivered), len(failed)
+
+
+# Через сколько секунд подойдёт ближайшее задание (None, если outbox пуст)
+def seconds_until_next_outbox():
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("SELECT EXTRACT(EPOCH FROM MIN(next_attempt_at) - CURRENT_TIMESTAMP) FROM subscriber_outbox"))
+        seconds = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+    return float(seconds) if seconds is not None else None
+
+
+# Диспетчер outbox: доставка в listmonk как минимум один раз; повтор безопасен,
+# так как задание уникально по serial, а listmonk не создаёт второго подписчика с тем же email
+def run_outbox_dispatcher(stop=None):
+    stop = stop or threading.Event()
+    listener = RetryListener(OUTBOX_NOTIFY_CHANNEL)
+    with ThreadPoolExecutor(max_workers=OUTBOX_CONCURRENCY, thread_name_prefix="outbox-send") as executor:
+        while not stop.is_set():
+            try:
+                rows = claim_outbox_batch()
+            except Exception as e:
+                logger.error(f"Ошибка захвата заданий subscriber_outbox: {e}")
+                rows = []
+
+            if rows:
+                started = time.monotonic()
+                results = list(executor.map(deliver, rows))
+                try:
+                    delivered, failed = finish_outbox_batch(results)
+                    logger.info(f"Пачка outbox отправлена в listmonk: доставлено={delivered}, ошибок={failed}, "
+                                f"время={time.monotonic() - started:.2f} с")
+                except Exception as e:
+                    # Задания вернутся в работу после OUTBOX_LEASE_SECONDS, доставленные будут опознаны по 409
+                    logger.error(f"Ошибка фиксации результатов subscriber_outbox: {e}")
+                continue
+
+            # Спим до ближайшего задания, NOTIFY о новом задании будит раньше
+            try:
+                next_due = seconds_until_next_outbox()
+            except Exception as e:
+                logger.error(f"Ошибка чтения расписания subscriber_outbox: {e}")
+                next_due = None
+            timeout = OUTBOX_POLL_INTERVAL if next_due is None else min(max(next_due, 0.5), OUTBOX_POLL_INTERVAL)
+            listener.wait(timeout, stop)
+
+    listener.close()
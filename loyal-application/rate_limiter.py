@@ -0,0 +1,241 @@
+import asyncio
+import math
+import os
+import threading
+import time
+import logging
+from dotenv import load_dotenv
+from psycopg2 import sql
+from db import get_connection
+from metrics import RATE_LIMIT_RPS, RATE_LIMITED, observe_stage
+
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Общий для всех процессов лимит запросов к внешнему хосту (token bucket в PostgreSQL)
+# со скоростью по AIMD: рост на RATE_LIMIT_INCREASE в секунду работы без перегрузки,
+# уменьшение в RATE_LIMIT_DECREASE раз при 429/5xx, таймаутах и медленных ответах
+# По умолчанию выключен: лимиты MCRM и listmonk не измерены, а ожидание токена дольше
+# RATE_LIMIT_WAIT отправляет событие в retry_queue. Включать с RATE_LIMIT_INITIAL_RPS/MAX_RPS по лимиту API
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "false").lower() in ("1", "true", "yes")
+RATE_LIMIT_INITIAL_RPS = float(os.getenv("RATE_LIMIT_INITIAL_RPS", "20"))
+RATE_LIMIT_MIN_RPS = float(os.getenv("RATE_LIMIT_MIN_RPS", "1"))
+RATE_LIMIT_MAX_RPS = float(os.getenv("RATE_LIMIT_MAX_RPS", "200"))
+RATE_LIMIT_BURST_SECONDS = float(os.getenv("RATE_LIMIT_BURST_SECONDS", "2"))  # запас токенов, секунд при текущей скорости
+RATE_LIMIT_INCREASE = float(os.getenv("RATE_LIMIT_INCREASE", "1"))  # запросов/с
+RATE_LIMIT_DECREASE = float(os.getenv("RATE_LIMIT_DECREASE", "0.5"))
+RATE_LIMIT_COOLDOWN = float(os.getenv("RATE_LIMIT_COOLDOWN", "5"))  # секунд между уменьшениями
+RATE_LIMIT_LATENCY_TARGET = float(os.getenv("RATE_LIMIT_LATENCY_TARGET", "2"))  # секунд, медленнее - перегрузка
+# Процесс забирает токены примерно на секунду работы: строка rate_limits обновляется
+# раз в секунду на процесс, а не на каждые несколько запросов
+RATE_LIMIT_LEASE_SECONDS = float(os.getenv("RATE_LIMIT_LEASE_SECONDS", "1"))  # секунд скорости, забираемых за раз
+RATE_LIMIT_POLL_INTERVAL = float(os.getenv("RATE_LIMIT_POLL_INTERVAL", "0.25"))  # секунд между запросами к БД при ожидании
+RATE_LIMIT_WAIT = float(os.getenv("RATE_LIMIT_WAIT", "2"))  # секунд ожидания токена до отказа
+RATE_LIMIT_FAIL_OPEN_SECONDS = 30  # при недоступной БД лимит не применяется это время
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"Превышен лимит запросов к {name}, повтор через {retry_after:.1f} с")
+        self.name = name
+        self.retry_after = retry_after
+
+
+# Таблица общего состояния лимитеров; создаётся в init_db вместе с остальными таблицами
+def create_rate_limit_table(cursor):
+    cursor.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            name VARCHAR(255) PRIMARY KEY,
+            rate DOUBLE PRECISION NOT NULL,
+            min_rate DOUBLE PRECISION NOT NULL,
+            max_rate DOUBLE PRECISION NOT NULL,
+            tokens DOUBLE PRECISION NOT NULL DEFAULT 0,
+            last_granted INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            decreased_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, name):
+        self.name = name
+        self._tokens = 0
+        self._rate = RATE_LIMIT_INITIAL_RPS
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._fail_open_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"acquired": 0, "waits": 0, "rejected": 0, "decreases": 0, "refills": 0}
+
+    # Забираем из общего ведра до want токенов одним UPDATE. Все выражения SET видят
+    # строку до изменения, поэтому одновременные процессы не выдают токены дважды
+    def _refill(self):
+        with self._lock:
+            want = max(1, math.ceil(self._rate * RATE_LIMIT_LEASE_SECONDS))
+            increase = RATE_LIMIT_INCREASE * self._successes / max(self._rate, 1)
+            self._successes = 0
+        available = """
+            LEAST(GREATEST(1, rate * %(burst)s),
+                  tokens + rate * EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - updated_at))
+        """
+        query = sql.SQL("""
+            UPDATE rate_limits
+            SET tokens = {available} - FLOOR(LEAST(%(want)s, {available})),
+                last_granted = FLOOR(LEAST(%(want)s, {available})),
+                rate = CASE WHEN decreased_at < CURRENT_TIMESTAMP - make_interval(secs => %(cooldown)s)
+                            THEN LEAST(max_rate, rate + %(increase)s) ELSE rate END,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE name = %(name)s
+            RETURNING last_granted, rate
+        """).format(available=sql.SQL(available))
+        params = {
+            "name": self.name,
+            "want": want,
+            "burst": RATE_LIMIT_BURST_SECONDS,
+            "cooldown": RATE_LIMIT_COOLDOWN,
+            "increase": increase
+        }
+        try:
+            with get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, params)
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute(sql.SQL("""
+                        INSERT INTO rate_limits (name, rate, min_rate, max_rate, tokens)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON CONFLICT (name) DO NOTHING
+                    """), (self.name, RATE_LIMIT_INITIAL_RPS, RATE_LIMIT_MIN_RPS, RATE_LIMIT_MAX_RPS,
+                           RATE_LIMIT_INITIAL_RPS * RATE_LIMIT_BURST_SECONDS))
+                    cursor.execute(query, params)
+                    row = cursor.fetchone()
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Ошибка лимитера {self.name}, лимит отключён на {RATE_LIMIT_FAIL_OPEN_SECONDS} с: {e}")
+            with self._lock:
+                self._fail_open_until = time.monotonic() + RATE_LIMIT_FAIL_OPEN_SECONDS
+            return None
+        granted, rate = row
+        with self._lock:
+            self._rate = rate
+            self._tokens += granted
+            self._stats["refills"] += 1
+        RATE_LIMIT_RPS.labels(self.name).set(rate)
+        return granted
+
+    # Берём локальный токен; True - можно отправлять, иначе пауза до следующего запроса к БД
+    # (не чаще RATE_LIMIT_POLL_INTERVAL, чтобы ожидающие процессы не нагружали строку rate_limits)
+    def _take(self):
+        with self._lock:
+            if self._tokens > 0 or time.monotonic() < self._fail_open_until:
+                self._tokens = max(0, self._tokens - 1)
+                self._stats["acquired"] += 1
+                return True, 0
+            return False, max(1 / max(self._rate, RATE_LIMIT_MIN_RPS), RATE_LIMIT_POLL_INTERVAL)
+
+    def _reject(self, wait):
+        with self._lock:
+            self._stats["rejected"] += 1
+        RATE_LIMITED.labels(self.name).inc()
+        raise RateLimitExceeded(self.name, wait)
+
+    def acquire(self, timeout=RATE_LIMIT_WAIT):
+        deadline = time.monotonic() + timeout
+        with observe_stage("rate_limit_wait"):
+            while True:
+                taken, wait = self._take()
+                if taken:
+                    return
+                # После ошибки БД _take пропускает запрос (fail-open)
+                self._refill()
+                if self._take()[0]:
+                    return
+                if time.monotonic() + wait > deadline:
+                    self._reject(wait)
+                with self._lock:
+                    self._stats["waits"] += 1
+                time.sleep(wait)
+
+    async def acquire_async(self, timeout=RATE_LIMIT_WAIT):
+        deadline = time.monotonic() + timeout
+        with observe_stage("rate_limit_wait"):
+            while True:
+                taken, wait = self._take()
+                if taken:
+                    return
+                await asyncio.to_thread(self._refill)
+                if self._take()[0]:
+                    return
+                if time.monotonic() + wait > deadline:
+                    self._reject(wait)
+                with self._lock:
+                    self._stats["waits"] += 1
+                await asyncio.sleep(wait)
+
+    # Учёт результата; True - нужна отправка уменьшения скорости (decrease)
+    def observe(self, congested):
+        with self._lock:
+            if not congested:
+                self._successes += 1
+                return False
+            now = time.monotonic()
+            if now - self._last_decrease < RATE_LIMIT_COOLDOWN:
+                return False
+            self._last_decrease = now
+            return True
+
+    # Мультипликативное уменьшение; не чаще RATE_LIMIT_COOLDOWN по всем процессам
+    def decrease(self):
+        try:
+            with get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql.SQL("""
+                    UPDATE rate_limits
+                    SET rate = GREATEST(min_rate, rate * %s), decreased_at = CURRENT_TIMESTAMP
+                    WHERE name = %s AND decreased_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                    RETURNING rate
+                """), (RATE_LIMIT_DECREASE, self.name, RATE_LIMIT_COOLDOWN))
+                row = cursor.fetchone()
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Ошибка уменьшения лимита {self.name}: {e}")
+            return
+        if row is not None:
+            with self._lock:
+                self._rate = row[0]
+                self._stats["decreases"] += 1
+            RATE_LIMIT_RPS.labels(self.name).set(row[0])
+            logger.warning(f"Скорость запросов к {self.name} снижена до {row[0]:.1f} запросов/с")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({"rate": round(self._rate, 2), "local_tokens": self._tokens})
+        return stats
+
+
+# Признак перегрузки внешнего API по ответу или исключению
+def is_congested(status_code=None, elapsed=0.0, timed_out=False):
+    return timed_out or status_code == 429 or (status_code is not None and status_code >= 500) \
+        or elapsed > RATE_LIMIT_LATENCY_TARGET
+
+
+# Лимитеры по хосту внешнего API
+rate_limiters = {}
+
+
+def get_limiter(host):
+    if not RATE_LIMIT_ENABLED or not host:
+        return None
+    if host not in rate_limiters:
+        rate_limiters[host] = AdaptiveRateLimiter(host)
+    return rate_limiters[host]
+
+
+def rate_limit_stats():
+    return {name: limiter.stats() for name, limiter in rate_limiters.items()}
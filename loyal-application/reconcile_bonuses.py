@@ -0,0 +1,94 @@
+import argparse
+import logging
+import sys
+from datetime import datetime
+from psycopg2 import sql
+from app import BONUS_LOCK_KEY, init_db
+from db import create_connection
+
+logger = logging.getLogger(__name__)
+
+
+# Условие отбора незавершённых начислений: отметка стоит, бонус не зафиксирован
+def build_filter(args):
+    conditions, params = [sql.SQL("NOT bonus_added AND bonus_claimed_at IS NOT NULL")], []
+    if args.uids:
+        conditions.append(sql.SQL("uid = ANY(%s)"))
+        params.append(args.uids)
+    if args.before:
+        conditions.append(sql.SQL("bonus_claimed_at < %s"))
+        params.append(args.before)
+    return sql.SQL(" AND ").join(conditions), params
+
+
+def list_claims(cursor, where, params, limit):
+    cursor.execute(sql.SQL("""
+        SELECT uid, phone, bonus_claimed_at FROM subscribers
+        WHERE {} ORDER BY bonus_claimed_at LIMIT %s
+    """).format(where), params + [limit])
+    rows = cursor.fetchall()
+    print(f"Начислений с неизвестным исходом: {len(rows)}")
+    for uid, phone, claimed_at in rows:
+        print(f"  uid={uid}, phone={phone}, bonus_claimed_at={claimed_at}")
+
+
+# --confirm: бонус найден в MCRM, фиксируем начисление.
+# --release: бонуса в MCRM нет, снимаем отметку - планировщик начислит в следующем запуске
+def resolve_claims(cursor, where, params, limit, confirm):
+    action = sql.SQL("bonus_added = TRUE") if confirm else sql.SQL("bonus_claimed_at = NULL")
+    cursor.execute(sql.SQL("""
+        UPDATE subscribers SET {}
+        WHERE uid IN (SELECT uid FROM subscribers WHERE {} ORDER BY bonus_claimed_at LIMIT %s)
+        RETURNING uid
+    """).format(action, where), params + [limit])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Сверка начислений бонусов с неизвестным исходом (таймаут или обрыв после отправки в MCRM)")
+    parser.add_argument('--uids', nargs='+', help="UID подписчиков")
+    parser.add_argument('--before', type=parse_time, help="отметка начисления раньше (ISO 8601)")
+    parser.add_argument('--limit', type=int, default=1000, help="максимум записей за запуск")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--confirm', action='store_true', help="бонус есть в MCRM: отметить как начисленный")
+    action.add_argument('--release', action='store_true', help="бонуса нет в MCRM: вернуть в начисление")
+    args = parser.parse_args()
+
+    if (args.confirm or args.release) and not args.uids and not args.before:
+        parser.error("для --confirm и --release нужен --uids или --before")
+
+    init_db()
+    where, params = build_filter(args)
+    conn = create_connection()
+    try:
+        cursor = conn.cursor()
+        # Та же блокировка, что у планировщика: отметки не меняются во время начисления
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', (BONUS_LOCK_KEY,))
+        if not cursor.fetchone()[0]:
+            print("Идёт начисление бонусов планировщиком, повторите позже")
+            sys.exit(1)
+        if not args.confirm and not args.release:
+            list_claims(cursor, where, params, args.limit)
+            conn.commit()
+            return
+        uids = resolve_claims(cursor, where, params, args.limit, args.confirm)
+        conn.commit()
+        print(f"{'Подтверждено' if args.confirm else 'Возвращено в начисление'}: {len(uids)}")
+        for uid in uids:
+            print(f"  uid={uid}")
+    finally:
+        # Блокировка сессии снимается при закрытии соединения
+        conn.close()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        logger.error(f"Ошибка сверки начислений бонусов: {e}")
+        sys.exit(1)
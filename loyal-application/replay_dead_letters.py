@@ -0,0 +1,231 @@
+import argparse
+import logging
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from psycopg2 import sql
+from db import DB_POOL_MAX, get_connection
+from webhook import OUTBOX_NOTIFY_CHANNEL, RETRY_INTERVAL, RETRY_NOTIFY_CHANNEL, init_db, process_retry_item
+
+logger = logging.getLogger(__name__)
+
+# Сколько записей показывать в --dry-run
+SAMPLE_SIZE = 10
+
+
+# Условие отбора dead_letters по аргументам командной строки
+def build_filter(args):
+    conditions, params = [], []
+    if args.ids:
+        conditions.append(sql.SQL("id = ANY(%s)"))
+        params.append(args.ids)
+    if args.error_class:
+        conditions.append(sql.SQL("error_class = ANY(%s)"))
+        params.append(args.error_class)
+    if args.stage:
+        conditions.append(sql.SQL("stage = ANY(%s)"))
+        params.append(args.stage)
+    if args.serial:
+        conditions.append(sql.SQL("serial = ANY(%s)"))
+        params.append(args.serial)
+    if args.since:
+        conditions.append(sql.SQL("dead_at >= %s"))
+        params.append(args.since)
+    if args.until:
+        conditions.append(sql.SQL("dead_at < %s"))
+        params.append(args.until)
+    where = sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("TRUE")
+    return where, params
+
+
+def select_ids(where, params, limit):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("SELECT id, stage FROM dead_letters WHERE {} ORDER BY id LIMIT %s").format(where),
+                       params + [limit])
+        ids = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+    return ids
+
+
+# Сводка по выбранным записям без изменений в БД
+def dry_run(where, params, limit):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("""
+            WITH selected AS (
+                SELECT * FROM dead_letters WHERE {} ORDER BY id LIMIT %s
+            )
+            SELECT error_class, stage, COUNT(*), MIN(dead_at), MAX(dead_at)
+            FROM selected
+            GROUP BY error_class, stage
+            ORDER BY COUNT(*) DESC
+        """).format(where), params + [limit])
+        groups = cursor.fetchall()
+        cursor.execute(sql.SQL("""
+            SELECT id, serial, event, stage, error_class, error_message, dead_at
+            FROM dead_letters WHERE {} ORDER BY id LIMIT %s
+        """).format(where), params + [min(limit, SAMPLE_SIZE)])
+        samples = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+
+    total = sum(group[2] for group in groups)
+    print(f"Будет повторно обработано записей: {total}")
+    for error_class, stage, count, first, last in groups:
+        print(f"  error_class={error_class}, stage={stage}: {count} (dead_at {first} - {last})")
+    if samples:
+        print("Примеры:")
+        for dead_id, serial, event, stage, error_class, error_message, dead_at in samples:
+            print(f"  id={dead_id}, serial={serial}, event={event}, stage={stage}, "
+                  f"error_class={error_class}, dead_at={dead_at}, error={error_message}")
+
+
+# Возврат записи в retry_queue с новым запасом попыток. При --enqueue запись сразу
+# доступна воркерам, иначе захвачена этим процессом на RETRY_INTERVAL, как в claim_retry_batch
+def restore(dead_id, enqueue):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("""
+            WITH moved AS (
+                DELETE FROM dead_letters WHERE id = %s AND stage IS DISTINCT FROM 'outbox'
+                RETURNING timestamp, serial, event, payload, stage, context, error_class, error_message
+            )
+            INSERT INTO retry_queue (timestamp, serial, event, payload, stage, context, error_class, error_message,
+                                     retry_count, last_attempt, next_attempt_at)
+            SELECT timestamp, serial, event, payload, stage, context, error_class, error_message,
+                   %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + make_interval(secs => %s)
+            FROM moved
+            RETURNING id, serial, event, payload, retry_count, stage, context
+        """), (dead_id, 0 if enqueue else 1, 0 if enqueue else RETRY_INTERVAL))
+        row = cursor.fetchone()
+        if row is not None and enqueue:
+            cursor.execute("SELECT pg_notify(%s, %s)", (RETRY_NOTIFY_CHANNEL, str(row[0])))
+        conn.commit()
+        cursor.close()
+    return row
+
+
+# Задание outbox, исчерпавшее попытки отправки в listmonk, возвращается в subscriber_outbox:
+# подписчик уже записан в subscribers, поэтому через retry_queue он был бы признан обработанным
+def restore_to_outbox(dead_id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("""
+            WITH moved AS (
+                DELETE FROM dead_letters WHERE id = %s AND stage = 'outbox'
+                RETURNING timestamp, serial, context
+            )
+            INSERT INTO subscriber_outbox (timestamp, serial, payload)
+            SELECT timestamp, serial, context->'listmonk_payload' FROM moved
+            ON CONFLICT (serial) DO UPDATE SET next_attempt_at = CURRENT_TIMESTAMP
+            RETURNING id
+        """), (dead_id,))
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute("SELECT pg_notify(%s, %s)", (OUTBOX_NOTIFY_CHANNEL, str(row[0])))
+        conn.commit()
+        cursor.close()
+    return row
+
+
+# Результат попытки: запись удалена из retry_queue - успех, иначе последняя ошибка
+def retry_outcome(retry_id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("SELECT error_class FROM retry_queue WHERE id = %s"), (retry_id,))
+        row = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+    return "ok" if row is None else f"retry:{row[0]}"
+
+
+def replay_one(dead_id, stage, enqueue):
+    if stage == "outbox":
+        try:
+            # Отправку выполняет диспетчер outbox (worker.py --outbox)
+            return "outbox" if restore_to_outbox(dead_id) is not None else "skipped"
+        except Exception as e:
+            logger.error(f"Ошибка переноса из dead_letters в subscriber_outbox: id={dead_id}, error={e}")
+            return "error"
+    try:
+        row = restore(dead_id, enqueue)
+    except Exception as e:
+        logger.error(f"Ошибка переноса из dead_letters: id={dead_id}, error={e}")
+        return "error"
+    if row is None:
+        # Уже перенесена другим запуском
+        return "skipped"
+    if enqueue:
+        return "enqueued"
+    retry_id, serial, event, payload, retry_count, stage, context = row
+    try:
+        process_retry_item(retry_id, serial, event, payload, retry_count, stage, context)
+        return retry_outcome(retry_id)
+    except Exception as e:
+        # Запись остаётся в retry_queue и будет подобрана воркером после RETRY_INTERVAL
+        logger.error(f"Ошибка повторной обработки dead_letters: id={dead_id}, retry_id={retry_id}, error={e}")
+        return "error"
+
+
+def replay(ids, concurrency, enqueue):
+    outcomes = Counter()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for done, outcome in enumerate(executor.map(lambda item: replay_one(item[0], item[1], enqueue), ids), 1):
+            outcomes[outcome] += 1
+            if done % 100 == 0:
+                print(f"Обработано {done}/{len(ids)}: {dict(outcomes)}", flush=True)
+    print(f"Готово за {time.monotonic() - started:.1f} с, записей: {len(ids)}, результат: {dict(outcomes)}")
+    return outcomes
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Повторная обработка записей dead_letters через MCRM -> listmonk")
+    parser.add_argument('--ids', type=int, nargs='+', help="id записей dead_letters")
+    parser.add_argument('--error-class', nargs='+', help="классы последней ошибки (network, upstream_5xx, ...)")
+    parser.add_argument('--stage', nargs='+', help="этапы, на которых произошёл сбой: mcrm, listmonk (запись подписчика "
+                        "и задания outbox), outbox (исчерпаны попытки отправки в listmonk)")
+    parser.add_argument('--serial', nargs='+', help="serial карт")
+    parser.add_argument('--since', type=parse_time, help="dead_at не раньше (ISO 8601)")
+    parser.add_argument('--until', type=parse_time, help="dead_at раньше (ISO 8601)")
+    parser.add_argument('--limit', type=int, default=10000, help="максимум записей за запуск")
+    parser.add_argument('--concurrency', type=int, default=DB_POOL_MAX, help="количество одновременных обработок")
+    parser.add_argument('--dry-run', action='store_true', help="только показать, что будет обработано")
+    parser.add_argument('--enqueue', action='store_true', help="вернуть записи в retry_queue для воркеров вместо обработки здесь")
+    args = parser.parse_args()
+
+    if args.concurrency < 1:
+        parser.error("--concurrency должен быть больше 0")
+    if args.concurrency > DB_POOL_MAX:
+        logger.warning(f"Потоков больше, чем соединений в пуле: threads={args.concurrency}, DB_POOL_MAX={DB_POOL_MAX}")
+
+    init_db()
+    where, params = build_filter(args)
+    if args.dry_run:
+        dry_run(where, params, args.limit)
+        return
+
+    ids = select_ids(where, params, args.limit)
+    if not ids:
+        print("Нет записей dead_letters по заданным условиям")
+        return
+    print(f"Повторная обработка записей dead_letters: {len(ids)}, потоков: {args.concurrency}")
+    outcomes = replay(ids, args.concurrency, args.enqueue)
+    if outcomes["error"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        logger.error(f"Ошибка повторной обработки dead_letters: {e}")
+        sys.exit(1)
@@ -4,28 +4,37 @@ import logging
 import os
 from dotenv import load_dotenv
 import requests
-from datetime import datetime, timedelta
-import base64
+from datetime import datetime
 import socket
 import sys
-import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import Json, execute_values
 import json
+import random
+import select
 import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from db import DB_HOST, DB_NAME, DB_POOL_MAX, create_connection, get_connection, pool_stats
+from audit_log import audit_log
+from http_client import CircuitOpenError, McrmClient, ListmonkClient, circuit_stats
+from cache import ResponseCache, RecentKeys
+from logging_config import SAMPLED, logging_stats, setup_logging
+from log_partitions import create_log_tables
+from rate_limiter import RateLimitExceeded, create_rate_limit_table, rate_limit_stats
+from metrics import record_batch, record_pool, record_request, render_metrics, request_outcome, start_pool_metrics, timed
 
 app = Flask(__name__)
 auth = HTTPBasicAuth()
+# Метрики пула обновляются фоновым потоком процесса (см. metrics.start_pool_metrics)
+start_pool_metrics()
 
 # Загружаем переменные окружения
 load_dotenv()
 
-# Настраиваем логирование
-logging.basicConfig(
-    filename=f'webhook_{datetime.now().strftime("%Y%m%d")}.log',
-    level=logging.DEBUG,
-    format='%(asctime)s [%(levelname)s] %(message)s'
-)
+# Настраиваем логирование: запись в файл идёт в фоновом потоке
+setup_logging("webhook")
 logger = logging.getLogger(__name__)
 
 # Пользователи для Basic Auth вебхука
@@ -43,16 +52,53 @@ LISTMONK_API_KEY = os.getenv("LISTMONK_API_KEY", "your-listmonk-api-key")
 MCRM_API_URL_USER = os.getenv("MCRM_API_URL_USER", "https://localhost")
 MCRM_API_KEY = os.getenv("MCRM_API_KEY", "your-mcrm-api-key")
 
-# Конфиг для PostgreSQL
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_PORT = os.getenv("DB_PORT", "5432")
-DB_NAME = os.getenv("DB_NAME", "webhook_db")
-DB_USER = os.getenv("DB_USER", "webhook_user")
-DB_PASSWORD = os.getenv("DB_PASSWORD", "your_postgres_password")
+# HTTP-клиенты с постоянными сессиями (общие для запросов и retry_queue)
+mcrm_client = McrmClient(user_url=MCRM_API_URL_USER, api_key=MCRM_API_KEY)
+listmonk_client = ListmonkClient(LISTMONK_API_URL, LISTMONK_USERNAME, LISTMONK_API_KEY)
 
-# Интервал повторных попыток (в секундах)
+# Кэш ответов MCRM по очищенному serial; ответы без email кэшируются на короткое время
+MCRM_CACHE_SIZE = int(os.getenv("MCRM_CACHE_SIZE", "10000"))
+MCRM_CACHE_TTL = float(os.getenv("MCRM_CACHE_TTL", "300"))  # секунд
+MCRM_NEGATIVE_CACHE_TTL = float(os.getenv("MCRM_NEGATIVE_CACHE_TTL", "30"))  # секунд
+MCRM_CACHE_SHARED = os.getenv("MCRM_CACHE_SHARED", "false").lower() in ("1", "true", "yes")
+mcrm_cache = ResponseCache("mcrm_user", MCRM_CACHE_SIZE, shared=MCRM_CACHE_SHARED)
+
+# Фильтр недавно обработанных serial (дубликаты отсекаются до запросов к MCRM и listmonk)
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "50000"))
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", "600"))  # секунд
+recent_serials = RecentKeys(DEDUP_CACHE_SIZE, DEDUP_TTL)
+
+# Интервал повторных попыток (в секундах): на это время захваченная запись скрыта от других воркеров
 RETRY_INTERVAL = 300  # 5 минут
 MAX_RETRIES = 3  # Максимум 3 попытки
+RETRY_BATCH_SIZE = int(os.getenv("RETRY_BATCH_SIZE", "20"))  # записей за один захват
+RETRY_POLL_INTERVAL = float(os.getenv("RETRY_POLL_INTERVAL", "60"))  # максимум секунд ожидания без уведомлений
+RETRY_NOTIFY_CHANNEL = "retry_queue"  # канал LISTEN/NOTIFY для пробуждения воркеров
+OUTBOX_NOTIFY_CHANNEL = "subscriber_outbox"  # канал LISTEN/NOTIFY для диспетчера outbox
+
+# Экспоненциальная задержка повтора по классам ошибок: (база, потолок) в секундах
+RETRY_BACKOFF = {
+    "network": (5, 300),          # таймауты и обрывы соединения
+    "upstream_5xx": (15, 900),    # 5xx и 429 от MCRM/listmonk
+    "upstream_4xx": (300, 3600),  # прочие ошибки ответа
+    "not_found": (600, 21600),    # email в MCRM ещё не заполнен
+    "invalid": (3600, 86400),     # некорректные входные данные
+    "internal": (60, 1800),       # ошибки самого приложения
+    "circuit_open": (30, 900),    # выключатель MCRM/listmonk разомкнут, вызов не выполнялся
+    "rate_limited": (10, 600),    # не дождались токена общего лимита запросов
+}
+
+# Режим приёма: событие сохраняется в webhook_events, ответ 202, обработку выполняет worker.py --events
+WEBHOOK_ASYNC_MODE = os.getenv("WEBHOOK_ASYNC_MODE", "false").lower() in ("1", "true", "yes")
+
+# Пакетный приём /webhook/batch: максимум событий в запросе и одновременных обработок
+# (не больше пула соединений, иначе потоки ждут соединение DB_POOL_TIMEOUT)
+WEBHOOK_BATCH_MAX = int(os.getenv("WEBHOOK_BATCH_MAX", "1000"))
+WEBHOOK_BATCH_CONCURRENCY = min(int(os.getenv("WEBHOOK_BATCH_CONCURRENCY", str(DB_POOL_MAX))), DB_POOL_MAX)
+# Синхронно обрабатываются только небольшие пакеты и только WEBHOOK_BATCH_TIME_BUDGET секунд
+# (меньше timeout gunicorn); остальные события уходят в webhook_events для worker.py --events
+WEBHOOK_BATCH_SYNC_MAX = int(os.getenv("WEBHOOK_BATCH_SYNC_MAX", "50"))
+WEBHOOK_BATCH_TIME_BUDGET = float(os.getenv("WEBHOOK_BATCH_TIME_BUDGET", "30"))  # секунд
 
 # Логируем загрузку конфигурации
 logger.info(f"Инициализация приложения: WEBHOOK_USERNAME={WEBHOOK_USERNAME}, LISTMONK_API_URL={LISTMONK_API_URL}, MCRM_API_URL_USER={MCRM_API_URL_USER}, DB_HOST={DB_HOST}, DB_NAME={DB_NAME}")
@@ -60,92 +106,162 @@ logger.info(f"Инициализация приложения: WEBHOOK_USERNAME=
 # Подключение к PostgreSQL и создание таблиц
 def init_db():
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        cursor = conn.cursor()
-        
-        # Создание таблиц для ошибок, очереди повторных попыток и финальной таблицы
-        tables = [
-            """
-            CREATE TABLE IF NOT EXISTS requests_log (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                method VARCHAR(10),
-                path VARCHAR(255),
-                headers TEXT,
-                remote_addr VARCHAR(45),
-                serial VARCHAR(255),
-                event VARCHAR(100),
-                error_message TEXT
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS serial_processing_log (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                original_serial VARCHAR(255),
-                cleaned_serial VARCHAR(255),
-                error_message TEXT
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS mcrm_requests_log (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                url VARCHAR(255),
-                number VARCHAR(255),
-                status_code INTEGER,
-                response TEXT,
-                error_message TEXT
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS listmonk_requests_log (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                url VARCHAR(255),
-                payload TEXT,
-                status_code INTEGER,
-                response TEXT,
-                error_message TEXT
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS subscribers (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                uuid VARCHAR(36),
-                email VARCHAR(255),
-                phone VARCHAR(20),
-                status BOOLEAN DEFAULT FALSE
-            )
-            """,
-            """
-            CREATE TABLE IF NOT EXISTS retry_queue (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                serial VARCHAR(255),
-                event VARCHAR(100),
-                payload TEXT,
-                retry_count INTEGER DEFAULT 0,
-                last_attempt TIMESTAMP,
-                error_message TEXT
-            )
-            """
-        ]
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Журналы ошибок секционированы по месяцам (см. log_partitions.py)
+            create_log_tables(cursor)
+            # Общее состояние лимитеров запросов к MCRM и listmonk (см. rate_limiter.py)
+            create_rate_limit_table(cursor)
+
+            # Создание очереди повторных попыток и финальной таблицы
+            tables = [
+                """
+                CREATE TABLE IF NOT EXISTS subscribers (
+                    id SERIAL PRIMARY KEY,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    uuid VARCHAR(36),
+                    email VARCHAR(255),
+                    phone VARCHAR(20),
+                    status BOOLEAN DEFAULT FALSE
+                )
+                """,
+                """
+                ALTER TABLE subscribers ADD COLUMN IF NOT EXISTS serial VARCHAR(255)
+                """,
+                """
+                CREATE UNIQUE INDEX IF NOT EXISTS subscribers_serial_uidx ON subscribers (serial)
+                """,
+                """
+                CREATE TABLE IF NOT EXISTS retry_queue (
+                    id SERIAL PRIMARY KEY,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    serial VARCHAR(255),
+                    event VARCHAR(100),
+                    payload TEXT,
+                    retry_count INTEGER DEFAULT 0,
+                    last_attempt TIMESTAMP,
+                    error_message TEXT
+                )
+                """,
+                """
+                ALTER TABLE retry_queue ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP
+                """,
+                """
+                ALTER TABLE retry_queue ADD COLUMN IF NOT EXISTS error_class VARCHAR(30)
+                """,
+                # Этап конвейера, с которого продолжить, и уже полученные промежуточные результаты
+                """
+                ALTER TABLE retry_queue ADD COLUMN IF NOT EXISTS stage VARCHAR(20)
+                """,
+                """
+                ALTER TABLE retry_queue ADD COLUMN IF NOT EXISTS context JSONB
+                """,
+                # Записи, созданные до появления next_attempt_at; исчерпанные остаются с NULL и переносятся в dead_letters ниже
+                sql.SQL("""
+                UPDATE retry_queue
+                SET next_attempt_at = COALESCE(last_attempt + make_interval(secs => {}), timestamp)
+                WHERE next_attempt_at IS NULL AND retry_count < {}
+                """).format(sql.Literal(RETRY_INTERVAL), sql.Literal(MAX_RETRIES)),
+                """
+                CREATE INDEX IF NOT EXISTS retry_queue_pending_idx
+                ON retry_queue (next_attempt_at) WHERE next_attempt_at IS NOT NULL
+                """,
+                # Записи, исчерпавшие MAX_RETRIES; повторно запускаются через replay_dead_letters.py
+                """
+                CREATE TABLE IF NOT EXISTS dead_letters (
+                    id BIGSERIAL PRIMARY KEY,
+                    retry_id INTEGER,
+                    timestamp TIMESTAMP,
+                    dead_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    serial VARCHAR(255),
+                    event VARCHAR(100),
+                    payload TEXT,
+                    stage VARCHAR(20),
+                    context JSONB,
+                    error_class VARCHAR(30),
+                    error_message TEXT,
+                    retry_count INTEGER
+                )
+                """,
+                """
+                CREATE INDEX IF NOT EXISTS dead_letters_dead_at_idx ON dead_letters (dead_at)
+                """,
+                """
+                CREATE INDEX IF NOT EXISTS dead_letters_serial_idx ON dead_letters (serial)
+                """,
+                # Исчерпанные записи, оставшиеся в retry_queue с прошлых версий
+                """
+                WITH moved AS (
+                    DELETE FROM retry_queue WHERE next_attempt_at IS NULL
+                    RETURNING id, timestamp, serial, event, payload, stage, context, error_class, error_message, retry_count
+                )
+                INSERT INTO dead_letters (retry_id, timestamp, serial, event, payload, stage, context, error_class, error_message, retry_count)
+                SELECT id, timestamp, serial, event, payload, stage, context, error_class, error_message, retry_count FROM moved
+                """,
+                # Исходящие запросы к listmonk: пишутся в одной транзакции с subscribers,
+                # доставляются диспетчером (outbox.py); serial - ключ идемпотентности
+                """
+                CREATE TABLE IF NOT EXISTS subscriber_outbox (
+                    id BIGSERIAL PRIMARY KEY,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    serial VARCHAR(255) NOT NULL UNIQUE,
+                    payload JSONB NOT NULL,
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    error_class VARCHAR(30),
+                    error_message TEXT
+                )
+                """,
+                """
+                CREATE INDEX IF NOT EXISTS subscriber_outbox_next_attempt_idx ON subscriber_outbox (next_attempt_at)
+                """,
+                """
+                CREATE TABLE IF NOT EXISTS webhook_events (
+                    id BIGSERIAL PRIMARY KEY,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    serial VARCHAR(255),
+                    event VARCHAR(100),
+                    username VARCHAR(255),
+                    status VARCHAR(20) DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    locked_until TIMESTAMP,
+                    processed_at TIMESTAMP,
+                    result_code INTEGER,
+                    error_message TEXT
+                )
+                """,
+                """
+                CREATE INDEX IF NOT EXISTS webhook_events_pending_idx
+                ON webhook_events (id) WHERE status IN ('pending', 'processing')
+                """,
+                """
+                CREATE UNLOGGED TABLE IF NOT EXISTS http_cache (
+                    cache_name VARCHAR(50),
+                    key VARCHAR(255),
+                    status_code INTEGER,
+                    response TEXT,
+                    negative BOOLEAN DEFAULT FALSE,
+                    expires_at TIMESTAMP,
+                    PRIMARY KEY (cache_name, key)
+                )
+                """
+            ]
         
-        for table_query in tables:
-            cursor.execute(table_query)
+            for table_query in tables:
+                cursor.execute(table_query)
+
+            # Уникальность email включаем, только если в накопленных данных нет дубликатов
+            cursor.execute("SAVEPOINT subscribers_email_uidx")
+            try:
+                cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS subscribers_email_uidx ON subscribers (lower(email))")
+            except Exception as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT subscribers_email_uidx")
+                logger.warning(f"Уникальный индекс по email не создан, в subscribers есть дубликаты: {e}")
         
-        conn.commit()
-        logger.info("Все таблицы базы данных успешно инициализированы")
-        cursor.close()
-        conn.close()
+            conn.commit()
+            logger.info("Все таблицы базы данных успешно инициализированы")
+            cursor.close()
     except Exception as e:
         logger.error(f"Ошибка инициализации базы данных: {e}")
         sys.exit(1)
@@ -173,300 +289,590 @@ def log_network_interfaces(port=5002):
         logger.error(f"Ошибка привязки к порту {port}: {e}")
         raise
 
-# Функция для записи ошибок в базу данных
+# Функция для записи ошибок в базу данных (через буфер, запись пачками в фоне)
 def log_error_to_db(table, data):
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
+    if audit_log.write(table, data):
+        logger.debug("Ошибка поставлена в очередь записи в таблицу %s", table)
+
+# Очистка serial: обрезаем до дефиса; результат служит ключом идемпотентности
+@timed("clean_serial")
+def clean_serial(serial):
+    return serial.split('-')[0] if '-' in serial else serial
+
+# Проверка, обработан ли уже serial (поиск по уникальному индексу)
+@timed("db_dedup_check")
+def subscriber_exists(cleaned_serial):
+    with get_connection() as conn:
         cursor = conn.cursor()
+        cursor.execute(sql.SQL("SELECT 1 FROM subscribers WHERE serial = %s"), (cleaned_serial,))
+        exists = cursor.fetchone() is not None
+        conn.commit()
+        cursor.close()
+    return exists
+
+# Подписчик и задание на его создание в listmonk фиксируются одним запросом (transactional outbox).
+# Задание появляется, только если serial ещё не было в subscribers; uuid заполнит диспетчер
+@timed("db_subscriber")
+def save_subscriber_intent(email, phone, serial, listmonk_payload):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql.SQL("""
+                WITH subscriber AS (
+                    INSERT INTO subscribers (email, phone, status, serial)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT DO NOTHING
+                    RETURNING serial
+                )
+                INSERT INTO subscriber_outbox (serial, payload)
+                SELECT serial, %s FROM subscriber
+                ON CONFLICT (serial) DO NOTHING
+                RETURNING id
+            """), (email, phone, False, serial, Json(listmonk_payload)))
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute("SELECT pg_notify(%s, %s)", (OUTBOX_NOTIFY_CHANNEL, str(row[0])))
+            conn.commit()
+            cursor.close()
+        if row is not None:
+            logger.debug("Подписчик записан, задание для listmonk в outbox: id=%s, serial=%s, email=%s", row[0], serial, email)
+        else:
+            logger.info(f"Подписчик уже есть в таблице subscribers: email={email}, serial={serial}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка записи подписчика и outbox: {e}")
+        return False
+
+# Класс ошибки по коду ответа внешнего API
+def classify_status(status_code):
+    if status_code is None or status_code == 429 or status_code >= 500:
+        return "upstream_5xx"
+    return "upstream_4xx"
+
+# Задержка перед попыткой номер attempt (с нуля): экспонента с джиттером в пределах [d/2, d]
+def retry_delay(error_class, attempt):
+    base, cap = RETRY_BACKOFF.get(error_class, RETRY_BACKOFF["internal"])
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+# Класс ошибки запроса: при разомкнутом выключателе или исчерпанном лимите вызов не выполнялся
+def request_error_class(e):
+    if isinstance(e, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(e, RateLimitExceeded):
+        return "rate_limited"
+    return "network"
+
+# Функция для записи в очередь повторных попыток.
+# stage - этап, с которого продолжить (mcrm, listmonk), context - уже полученные данные
+@timed("db_retry_queue")
+def add_to_retry_queue(serial, event, error_message, error_class="internal", stage="mcrm", context=None):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
         
-        if table == "requests_log":
-            query = sql.SQL("""
-                INSERT INTO requests_log (method, path, headers, remote_addr, serial, event, error_message)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """)
-            cursor.execute(query, (
-                data['method'],
-                data['path'],
-                data['headers'],
-                data['remote_addr'],
-                data['serial'],
-                data['event'],
-                data['error_message']
-            ))
-        elif table == "serial_processing_log":
-            query = sql.SQL("""
-                INSERT INTO serial_processing_log (original_serial, cleaned_serial, error_message)
-                VALUES (%s, %s, %s)
-            """)
-            cursor.execute(query, (
-                data['original_serial'],
-                data['cleaned_serial'],
-                data['error_message']
-            ))
-        elif table == "mcrm_requests_log":
-            query = sql.SQL("""
-                INSERT INTO mcrm_requests_log (url, number, status_code, response, error_message)
-                VALUES (%s, %s, %s, %s, %s)
-            """)
-            cursor.execute(query, (
-                data['url'],
-                data['number'],
-                data['status_code'],
-                data['response'],
-                data['error_message']
-            ))
-        elif table == "listmonk_requests_log":
             query = sql.SQL("""
-                INSERT INTO listmonk_requests_log (url, payload, status_code, response, error_message)
-                VALUES (%s, %s, %s, %s, %s)
+                INSERT INTO retry_queue (serial, event, error_message, error_class, stage, context, next_attempt_at)
+                VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+                RETURNING id
             """)
-            cursor.execute(query, (
-                data['url'],
-                data['payload'],
-                data['status_code'],
-                data['response'],
-                data['error_message']
-            ))
+            delay = retry_delay(error_class, 0)
+            cursor.execute(query, (serial, event, error_message, error_class, stage, Json(context or {}), delay))
+            # Уведомление доставляется воркерам в момент commit
+            cursor.execute("SELECT pg_notify(%s, %s)", (RETRY_NOTIFY_CHANNEL, str(cursor.fetchone()[0])))
         
-        conn.commit()
-        logger.debug(f"Ошибка записана в таблицу {table}")
-        cursor.close()
-        conn.close()
+            conn.commit()
+            logger.debug("Добавлена запись в retry_queue: serial=%s, event=%s, stage=%s, error_class=%s, delay=%.0fs", serial, event, stage, error_class, delay)
+            cursor.close()
     except Exception as e:
-        logger.error(f"Ошибка записи в таблицу {table}: {e}")
+        logger.error(f"Ошибка записи в retry_queue: {e}")
+
+# Запрос клиента в MCRM с кэшированием по очищенному serial
+@timed("mcrm")
+def get_mcrm_user(cleaned_serial):
+    cached = mcrm_cache.get(cleaned_serial)
+    if cached is not None:
+        logger.debug("Ответ MCRM взят из кэша: number=%s", cleaned_serial)
+        return cached
 
-# Функция для записи в таблицу subscribers
-def log_subscriber_to_db(uuid, email, phone):
+    mcrm_response = mcrm_client.get_user(cleaned_serial)
+    if mcrm_response.status_code == 200:
+        try:
+            has_email = bool(mcrm_response.json().get('email'))
+        except ValueError:
+            return mcrm_response
+        if has_email:
+            mcrm_cache.set(cleaned_serial, mcrm_response, MCRM_CACHE_TTL)
+        else:
+            mcrm_cache.set(cleaned_serial, mcrm_response, MCRM_NEGATIVE_CACHE_TTL, negative=True)
+    return mcrm_response
+
+# Формирование payload для listmonk из ответа MCRM
+def build_listmonk_payload(mcrm_data):
+    # Собираем имя из first_name и last_name; listmonk не принимает пустое имя
+    name = f"{mcrm_data.get('first_name', '')} {mcrm_data.get('last_name', '')}".strip() or 'Unknown'
+
+    # Формируем attribs из ответа MCRM
+    attribs = {
+        "phone": mcrm_data.get('phone', ''),
+        "birth_date": mcrm_data.get('birth_date', ''),
+        "gender": mcrm_data.get('gender', ''),
+        "card_number": mcrm_data.get('card_number', ''),
+        "balance": mcrm_data.get('balance', 0),
+        "check_count": mcrm_data.get('check_count', 0),
+        "average_check": mcrm_data.get('average_check', 0),
+        "register_date": mcrm_data.get('register_date', ''),
+        "last_visit_date": mcrm_data.get('last_visit_date', ''),
+        "resto_id": mcrm_data.get('resto_id', 0),
+        "osmi_setup": mcrm_data.get('osmi_setup', False)
+    }
+    if mcrm_data.get('segments'):
+        attribs['segments'] = [segment['name'] for segment in mcrm_data.get('segments', [])]
+
+    return {
+        "email": mcrm_data['email'],
+        "name": name,
+        "status": "enabled",
+        "lists": [1],
+        "attribs": attribs
+    }
+
+# Сохранение события в webhook_events для обработки фоновыми воркерами
+@timed("db_event")
+def enqueue_event(serial, event, user):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql.SQL("""
+                INSERT INTO webhook_events (serial, event, username)
+                VALUES (%s, %s, %s)
+                RETURNING id
+            """), (serial, event, user))
+            event_id = cursor.fetchone()[0]
+            conn.commit()
+            cursor.close()
+        logger.info(f"Событие принято в очередь: id={event_id}, serial={serial}, event={event}")
+        return event_id
+    except Exception as e:
+        logger.error(f"Ошибка записи в webhook_events, событие будет обработано синхронно: {e}")
+        return None
+
+# Пакетное сохранение событий одним INSERT; id возвращаются в порядке items
+@timed("db_event")
+def enqueue_events(items, user):
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            rows = execute_values(
+                cursor,
+                "INSERT INTO webhook_events (serial, event, username) VALUES %s RETURNING id",
+                [(serial, event, user) for serial, event in items],
+                fetch=True
+            )
+            conn.commit()
+            cursor.close()
+        logger.info(f"Пакет событий принят в очередь: {len(rows)}")
+        return [row[0] for row in rows]
+    except Exception as e:
+        logger.error(f"Ошибка записи пакета в webhook_events, события будут обработаны синхронно: {e}")
+        return None
+
+# Постановка позиций пакета в webhook_events: принятые получают 202, возвращаются не принятые
+def enqueue_batch_items(items, results, user):
+    event_ids = enqueue_events([(serial, event) for _, serial, event in items], user)
+    if event_ids is None:
+        return items
+    for (index, _, _), event_id in zip(items, event_ids):
+        results[index] = ({"status": "accepted", "id": event_id}, 202)
+    return []
+
+# Позиции, не успевшие начаться за WEBHOOK_BATCH_TIME_BUDGET: в очередь, при ошибке очереди - 503
+def defer_batch_items(items, results, user):
+    logger.warning(f"Время обработки пакета истекло, событий в очередь: {len(items)}")
+    for index, _, _ in enqueue_batch_items(items, results, user):
+        results[index] = ({"error": "Время обработки пакета истекло, повторите позже"}, 503)
+
+# Фиксация неудачной попытки и планирование следующей; после MAX_RETRIES запись переносится в dead_letters
+def schedule_retry(retry_id, retry_count, error_message, error_class, stage=None, context=None):
+    if retry_count >= MAX_RETRIES:
+        logger.warning(f"Исчерпаны попытки для записи retry_queue, перенос в dead_letters: id={retry_id}, error={error_message}")
+        move_to_dead_letters(retry_id, error_message, error_class, stage, context)
+        return
+    delay = retry_delay(error_class, retry_count)
+    with get_connection() as conn:
         cursor = conn.cursor()
-        
-        query = sql.SQL("""
-            INSERT INTO subscribers (uuid, email, phone, status)
-            VALUES (%s, %s, %s, %s)
-        """)
-        cursor.execute(query, (uuid, email, phone, False))
-        
+        cursor.execute(sql.SQL("""
+            UPDATE retry_queue
+            SET error_message = %s, error_class = %s,
+                next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                stage = COALESCE(%s, stage), context = COALESCE(%s, context)
+            WHERE id = %s
+        """), (error_message, error_class, delay, stage, Json(context) if context is not None else None, retry_id))
+        cursor.execute("SELECT pg_notify(%s, %s)", (RETRY_NOTIFY_CHANNEL, str(retry_id)))
         conn.commit()
-        logger.debug(f"Запись добавлена в таблицу subscribers: uuid={uuid}, email={email}, phone={phone}")
         cursor.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Ошибка записи в таблицу subscribers: {e}")
 
-# Функция для записи в очередь повторных попыток
-def add_to_retry_queue(serial, event, payload, error_message):
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
+# Перенос исчерпанной записи в dead_letters с последней ошибкой и этапом (одним запросом)
+def move_to_dead_letters(retry_id, error_message, error_class, stage=None, context=None):
+    with get_connection() as conn:
         cursor = conn.cursor()
-        
-        query = sql.SQL("""
-            INSERT INTO retry_queue (serial, event, payload, error_message)
-            VALUES (%s, %s, %s, %s)
-        """)
-        cursor.execute(query, (serial, event, json.dumps(payload) if payload else None, error_message))
-        
+        cursor.execute(sql.SQL("""
+            WITH moved AS (
+                DELETE FROM retry_queue WHERE id = %s
+                RETURNING id, timestamp, serial, event, payload, stage, context, retry_count
+            )
+            INSERT INTO dead_letters (retry_id, timestamp, serial, event, payload, stage, context, error_class, error_message, retry_count)
+            SELECT id, timestamp, serial, event, payload, COALESCE(%s, stage), COALESCE(%s, context), %s, %s, retry_count
+            FROM moved
+        """), (retry_id, stage, Json(context) if context is not None else None, error_class, error_message))
         conn.commit()
-        logger.debug(f"Добавлена запись в retry_queue: serial={serial}, event={event}")
         cursor.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Ошибка записи в retry_queue: {e}")
 
-# Функция для обработки записей из retry_queue
-def process_retry_queue():
-    while True:
-        try:
-            conn = psycopg2.connect(
-                host=DB_HOST,
-                port=DB_PORT,
-                database=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD
+# Удаление обработанной записи из retry_queue
+def delete_retry(retry_id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("DELETE FROM retry_queue WHERE id = %s"), (retry_id,))
+        conn.commit()
+        cursor.close()
+
+# Захват пачки записей retry_queue, у которых подошло next_attempt_at (поиск по частичному индексу).
+# SKIP LOCKED не даёт двум воркерам взять одну запись, а сдвинутый next_attempt_at
+# скрывает её от остальных на RETRY_INTERVAL, если воркер упадёт во время обработки
+def claim_retry_batch(batch_size=None):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("""
+            UPDATE retry_queue
+            SET retry_count = retry_count + 1, last_attempt = CURRENT_TIMESTAMP,
+                next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE id IN (
+                SELECT id FROM retry_queue
+                WHERE next_attempt_at <= CURRENT_TIMESTAMP
+                ORDER BY next_attempt_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
             )
-            cursor = conn.cursor()
-            
-            # Извлекаем записи, где last_attempt старше RETRY_INTERVAL или NULL, и retry_count < MAX_RETRIES
-            query = sql.SQL("""
-                SELECT id, serial, event, payload, retry_count
-                FROM retry_queue
-                WHERE (last_attempt IS NULL OR last_attempt < %s) AND retry_count < %s
-            """)
-            cursor.execute(query, (datetime.now() - timedelta(seconds=RETRY_INTERVAL), MAX_RETRIES))
-            rows = cursor.fetchall()
-            
-            for row in rows:
-                retry_id, serial, event, payload, retry_count = row
-                logger.info(f"Повторная обработка записи из retry_queue: id={retry_id}, serial={serial}, retry_count={retry_count}")
-                
+            RETURNING id, serial, event, payload, retry_count, stage, context
+        """), (RETRY_INTERVAL, batch_size or RETRY_BATCH_SIZE))
+        rows = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+    return rows
+
+# Через сколько секунд подойдёт ближайшая попытка (None, если очередь пуста)
+def seconds_until_next_retry():
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("""
+            SELECT EXTRACT(EPOCH FROM MIN(next_attempt_at) - CURRENT_TIMESTAMP)
+            FROM retry_queue
+            WHERE next_attempt_at IS NOT NULL
+        """))
+        seconds = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+    return float(seconds) if seconds is not None else None
+
+# Ожидание NOTIFY о новых записях retry_queue на выделенном соединении (LISTEN живёт, пока открыта сессия)
+class RetryListener:
+    def __init__(self, channel=RETRY_NOTIFY_CHANNEL):
+        self.channel = channel
+        self.conn = None
+
+    def _connect(self):
+        conn = create_connection()
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+        cursor.close()
+        self.conn = conn
+
+    # Возвращает True, если пришло уведомление, и False по таймауту или остановке
+    def wait(self, timeout, stop):
+        deadline = time.monotonic() + timeout
+        try:
+            if self.conn is None or self.conn.closed:
+                self._connect()
+            while not stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                # Короткие интервалы select, чтобы вовремя заметить остановку
+                if select.select([self.conn], [], [], min(1, remaining)) != ([], [], []):
+                    self.conn.poll()
+                    if self.conn.notifies:
+                        self.conn.notifies.clear()
+                        return True
+        except Exception as e:
+            logger.error(f"Ошибка ожидания уведомлений {self.channel}: {e}")
+            self.close()
+            stop.wait(max(0, deadline - time.monotonic()))
+        return False
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+# Повторная обработка одной записи из retry_queue: продолжаем с этапа, на котором произошёл сбой
+def process_retry_item(retry_id, serial, event, payload, retry_count, stage=None, context=None):
+    if event != "cardcreate":
+        logger.warning(f"Неподдерживаемое событие в retry_queue: id={retry_id}, event={event}")
+        return
+
+    # Записи, созданные до появления stage, хранили только payload для listmonk
+    context = context or {}
+    if stage is None:
+        if payload:
+            stage, context = "listmonk", {"listmonk_payload": json.loads(payload)}
+        else:
+            stage = "mcrm"
+
+    cleaned_serial = clean_serial(serial)
+    if not cleaned_serial:
+        logger.error(f"Пустой serial после очистки в retry_queue: id={retry_id}")
+        schedule_retry(retry_id, retry_count, "Пустой serial после очистки", "invalid")
+        return
+
+    if subscriber_exists(cleaned_serial):
+        logger.info(f"Serial уже обработан, запись удалена из retry_queue: id={retry_id}, serial={cleaned_serial}")
+        delete_retry(retry_id)
+        return
+
+    if stage == "mcrm":
+        # Запрос к MCRM
+        logger.info(f"Повторный запрос к MCRM: number={cleaned_serial}")
+        try:
+            mcrm_response = get_mcrm_user(cleaned_serial)
+        except (requests.RequestException, CircuitOpenError, RateLimitExceeded) as e:
+            logger.error(f"Ошибка повторного запроса MCRM: id={retry_id}, error={e}")
+            schedule_retry(retry_id, retry_count, f"MCRM API request error: {str(e)}", request_error_class(e))
+            return
+
+        if mcrm_response.status_code != 200:
+            logger.error(f"Ошибка повторного запроса MCRM: id={retry_id}, status_code={mcrm_response.status_code}")
+            log_error_to_db("mcrm_requests_log", {
+                "url": MCRM_API_URL_USER,
+                "number": cleaned_serial,
+                "status_code": mcrm_response.status_code,
+                "response": mcrm_response.text,
+                "error_message": f"MCRM API error: {mcrm_response.status_code}"
+            })
+            schedule_retry(retry_id, retry_count, f"MCRM API error: {mcrm_response.status_code}", classify_status(mcrm_response.status_code))
+            return
+
+        mcrm_data = mcrm_response.json()
+        if not mcrm_data.get('email'):
+            logger.error(f"Email не найден в MCRM: id={retry_id}")
+            log_error_to_db("mcrm_requests_log", {
+                "url": MCRM_API_URL_USER,
+                "number": cleaned_serial,
+                "status_code": mcrm_response.status_code,
+                "response": mcrm_response.text,
+                "error_message": "Email не найден"
+            })
+            schedule_retry(retry_id, retry_count, "Email не найден", "not_found")
+            return
+
+        stage, context = "listmonk", {"listmonk_payload": build_listmonk_payload(mcrm_data)}
+
+    if stage != "listmonk":
+        logger.error(f"Неизвестный этап в retry_queue: id={retry_id}, stage={stage}")
+        schedule_retry(retry_id, retry_count, f"Неизвестный этап: {stage}", "invalid", stage, context)
+        return
+
+    # Подписчик и задание для listmonk с payload, сохранённым на предыдущей попытке
+    payload_dict = context["listmonk_payload"]
+    if not save_subscriber_intent(payload_dict['email'], payload_dict.get('attribs', {}).get('phone', ''),
+                                  cleaned_serial, payload_dict):
+        schedule_retry(retry_id, retry_count, "Ошибка записи в таблицу subscribers", "internal", stage, context)
+        return
+    logger.info(f"Успешная повторная обработка, подписчик передан в outbox: id={retry_id}")
+
+    delete_retry(retry_id)
+    logger.debug(f"Запись удалена из retry_queue: id={retry_id}")
+
+# Потребитель retry_queue; можно запускать в нескольких потоках и процессах одновременно
+def process_retry_queue(stop=None):
+    stop = stop or threading.Event()
+    listener = RetryListener()
+    while not stop.is_set():
+        try:
+            rows = claim_retry_batch()
+        except Exception as e:
+            logger.error(f"Ошибка обработки retry_queue: {e}")
+            rows = []
+
+        for retry_id, serial, event, payload, retry_count, stage, context in rows:
+            logger.info(f"Повторная обработка записи из retry_queue: id={retry_id}, serial={serial}, stage={stage}, retry_count={retry_count}")
+            try:
+                process_retry_item(retry_id, serial, event, payload, retry_count, stage, context)
+            except Exception as e:
+                logger.error(f"Ошибка повторной обработки: id={retry_id}, error={e}")
+                error_class = request_error_class(e) if isinstance(e, (requests.RequestException, CircuitOpenError, RateLimitExceeded)) else "internal"
                 try:
-                    # Увеличиваем retry_count и обновляем last_attempt
-                    cursor.execute(
-                        sql.SQL("UPDATE retry_queue SET retry_count = %s, last_attempt = %s WHERE id = %s"),
-                        (retry_count + 1, datetime.now(), retry_id)
-                    )
-                    conn.commit()
-                    
-                    if event == "cardcreate":
-                        cleaned_serial = serial.split('-')[0] if '-' in serial else serial
-                        if not cleaned_serial:
-                            logger.error(f"Пустой serial после очистки в retry_queue: id={retry_id}")
-                            cursor.execute(
-                                sql.SQL("UPDATE retry_queue SET error_message = %s WHERE id = %s"),
-                                ("Пустой serial после очистки", retry_id)
-                            )
-                            conn.commit()
-                            continue
-                        
-                        # Запрос к MCRM
-                        logger.info(f"Повторный запрос к MCRM: number={cleaned_serial}")
-                        mcrm_response = requests.get(
-                            MCRM_API_URL_USER,
-                            params={"number": cleaned_serial, "api_key": MCRM_API_KEY}
-                        )
-                        
-                        if mcrm_response.status_code != 200:
-                            logger.error(f"Ошибка повторного запроса MCRM: id={retry_id}, status_code={mcrm_response.status_code}")
-                            log_error_to_db("mcrm_requests_log", {
-                                "url": MCRM_API_URL_USER,
-                                "number": cleaned_serial,
-                                "status_code": mcrm_response.status_code,
-                                "response": mcrm_response.text,
-                                "error_message": f"MCRM API error: {mcrm_response.status_code}"
-                            })
-                            cursor.execute(
-                                sql.SQL("UPDATE retry_queue SET error_message = %s WHERE id = %s"),
-                                (f"MCRM API error: {mcrm_response.status_code}", retry_id)
-                            )
-                            conn.commit()
-                            continue
-                        
-                        mcrm_data = mcrm_response.json()
-                        if not mcrm_data.get('email'):
-                            logger.error(f"Email не найден в MCRM: id={retry_id}")
-                            log_error_to_db("mcrm_requests_log", {
-                                "url": MCRM_API_URL_USER,
-                                "number": cleaned_serial,
-                                "status_code": mcrm_response.status_code,
-                                "response": mcrm_response.text,
-                                "error_message": "Email не найден"
-                            })
-                            cursor.execute(
-                                sql.SQL("UPDATE retry_queue SET error_message = %s WHERE id = %s"),
-                                ("Email не найден", retry_id)
-                            )
-                            conn.commit()
-                            continue
-                        
-                        email = mcrm_data['email']
-                        phone = mcrm_data.get('phone', '')
-                        
-                        # Используем сохранённый payload или формируем новый
-                        payload_dict = json.loads(payload) if payload else {
-                            "email": email,
-                            "name": f"{mcrm_data.get('first_name', '')} {mcrm_data.get('last_name', '')}".strip() or 'Unknown',
-                            "status": "enabled",
-                            "lists": [1],
-                            "attribs": {
-                                "phone": phone,
-                                "birth_date": mcrm_data.get('birth_date', ''),
-                                "gender": mcrm_data.get('gender', ''),
-                                "card_number": mcrm_data.get('card_number', ''),
-                                "balance": mcrm_data.get('balance', 0),
-                                "check_count": mcrm_data.get('check_count', 0),
-                                "average_check": mcrm_data.get('average_check', 0),
-                                "register_date": mcrm_data.get('register_date', ''),
-                                "last_visit_date": mcrm_data.get('last_visit_date', ''),
-                                "resto_id": mcrm_data.get('resto_id', 0),
-                                "osmi_setup": mcrm_data.get('osmi_setup', False),
-                                "segments": [segment['name'] for segment in mcrm_data.get('segments', [])]
-                            }
-                        }
-                        
-                        # Запрос к listmonk
-                        auth_str = f"{LISTMONK_USERNAME}:{LISTMONK_API_KEY}"
-                        auth_header = {"Authorization": f"Basic {base64.b64encode(auth_str.encode()).decode()}"}
-                        logger.info(f"Повторный запрос к listmonk: id={retry_id}")
-                        listmonk_response = requests.post(
-                            LISTMONK_API_URL,
-                            json=payload_dict,
-                            headers={
-                                **auth_header,
-                                "Content-Type": "application/json"
-                            }
-                        )
-                        
-                        if listmonk_response.status_code not in [200, 201]:
-                            logger.error(f"Ошибка повторного запроса listmonk: id={retry_id}, status_code={listmonk_response.status_code}")
-                            log_error_to_db("listmonk_requests_log", {
-                                "url": LISTMONK_API_URL,
-                                "payload": json.dumps(payload_dict),
-                                "status_code": listmonk_response.status_code,
-                                "response": listmonk_response.text,
-                                "error_message": f"listmonk API error: {listmonk_response.status_code}"
-                            })
-                            cursor.execute(
-                                sql.SQL("UPDATE retry_queue SET error_message = %s WHERE id = %s"),
-                                (f"listmonk API error: {listmonk_response.status_code}", retry_id)
-                            )
-                            conn.commit()
-                            continue
-                        
-                        # Успех, записываем в subscribers и удаляем из retry_queue
-                        listmonk_data = listmonk_response.json()
-                        uuid = listmonk_data.get('data', {}).get('id') or listmonk_data.get('uuid', 'unknown')
-                        log_subscriber_to_db(uuid, email, phone)
-                        logger.info(f"Успешная повторная обработка: id={retry_id}, uuid={uuid}")
-                        
-                        cursor.execute(sql.SQL("DELETE FROM retry_queue WHERE id = %s"), (retry_id,))
-                        conn.commit()
-                        logger.debug(f"Запись удалена из retry_queue: id={retry_id}")
-                
+                    schedule_retry(retry_id, retry_count, str(e), error_class)
                 except Exception as e:
-                    logger.error(f"Ошибка повторной обработки: id={retry_id}, error={e}")
-                    cursor.execute(
-                        sql.SQL("UPDATE retry_queue SET error_message = %s WHERE id = %s"),
-                        (str(e), retry_id)
-                    )
-                    conn.commit()
-            
-            cursor.close()
-            conn.close()
+                    logger.error(f"Ошибка записи в retry_queue: id={retry_id}, error={e}")
+
+        if rows:
+            continue
+
+        # Спим до ближайшего next_attempt_at, NOTIFY о новой записи будит раньше
+        try:
+            next_due = seconds_until_next_retry()
         except Exception as e:
-            logger.error(f"Ошибка обработки retry_queue: {e}")
+            logger.error(f"Ошибка чтения расписания retry_queue: {e}")
+            next_due = None
+        timeout = RETRY_POLL_INTERVAL if next_due is None else min(max(next_due, 0.5), RETRY_POLL_INTERVAL)
+        listener.wait(timeout, stop)
+
+    listener.close()
+
+# Обработка события cardcreate с подавлением дубликатов по очищенному serial
+def process_cardcreate(serial, event, user='anonymous'):
+    cleaned_serial = clean_serial(serial)
+    if not cleaned_serial:
+        return run_cardcreate(serial, event, user)
+
+    claim = recent_serials.claim(cleaned_serial)
+    if claim == RecentKeys.RECENT:
+        logger.info(f"Дубликат события cardcreate отброшен: serial={cleaned_serial}")
+        return {"status": "success", "duplicate": True}, 200
+    if claim == RecentKeys.IN_FLIGHT:
+        # Исход первой доставки ещё неизвестен: отправитель должен повторить позже
+        logger.info(f"Событие cardcreate уже обрабатывается: serial={cleaned_serial}")
+        return {"error": "Событие с этим serial уже обрабатывается, повторите позже"}, 409
+
+    status_code = 500
+    try:
+        try:
+            if subscriber_exists(cleaned_serial):
+                logger.info(f"Serial уже обработан ранее: serial={cleaned_serial}")
+                status_code = 200
+                return {"status": "success", "duplicate": True}, 200
+        except Exception as e:
+            logger.error(f"Ошибка проверки дубликата serial={cleaned_serial}: {e}")
+
+        result, status_code = run_cardcreate(serial, event, user)
+        return result, status_code
+    finally:
+        # Неуспешное событие не должно блокировать повторную доставку
+        recent_serials.finish(cleaned_serial, status_code == 200)
+
+# Конвейер cardcreate: MCRM -> subscribers + subscriber_outbox (listmonk - через диспетчер outbox)
+def run_cardcreate(serial, event, user='anonymous'):
+    try:
+        logger.info("Обработка события cardcreate: serial=%s", serial)
         
-        time.sleep(RETRY_INTERVAL)
+        # Обрезаем serial до дефиса
+        cleaned_serial = clean_serial(serial)
+        logger.debug("Обработан serial: исходный=%s, очищенный=%s", serial, cleaned_serial)
+        if not cleaned_serial:
+            logger.error(f"Ошибка обработки serial: пустой после очистки")
+            log_error_to_db("serial_processing_log", {
+                "original_serial": serial,
+                "cleaned_serial": cleaned_serial,
+                "error_message": "Пустой serial после очистки"
+            })
+            add_to_retry_queue(serial, event, "Пустой serial после очистки", "invalid")
+            return {"error": "Ошибка обработки serial"}, 400
+
+        # Запрос к marketingcrm API
+        logger.info("Отправка запроса к MCRM API: URL=%s, number=%s", MCRM_API_URL_USER, cleaned_serial, extra=SAMPLED)
+        try:
+            mcrm_response = get_mcrm_user(cleaned_serial)
+        except (requests.RequestException, CircuitOpenError, RateLimitExceeded) as e:
+            logger.error(f"Ошибка запроса к MCRM API: {e}")
+            log_error_to_db("mcrm_requests_log", {
+                "url": MCRM_API_URL_USER,
+                "number": cleaned_serial,
+                "status_code": None,
+                "response": None,
+                "error_message": f"MCRM API request error: {str(e)}"
+            })
+            add_to_retry_queue(serial, event, f"MCRM API request error: {str(e)}", request_error_class(e))
+            return {"error": "Ошибка запроса к MCRM API"}, 500
+        
+        logger.info("Ответ от MCRM API: status_code=%s", mcrm_response.status_code, extra=SAMPLED)
+        if mcrm_response.status_code != 200:
+            logger.error(f"Ошибка запроса к MCRM API: status_code={mcrm_response.status_code}, response={mcrm_response.text}")
+            log_error_to_db("mcrm_requests_log", {
+                "url": MCRM_API_URL_USER,
+                "number": cleaned_serial,
+                "status_code": mcrm_response.status_code,
+                "response": mcrm_response.text,
+                "error_message": f"MCRM API error: {mcrm_response.status_code}"
+            })
+            add_to_retry_queue(serial, event, f"MCRM API error: {mcrm_response.status_code}", classify_status(mcrm_response.status_code))
+            return {"error": "Ошибка запроса к MCRM API"}, 500
+
+        mcrm_data = mcrm_response.json()
+        logger.info("Получен ответ от MCRM API: status=%s, user_id=%s, email=%s", mcrm_data.get('status'), mcrm_data.get('user_id'), mcrm_data.get('email'), extra=SAMPLED)
+        
+        if not mcrm_data.get('email'):
+            logger.error(f"Email не найден в ответе MCRM: status={mcrm_data.get('status')}")
+            log_error_to_db("mcrm_requests_log", {
+                "url": MCRM_API_URL_USER,
+                "number": cleaned_serial,
+                "status_code": mcrm_response.status_code,
+                "response": mcrm_response.text,
+                "error_message": "Email не найден"
+            })
+            add_to_retry_queue(serial, event, "Email не найден", "not_found")
+            return {"error": "Email не найден в ответе MCRM"}, 400
+
+        email = mcrm_data['email']
+        phone = mcrm_data.get('phone', '')
+        logger.debug("Извлечён email: %s, phone: %s", email, phone)
+        
+        # Формируем payload для listmonk
+        listmonk_payload = build_listmonk_payload(mcrm_data)
+        logger.debug("Подготовлен payload для listmonk: %s", listmonk_payload, extra=SAMPLED)
+
+        # Подписчик и задание для listmonk - одной локальной транзакцией, отправку выполняет диспетчер outbox
+        if not save_subscriber_intent(email, phone, cleaned_serial, listmonk_payload):
+            add_to_retry_queue(serial, event, "Ошибка записи в таблицу subscribers", "internal", "listmonk",
+                               {"listmonk_payload": listmonk_payload})
+            return {"error": "Ошибка записи в базу данных"}, 500
+
+        logger.info("Событие cardcreate успешно обработано: serial=%s, email=%s, user=%s", serial, email, user)
+    except Exception as e:
+        logger.error(f"Общая ошибка обработки: {e}, serial={serial}, event={event}")
+        add_to_retry_queue(serial, event, f"Общая ошибка: {str(e)}", "internal")
+        return {"error": "Общая ошибка обработки"}, 500
+
+    logger.debug("Запрос успешно обработан, возвращён ответ: status=success")
+    return {"status": "success"}, 200
 
 # Health check эндпоинт
 @app.route('/health', methods=['GET'])
 def health_check():
-    logger.info("Получен запрос на /health")
-    return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()}), 200
+    logger.info("Получен запрос на /health", extra=SAMPLED)
+    return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat(), "db_pool": pool_stats(), "audit_log": audit_log.stats(), "mcrm_cache": mcrm_cache.stats(), "dedup": recent_serials.stats(), "logging": logging_stats(), "circuits": circuit_stats(), "rate_limits": rate_limit_stats()}), 200
+
+# Метрики в формате Prometheus (суммарно по всем воркерам gunicorn)
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    record_pool()
+    body, content_type = render_metrics()
+    return body, 200, {"Content-Type": content_type}
+
+# Ответ /webhook с учётом в метриках
+def respond(result, status_code, started):
+    record_request(started, status_code, result)
+    return jsonify(result), status_code
 
 # Проверка логина и пароля для вебхука
 @auth.verify_password
 def verify_password(username, password):
-    logger.info(f"Проверка авторизации: username={username}")
+    logger.debug("Проверка авторизации: username=%s", username)
     if username in users and users[username] == password:
-        logger.info(f"Авторизация успешна для username={username}")
+        logger.debug("Авторизация успешна для username=%s", username)
         return username
     logger.warning(f"Неудачная авторизация для username={username}")
     return None
@@ -474,6 +880,7 @@ def verify_password(username, password):
 @app.route('/webhook', methods=['GET', 'POST'])
 @auth.login_required(optional=True)
 def webhook():
+    started = time.perf_counter()
     request_data = {
         "method": request.method,
         "path": request.path,
@@ -487,198 +894,152 @@ def webhook():
     if request.method == 'GET':
         serial = request.args.get('serial')
         event = request.args.get('event')
-        logger.info(f"GET запрос: serial={serial}, event={event}")
+        logger.info("GET запрос: serial=%s, event=%s", serial, event)
         if not serial or not event:
             logger.error(f"Отсутствует параметр serial или event: serial={serial}, event={event}")
             request_data.update({"serial": serial, "event": event, "error_message": "Отсутствует параметр serial или event"})
             log_error_to_db("requests_log", request_data)
-            return jsonify({"error": "Отсутствует параметр serial или event"}), 400
+            return respond({"error": "Отсутствует параметр serial или event"}, 400, started)
         if event != "cardcreate":
             logger.error(f"Неподдерживаемое событие: event={event}")
             request_data.update({"serial": serial, "event": event, "error_message": f"Неподдерживаемое событие: {event}"})
             log_error_to_db("requests_log", request_data)
-            return jsonify({"error": "Неподдерживаемое событие"}), 400
+            return respond({"error": "Неподдерживаемое событие"}, 400, started)
         request_data.update({"serial": serial, "event": event})
         data = {"serial": serial, "event": event}
     elif request.method == 'POST':
         serial = request.form.get('serial')
         event = request.form.get('event')
-        logger.info(f"POST запрос: serial={serial}, event={event}")
+        logger.info("POST запрос: serial=%s, event=%s", serial, event)
         if not serial or not event:
             logger.error(f"Отсутствует параметр serial или event: serial={serial}, event={event}")
             request_data.update({"serial": serial, "event": event, "error_message": "Отсутствует параметр serial или event"})
             log_error_to_db("requests_log", request_data)
-            return jsonify({"error": "Отсутствует параметр serial или event"}), 400
+            return respond({"error": "Отсутствует параметр serial или event"}, 400, started)
         if event != "cardcreate":
             logger.error(f"Неподдерживаемое событие: event={event}")
             request_data.update({"serial": serial, "event": event, "error_message": f"Неподдерживаемое событие: {event}"})
             log_error_to_db("requests_log", request_data)
-            return jsonify({"error": "Неподдерживаемое событие"}), 400
+            return respond({"error": "Неподдерживаемое событие"}, 400, started)
         request_data.update({"serial": serial, "event": event})
         data = {"serial": serial, "event": event}
 
     user = auth.current_user() or 'anonymous'
-    logger.info(f"Текущий пользователь: {user}")
+    logger.debug("Текущий пользователь: %s", user)
 
-    try:
-        logger.info(f"Обработка события cardcreate: serial={data['serial']}")
-        
-        # Обрезаем serial до дефиса
-        cleaned_serial = data['serial'].split('-')[0] if '-' in data['serial'] else data['serial']
-        logger.info(f"Обработан serial: исходный={data['serial']}, очищенный={cleaned_serial}")
-        if not cleaned_serial:
-            logger.error(f"Ошибка обработки serial: пустой после очистки")
-            log_error_to_db("serial_processing_log", {
-                "original_serial": data['serial'],
-                "cleaned_serial": cleaned_serial,
-                "error_message": "Пустой serial после очистки"
-            })
-            add_to_retry_queue(data['serial'], data['event'], None, "Пустой serial после очистки")
-            return jsonify({"error": "Ошибка обработки serial"}), 400
+    if WEBHOOK_ASYNC_MODE:
+        event_id = enqueue_event(data['serial'], data['event'], user)
+        if event_id is not None:
+            return respond({"status": "accepted", "id": event_id}, 202, started)
 
-        # Запрос к marketingcrm API
-        logger.info(f"Отправка запроса к MCRM API: URL={MCRM_API_URL_USER}, number={cleaned_serial}")
-        try:
-            mcrm_response = requests.get(
-                MCRM_API_URL_USER,
-                params={
-                    "number": cleaned_serial,
-                    "api_key": MCRM_API_KEY
-                }
-            )
-        except requests.RequestException as e:
-            logger.error(f"Ошибка запроса к MCRM API: {e}")
-            log_error_to_db("mcrm_requests_log", {
-                "url": MCRM_API_URL_USER,
-                "number": cleaned_serial,
-                "status_code": None,
-                "response": None,
-                "error_message": f"MCRM API request error: {str(e)}"
-            })
-            add_to_retry_queue(data['serial'], data['event'], None, f"MCRM API request error: {str(e)}")
-            return jsonify({"error": "Ошибка запроса к MCRM API"}), 500
-        
-        logger.info(f"Ответ от MCRM API: status_code={mcrm_response.status_code}")
-        if mcrm_response.status_code != 200:
-            logger.error(f"Ошибка запроса к MCRM API: status_code={mcrm_response.status_code}, response={mcrm_response.text}")
-            log_error_to_db("mcrm_requests_log", {
-                "url": MCRM_API_URL_USER,
-                "number": cleaned_serial,
-                "status_code": mcrm_response.status_code,
-                "response": mcrm_response.text,
-                "error_message": f"MCRM API error: {mcrm_response.status_code}"
-            })
-            add_to_retry_queue(data['serial'], data['event'], None, f"MCRM API error: {mcrm_response.status_code}")
-            return jsonify({"error": "Ошибка запроса к MCRM API"}), 500
+    result, status_code = process_cardcreate(data['serial'], data['event'], user)
+    return respond(result, status_code, started)
 
-        mcrm_data = mcrm_response.json()
-        logger.info(f"Получен ответ от MCRM API: status={mcrm_data.get('status')}, user_id={mcrm_data.get('user_id')}, email={mcrm_data.get('email')}")
-        
-        if not mcrm_data.get('email'):
-            logger.error(f"Email не найден в ответе MCRM: status={mcrm_data.get('status')}")
-            log_error_to_db("mcrm_requests_log", {
-                "url": MCRM_API_URL_USER,
-                "number": cleaned_serial,
-                "status_code": mcrm_response.status_code,
-                "response": mcrm_response.text,
-                "error_message": "Email не найден"
-            })
-            add_to_retry_queue(data['serial'], data['event'], None, "Email не найден")
-            return jsonify({"error": "Email не найден в ответе MCRM"}), 400
+# Проверка пакета за один проход: ошибочные позиции получают 400, повторы очищенного serial
+# внутри пакета запоминаются как (позиция, первая позиция) и получают её итоговый результат.
+# Возвращает уникальные события, заготовку результатов и повторы
+def validate_batch(events, request_data):
+    results = [None] * len(events)
+    unique = []
+    duplicates = []
+    seen = {}
+    for index, item in enumerate(events):
+        serial = item.get('serial') if isinstance(item, dict) else None
+        event = item.get('event') if isinstance(item, dict) else None
+        if not serial or not event:
+            error, log_message = "Отсутствует параметр serial или event", "Отсутствует параметр serial или event"
+        elif event != "cardcreate":
+            error, log_message = "Неподдерживаемое событие", f"Неподдерживаемое событие: {event}"
+        else:
+            serial = str(serial)
+            cleaned_serial = clean_serial(serial)
+            if cleaned_serial and cleaned_serial in seen:
+                duplicates.append((index, seen[cleaned_serial]))
+            else:
+                seen[cleaned_serial] = index
+                unique.append((index, serial, event))
+            continue
+        log_error_to_db("requests_log", {**request_data, "serial": serial, "event": event, "error_message": log_message})
+        results[index] = ({"error": error}, 400)
+    if len(unique) < len(events):
+        logger.info(f"Пакет: событий={len(events)}, уникальных валидных={len(unique)}")
+    return unique, results, duplicates
 
-        email = mcrm_data['email']
-        phone = mcrm_data.get('phone', '')
-        logger.info(f"Извлечён email: {email}, phone: {phone}")
-        
-        # Собираем имя из first_name и last_name
-        first_name = mcrm_data.get('first_name', '')
-        last_name = mcrm_data.get('last_name', '')
-        name = f"{first_name} {last_name}".strip()
-        logger.info(f"Сформировано имя: first_name={first_name}, last_name={last_name}, name={name}")
-
-        # Формируем attribs из ответа MCRM
-        attribs = {
-            "phone": phone,
-            "birth_date": mcrm_data.get('birth_date', ''),
-            "gender": mcrm_data.get('gender', ''),
-            "card_number": mcrm_data.get('card_number', ''),
-            "balance": mcrm_data.get('balance', 0),
-            "check_count": mcrm_data.get('check_count', 0),
-            "average_check": mcrm_data.get('average_check', 0),
-            "register_date": mcrm_data.get('register_date', ''),
-            "last_visit_date": mcrm_data.get('last訪_date', ''),
-            "resto_id": mcrm_data.get('resto_id', 0),
-            "osmi_setup": mcrm_data.get('osmi_setup', False)
-        }
-        if mcrm_data.get('segments'):
-            attribs['segments'] = [segment['name'] for segment in mcrm_data.get('segments', [])]
-        logger.info(f"Сформированы attribs для listmonk: {attribs}")
+# Повтор внутри пакета получает результат и код первой позиции, когда она обработана:
+# успех повтора без успеха оригинала потерял бы событие
+def fill_duplicates(results, duplicates):
+    for index, first in duplicates:
+        result, status_code = results[first]
+        results[index] = ({**result, "duplicate": True, "duplicate_of": first}, status_code)
 
-        # Формируем payload для listmonk
-        listmonk_payload = {
-            "email": email,
-            "name": name,
-            "status": "enabled",
-            "lists": [1],
-            "attribs": attribs
-        }
-        logger.info(f"Подготовлен payload для listmonk: {listmonk_payload}")
-
-        # Формируем Basic Auth заголовок для listmonk
-        auth_str = f"{LISTMONK_USERNAME}:{LISTMONK_API_KEY}"
-        auth_header = {"Authorization": f"Basic {base64.b64encode(auth_str.encode()).decode()}"}
-        logger.info(f"Подготовлен заголовок авторизации для listmonk")
-
-        # Отправляем в listmonk
-        logger.info(f"Отправка запроса к listmonk API: URL={LISTMONK_API_URL}")
-        try:
-            listmonk_response = requests.post(
-                LISTMONK_API_URL,
-                json=listmonk_payload,
-                headers={
-                    **auth_header,
-                    "Content-Type": "application/json"
-                }
-            )
-        except requests.RequestException as e:
-            logger.error(f"Ошибка запроса к listmonk API: {e}")
-            log_error_to_db("listmonk_requests_log", {
-                "url": LISTMONK_API_URL,
-                "payload": json.dumps(listmonk_payload),
-                "status_code": None,
-                "response": None,
-                "error_message": f"listmonk API request error: {str(e)}"
-            })
-            add_to_retry_queue(data['serial'], data['event'], listmonk_payload, f"listmonk API request error: {str(e)}")
-            return jsonify({"error": "Ошибка запроса к listmonk API"}), 500
-
-        logger.info(f"Ответ от listmonk API: status_code={listmonk_response.status_code}")
-        if listmonk_response.status_code not in [200, 201]:
-            logger.error(f"Ошибка запроса к listmonk API: status_code={listmonk_response.status_code}, response={listmonk_response.text}")
-            log_error_to_db("listmonk_requests_log", {
-                "url": LISTMONK_API_URL,
-                "payload": json.dumps(listmonk_payload),
-                "status_code": listmonk_response.status_code,
-                "response": listmonk_response.text,
-                "error_message": f"listmonk API error: {listmonk_response.status_code}"
-            })
-            add_to_retry_queue(data['serial'], data['event'], listmonk_payload, f"listmonk API error: {listmonk_response.status_code}")
-            return jsonify({"error": "Ошибка запроса к listmonk API"}), 500
-
-        # Успех, записываем в subscribers
-        listmonk_data = listmonk_response.json()
-        uuid = listmonk_data.get('data', {}).get('id') or listmonk_data.get('uuid', 'unknown')
-        logger.info(f"Извлечён UUID из listmonk: {uuid}")
-        log_subscriber_to_db(uuid, email, phone)
-        
-        logger.info(f"Событие cardcreate успешно обработано: serial={data['serial']}, email={email}, user={user}, uuid={uuid}")
-    except Exception as e:
-        logger.error(f"Общая ошибка обработки: {e}, data: {data}")
-        add_to_retry_queue(data['serial'], data['event'], None, f"Общая ошибка: {str(e)}")
-        return jsonify({"error": "Общая ошибка обработки"}), 500
+# Ответ пакета: результат по каждой позиции и сводка
+def batch_response(events, results, started):
+    items = []
+    for index, (result, status_code) in enumerate(results):
+        serial = events[index].get('serial') if isinstance(events[index], dict) else None
+        items.append({"index": index, "serial": serial, "code": status_code, **result})
+    record_batch(started, items)
+    summary = Counter(request_outcome(item["code"], item) for item in items)
+    return {"results": items, "summary": {"total": len(items), **summary}}
+
+# Разбор тела пакета: JSON-массив событий или {"events": [...]}
+def parse_batch_body(body):
+    events = body.get('events') if isinstance(body, dict) else body
+    if not isinstance(events, list) or not events:
+        return None, "Ожидается JSON-массив событий"
+    if len(events) > WEBHOOK_BATCH_MAX:
+        return None, f"Слишком много событий в пакете: {len(events)}, максимум {WEBHOOK_BATCH_MAX}"
+    return events, None
+
+@app.route('/webhook/batch', methods=['POST'])
+@auth.login_required(optional=True)
+def webhook_batch():
+    started = time.perf_counter()
+    request_data = {
+        "method": request.method,
+        "path": request.path,
+        "headers": str(request.headers),
+        "remote_addr": request.remote_addr,
+        "serial": None,
+        "event": None,
+        "error_message": None
+    }
+
+    events, error = parse_batch_body(request.get_json(silent=True))
+    if error:
+        logger.error(f"Некорректный пакет событий: {error}")
+        log_error_to_db("requests_log", {**request_data, "error_message": error})
+        return respond({"error": error}, 400, started)
+
+    user = auth.current_user() or 'anonymous'
+    logger.info(f"Пакет событий: count={len(events)}, user={user}")
+    unique, results, duplicates = validate_batch(events, request_data)
+
+    if unique and (WEBHOOK_ASYNC_MODE or len(unique) > WEBHOOK_BATCH_SYNC_MAX):
+        unique = enqueue_batch_items(unique, results, user)
+
+    if unique:
+        deadline = time.monotonic() + WEBHOOK_BATCH_TIME_BUDGET
+
+        # None - позиция не начата до истечения времени пакета
+        def run(item):
+            if time.monotonic() >= deadline:
+                return None
+            return process_cardcreate(item[1], item[2], user)
+
+        # Ограниченное число потоков на пакет: соединения к БД берутся из общего пула процесса
+        late = []
+        with ThreadPoolExecutor(max_workers=min(WEBHOOK_BATCH_CONCURRENCY, len(unique))) as executor:
+            for item, outcome in zip(unique, executor.map(run, unique)):
+                if outcome is None:
+                    late.append(item)
+                else:
+                    results[item[0]] = outcome
+        if late:
+            defer_batch_items(late, results, user)
 
-    logger.info(f"Запрос успешно обработан, возвращён ответ: status=success")
-    return jsonify({"status": "success"}), 200
+    fill_duplicates(results, duplicates)
+    return jsonify(batch_response(events, results, started)), 200
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,456 @@
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+import asyncpg
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from audit_log import audit_log
+from cache import RecentKeys
+from db import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD, DB_POOL_TIMEOUT
+from http_client import AsyncMcrmClient, CircuitOpenError, circuit_stats
+from logging_config import SAMPLED, logging_stats
+from rate_limiter import RateLimitExceeded, rate_limit_stats
+from metrics import record_pool, record_request, render_metrics, start_pool_metrics, timed
+from webhook import (
+    MCRM_API_URL_USER, MCRM_API_KEY, MCRM_CACHE_TTL, MCRM_NEGATIVE_CACHE_TTL, OUTBOX_NOTIFY_CHANNEL, RETRY_NOTIFY_CHANNEL,
+    WEBHOOK_ASYNC_MODE, WEBHOOK_BATCH_CONCURRENCY, WEBHOOK_BATCH_SYNC_MAX, WEBHOOK_BATCH_TIME_BUDGET,
+    batch_response, build_listmonk_payload, classify_status, clean_serial, fill_duplicates, log_error_to_db, mcrm_cache,
+    parse_batch_body, recent_serials, request_error_class, retry_delay, validate_batch, verify_password
+)
+
+logger = logging.getLogger(__name__)
+
+# Размер пула asyncpg на один процесс воркера
+ASYNC_DB_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", "10"))
+
+# Асинхронный HTTP-клиент MCRM (создаётся в процессе воркера при первом запросе);
+# в listmonk подписчиков отправляет диспетчер outbox
+mcrm_client = AsyncMcrmClient(user_url=MCRM_API_URL_USER, api_key=MCRM_API_KEY)
+
+db_pool = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global db_pool
+    db_pool = await asyncpg.create_pool(
+        host=DB_HOST,
+        port=int(DB_PORT),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        min_size=1,
+        max_size=ASYNC_DB_POOL_MAX
+    )
+    logger.info(f"Создан пул asyncpg: pid={os.getpid()}, max={ASYNC_DB_POOL_MAX}")
+    start_pool_metrics(async_pool_stats)
+    try:
+        yield
+    finally:
+        await mcrm_client.aclose()
+        await db_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# Проверка, обработан ли уже serial (поиск по уникальному индексу)
+@timed("db_dedup_check")
+async def subscriber_exists(cleaned_serial):
+    async with db_pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+        return await conn.fetchval("SELECT 1 FROM subscribers WHERE serial = $1", cleaned_serial) is not None
+
+
+# Подписчик и задание для listmonk в subscriber_outbox одним запросом (см. save_subscriber_intent в webhook.py)
+@timed("db_subscriber")
+async def save_subscriber_intent(email, phone, serial, listmonk_payload):
+    try:
+        async with db_pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+            async with conn.transaction():
+                outbox_id = await conn.fetchval("""
+                    WITH subscriber AS (
+                        INSERT INTO subscribers (email, phone, status, serial)
+                        VALUES ($1, $2, $3, $4)
+                        ON CONFLICT DO NOTHING
+                        RETURNING serial
+                    )
+                    INSERT INTO subscriber_outbox (serial, payload)
+                    SELECT serial, $5::jsonb FROM subscriber
+                    ON CONFLICT (serial) DO NOTHING
+                    RETURNING id
+                """, email, phone, False, serial, json.dumps(listmonk_payload))
+                if outbox_id is not None:
+                    await conn.execute("SELECT pg_notify($1, $2)", OUTBOX_NOTIFY_CHANNEL, str(outbox_id))
+        if outbox_id is not None:
+            logger.debug("Подписчик записан, задание для listmonk в outbox: id=%s, serial=%s, email=%s", outbox_id, serial, email)
+        else:
+            logger.info(f"Подписчик уже есть в таблице subscribers: email={email}, serial={serial}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка записи подписчика и outbox: {e}")
+        return False
+
+
+# Функция для записи в очередь повторных попыток (с уведомлением воркеров)
+@timed("db_retry_queue")
+async def add_to_retry_queue(serial, event, error_message, error_class="internal", stage="mcrm", context=None):
+    try:
+        delay = retry_delay(error_class, 0)
+        async with db_pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+            async with conn.transaction():
+                retry_id = await conn.fetchval("""
+                    INSERT INTO retry_queue (serial, event, error_message, error_class, stage, context, next_attempt_at)
+                    VALUES ($1, $2, $3, $4, $5, $6::jsonb, CURRENT_TIMESTAMP + make_interval(secs => $7))
+                    RETURNING id
+                """, serial, event, error_message, error_class, stage, json.dumps(context or {}), delay)
+                await conn.execute("SELECT pg_notify($1, $2)", RETRY_NOTIFY_CHANNEL, str(retry_id))
+        logger.debug("Добавлена запись в retry_queue: serial=%s, event=%s, stage=%s, error_class=%s, delay=%.0fs", serial, event, stage, error_class, delay)
+    except Exception as e:
+        logger.error(f"Ошибка записи в retry_queue: {e}")
+
+
+# Сохранение события в webhook_events для обработки фоновыми воркерами
+@timed("db_event")
+async def enqueue_event(serial, event, user):
+    try:
+        async with db_pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+            event_id = await conn.fetchval("""
+                INSERT INTO webhook_events (serial, event, username)
+                VALUES ($1, $2, $3)
+                RETURNING id
+            """, serial, event, user)
+        logger.info(f"Событие принято в очередь: id={event_id}, serial={serial}, event={event}")
+        return event_id
+    except Exception as e:
+        logger.error(f"Ошибка записи в webhook_events, событие будет обработано синхронно: {e}")
+        return None
+
+
+# Пакетное сохранение событий одним INSERT; id возвращаются в порядке items
+@timed("db_event")
+async def enqueue_events(items, user):
+    try:
+        async with db_pool.acquire(timeout=DB_POOL_TIMEOUT) as conn:
+            rows = await conn.fetch("""
+                INSERT INTO webhook_events (serial, event, username)
+                SELECT serial, event, $3
+                FROM unnest($1::varchar[], $2::varchar[]) AS items(serial, event)
+                RETURNING id
+            """, [serial for serial, _ in items], [event for _, event in items], user)
+        logger.info(f"Пакет событий принят в очередь: {len(rows)}")
+        return [row['id'] for row in rows]
+    except Exception as e:
+        logger.error(f"Ошибка записи пакета в webhook_events, события будут обработаны синхронно: {e}")
+        return None
+
+
+# Постановка позиций пакета в webhook_events: принятые получают 202, возвращаются не принятые
+async def enqueue_batch_items(items, results, user):
+    event_ids = await enqueue_events([(serial, event) for _, serial, event in items], user)
+    if event_ids is None:
+        return items
+    for (index, _, _), event_id in zip(items, event_ids):
+        results[index] = ({"status": "accepted", "id": event_id}, 202)
+    return []
+
+
+# Запрос клиента в MCRM с кэшированием по очищенному serial.
+# Общий кэш читается через БД синхронно, поэтому уходит в поток
+@timed("mcrm")
+async def get_mcrm_user(cleaned_serial):
+    if mcrm_cache.shared:
+        cached = await asyncio.to_thread(mcrm_cache.get, cleaned_serial)
+    else:
+        cached = mcrm_cache.get(cleaned_serial)
+    if cached is not None:
+        logger.debug("Ответ MCRM взят из кэша: number=%s", cleaned_serial)
+        return cached
+
+    mcrm_response = await mcrm_client.get_user(cleaned_serial)
+    if mcrm_response.status_code == 200:
+        try:
+            has_email = bool(mcrm_response.json().get('email'))
+        except ValueError:
+            return mcrm_response
+        ttl = MCRM_CACHE_TTL if has_email else MCRM_NEGATIVE_CACHE_TTL
+        if mcrm_cache.shared:
+            await asyncio.to_thread(mcrm_cache.set, cleaned_serial, mcrm_response, ttl, not has_email)
+        else:
+            mcrm_cache.set(cleaned_serial, mcrm_response, ttl, negative=not has_email)
+    return mcrm_response
+
+
+# Обработка события cardcreate с подавлением дубликатов по очищенному serial
+async def process_cardcreate(serial, event, user='anonymous'):
+    cleaned_serial = clean_serial(serial)
+    if not cleaned_serial:
+        return await run_cardcreate(serial, event, user)
+
+    claim = recent_serials.claim(cleaned_serial)
+    if claim == RecentKeys.RECENT:
+        logger.info(f"Дубликат события cardcreate отброшен: serial={cleaned_serial}")
+        return {"status": "success", "duplicate": True}, 200
+    if claim == RecentKeys.IN_FLIGHT:
+        # Исход первой доставки ещё неизвестен: отправитель должен повторить позже
+        logger.info(f"Событие cardcreate уже обрабатывается: serial={cleaned_serial}")
+        return {"error": "Событие с этим serial уже обрабатывается, повторите позже"}, 409
+
+    status_code = 500
+    try:
+        try:
+            if await subscriber_exists(cleaned_serial):
+                logger.info(f"Serial уже обработан ранее: serial={cleaned_serial}")
+                status_code = 200
+                return {"status": "success", "duplicate": True}, 200
+        except Exception as e:
+            logger.error(f"Ошибка проверки дубликата serial={cleaned_serial}: {e}")
+
+        result, status_code = await run_cardcreate(serial, event, user)
+        return result, status_code
+    finally:
+        # Неуспешное событие не должно блокировать повторную доставку
+        recent_serials.finish(cleaned_serial, status_code == 200)
+
+
+# Конвейер cardcreate: MCRM -> subscribers + subscriber_outbox (listmonk - через диспетчер outbox)
+async def run_cardcreate(serial, event, user='anonymous'):
+    try:
+        logger.info("Обработка события cardcreate: serial=%s", serial)
+
+        # Обрезаем serial до дефиса
+        cleaned_serial = clean_serial(serial)
+        logger.debug("Обработан serial: исходный=%s, очищенный=%s", serial, cleaned_serial)
+        if not cleaned_serial:
+            logger.error(f"Ошибка обработки serial: пустой после очистки")
+            log_error_to_db("serial_processing_log", {
+                "original_serial": serial,
+                "cleaned_serial": cleaned_serial,
+                "error_message": "Пустой serial после очистки"
+            })
+            await add_to_retry_queue(serial, event, "Пустой serial после очистки", "invalid")
+            return {"error": "Ошибка обработки serial"}, 400
+
+        # Запрос к marketingcrm API
+        logger.info("Отправка запроса к MCRM API: URL=%s, number=%s", MCRM_API_URL_USER, cleaned_serial, extra=SAMPLED)
+        try:
+            mcrm_response = await get_mcrm_user(cleaned_serial)
+        except (httpx.HTTPError, CircuitOpenError, RateLimitExceeded) as e:
+            logger.error(f"Ошибка запроса к MCRM API: {e!r}")
+            log_error_to_db("mcrm_requests_log", {
+                "url": MCRM_API_URL_USER,
+                "number": cleaned_serial,
+                "status_code": None,
+                "response": None,
+                "error_message": f"MCRM API request error: {e!r}"
+            })
+            await add_to_retry_queue(serial, event, f"MCRM API request error: {e!r}", request_error_class(e))
+            return {"error": "Ошибка запроса к MCRM API"}, 500
+
+        logger.info("Ответ от MCRM API: status_code=%s", mcrm_response.status_code, extra=SAMPLED)
+        if mcrm_response.status_code != 200:
+            logger.error(f"Ошибка запроса к MCRM API: status_code={mcrm_response.status_code}, response={mcrm_response.text}")
+            log_error_to_db("mcrm_requests_log", {
+                "url": MCRM_API_URL_USER,
+                "number": cleaned_serial,
+                "status_code": mcrm_response.status_code,
+                "response": mcrm_response.text,
+                "error_message": f"MCRM API error: {mcrm_response.status_code}"
+            })
+            await add_to_retry_queue(serial, event, f"MCRM API error: {mcrm_response.status_code}", classify_status(mcrm_response.status_code))
+            return {"error": "Ошибка запроса к MCRM API"}, 500
+
+        mcrm_data = mcrm_response.json()
+        logger.info("Получен ответ от MCRM API: status=%s, user_id=%s, email=%s", mcrm_data.get('status'), mcrm_data.get('user_id'), mcrm_data.get('email'), extra=SAMPLED)
+
+        if not mcrm_data.get('email'):
+            logger.error(f"Email не найден в ответе MCRM: status={mcrm_data.get('status')}")
+            log_error_to_db("mcrm_requests_log", {
+                "url": MCRM_API_URL_USER,
+                "number": cleaned_serial,
+                "status_code": mcrm_response.status_code,
+                "response": mcrm_response.text,
+                "error_message": "Email не найден"
+            })
+            await add_to_retry_queue(serial, event, "Email не найден", "not_found")
+            return {"error": "Email не найден в ответе MCRM"}, 400
+
+        email = mcrm_data['email']
+        phone = mcrm_data.get('phone', '')
+        logger.debug("Извлечён email: %s, phone: %s", email, phone)
+
+        # Формируем payload для listmonk
+        listmonk_payload = build_listmonk_payload(mcrm_data)
+        logger.debug("Подготовлен payload для listmonk: %s", listmonk_payload, extra=SAMPLED)
+
+        # Подписчик и задание для listmonk - одной локальной транзакцией, отправку выполняет диспетчер outbox
+        if not await save_subscriber_intent(email, phone, cleaned_serial, listmonk_payload):
+            await add_to_retry_queue(serial, event, "Ошибка записи в таблицу subscribers", "internal", "listmonk",
+                                     {"listmonk_payload": listmonk_payload})
+            return {"error": "Ошибка записи в базу данных"}, 500
+
+        logger.info("Событие cardcreate успешно обработано: serial=%s, email=%s, user=%s", serial, email, user)
+    except Exception as e:
+        logger.error(f"Общая ошибка обработки: {e}, serial={serial}, event={event}")
+        await add_to_retry_queue(serial, event, f"Общая ошибка: {str(e)}", "internal")
+        return {"error": "Общая ошибка обработки"}, 500
+
+    logger.debug("Запрос успешно обработан, возвращён ответ: status=success")
+    return {"status": "success"}, 200
+
+
+# Необязательная Basic Auth, как login_required(optional=True) во Flask-версии
+def current_user(request):
+    header = request.headers.get('authorization', '')
+    if not header.lower().startswith('basic '):
+        return None
+    try:
+        username, _, password = base64.b64decode(header[6:]).decode().partition(':')
+    except (binascii.Error, UnicodeDecodeError):
+        logger.warning("Некорректный заголовок Basic Auth")
+        return None
+    return verify_password(username, password)
+
+
+def async_pool_stats():
+    size, idle = db_pool.get_size(), db_pool.get_idle_size()
+    return {"size": size, "idle": idle, "in_use": size - idle, "max": ASYNC_DB_POOL_MAX}
+
+
+# Ответ /webhook с учётом в метриках
+def respond(result, status_code, started):
+    record_request(started, status_code, result)
+    return JSONResponse(result, status_code=status_code)
+
+
+# Health check эндпоинт
+@app.get('/health')
+async def health_check():
+    logger.info("Получен запрос на /health", extra=SAMPLED)
+    db_pool_stats = async_pool_stats() if db_pool else {}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "db_pool": db_pool_stats,
+        "audit_log": audit_log.stats(),
+        "mcrm_cache": mcrm_cache.stats(),
+        "dedup": recent_serials.stats(),
+        "logging": logging_stats(),
+        "circuits": circuit_stats(),
+        "rate_limits": rate_limit_stats()
+    }
+
+
+# Метрики в формате Prometheus; очереди читаются синхронным драйвером, поэтому в отдельном потоке
+@app.get('/metrics')
+async def metrics():
+    if db_pool is not None:
+        record_pool(async_pool_stats())
+    body, content_type = await asyncio.to_thread(render_metrics)
+    return Response(body, media_type=content_type)
+
+
+@app.api_route('/webhook', methods=['GET', 'POST'])
+async def webhook(request: Request):
+    started = time.perf_counter()
+    request_data = {
+        "method": request.method,
+        "path": request.url.path,
+        "headers": "".join(f"{key}: {value}\r\n" for key, value in request.headers.items()),
+        "remote_addr": request.client.host if request.client else None,
+        "serial": None,
+        "event": None,
+        "error_message": None
+    }
+
+    if request.method == 'GET':
+        params = request.query_params
+    else:
+        params = await request.form()
+    serial = params.get('serial')
+    event = params.get('event')
+    logger.info("%s запрос: serial=%s, event=%s", request.method, serial, event)
+    if not serial or not event:
+        logger.error(f"Отсутствует параметр serial или event: serial={serial}, event={event}")
+        request_data.update({"serial": serial, "event": event, "error_message": "Отсутствует параметр serial или event"})
+        log_error_to_db("requests_log", request_data)
+        return respond({"error": "Отсутствует параметр serial или event"}, 400, started)
+    if event != "cardcreate":
+        logger.error(f"Неподдерживаемое событие: event={event}")
+        request_data.update({"serial": serial, "event": event, "error_message": f"Неподдерживаемое событие: {event}"})
+        log_error_to_db("requests_log", request_data)
+        return respond({"error": "Неподдерживаемое событие"}, 400, started)
+
+    user = current_user(request) or 'anonymous'
+    logger.debug("Текущий пользователь: %s", user)
+
+    if WEBHOOK_ASYNC_MODE:
+        event_id = await enqueue_event(serial, event, user)
+        if event_id is not None:
+            return respond({"status": "accepted", "id": event_id}, 202, started)
+
+    result, status_code = await process_cardcreate(serial, event, user)
+    return respond(result, status_code, started)
+
+
+@app.post('/webhook/batch')
+async def webhook_batch(request: Request):
+    started = time.perf_counter()
+    request_data = {
+        "method": request.method,
+        "path": request.url.path,
+        "headers": "".join(f"{key}: {value}\r\n" for key, value in request.headers.items()),
+        "remote_addr": request.client.host if request.client else None,
+        "serial": None,
+        "event": None,
+        "error_message": None
+    }
+
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    events, error = parse_batch_body(body)
+    if error:
+        logger.error(f"Некорректный пакет событий: {error}")
+        log_error_to_db("requests_log", {**request_data, "error_message": error})
+        return respond({"error": error}, 400, started)
+
+    user = current_user(request) or 'anonymous'
+    logger.info(f"Пакет событий: count={len(events)}, user={user}")
+    unique, results, duplicates = validate_batch(events, request_data)
+
+    # Большие пакеты обрабатывают воркеры, синхронно - не дольше WEBHOOK_BATCH_TIME_BUDGET
+    if unique and (WEBHOOK_ASYNC_MODE or len(unique) > WEBHOOK_BATCH_SYNC_MAX):
+        unique = await enqueue_batch_items(unique, results, user)
+
+    # Не больше WEBHOOK_BATCH_CONCURRENCY одновременных конвейеров на пакет
+    semaphore = asyncio.Semaphore(WEBHOOK_BATCH_CONCURRENCY)
+    deadline = time.monotonic() + WEBHOOK_BATCH_TIME_BUDGET
+
+    async def run(serial, event):
+        async with semaphore:
+            if time.monotonic() >= deadline:
+                return None
+            return await process_cardcreate(serial, event, user)
+
+    outcomes = await asyncio.gather(*(run(serial, event) for _, serial, event in unique))
+    late = []
+    for item, outcome in zip(unique, outcomes):
+        if outcome is None:
+            late.append(item)
+        else:
+            results[item[0]] = outcome
+    if late:
+        logger.warning(f"Время обработки пакета истекло, событий в очередь: {len(late)}")
+        for index, _, _ in await enqueue_batch_items(late, results, user):
+            results[index] = ({"error": "Время обработки пакета истекло, повторите позже"}, 503)
+
+    fill_duplicates(results, duplicates)
+    return JSONResponse(batch_response(events, results, started))
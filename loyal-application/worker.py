@@ -0,0 +1,191 @@
+import argparse
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from psycopg2 import sql
+from db import DB_POOL_MAX, get_connection
+from log_partitions import run_log_maintenance
+from metrics import start_metrics_server
+from outbox import run_outbox_dispatcher
+from webhook import init_db, process_cardcreate, process_retry_queue
+
+logger = logging.getLogger(__name__)
+
+# Параметры фоновой обработки событий из webhook_events
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "4"))
+EVENT_POLL_INTERVAL = float(os.getenv("EVENT_POLL_INTERVAL", "1"))  # секунд ожидания при пустой очереди
+EVENT_LEASE_SECONDS = int(os.getenv("EVENT_LEASE_SECONDS", "300"))  # после истечения событие может забрать другой воркер
+EVENT_MAX_ATTEMPTS = int(os.getenv("EVENT_MAX_ATTEMPTS", "3"))
+
+# Количество потоков-потребителей retry_queue
+RETRY_WORKERS = int(os.getenv("RETRY_WORKERS", "2"))
+
+# Период обслуживания партиций журналов
+LOG_MAINTENANCE_INTERVAL = float(os.getenv("LOG_MAINTENANCE_INTERVAL", "3600"))  # секунд
+
+# Порт /metrics воркера; 0 - метрики не отдаются
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+# Захват одного события; SKIP LOCKED позволяет воркерам не мешать друг другу
+def claim_event():
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql.SQL("""
+            UPDATE webhook_events
+            SET status = 'processing',
+                attempts = attempts + 1,
+                locked_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE id = (
+                SELECT id FROM webhook_events
+                WHERE (status = 'pending' OR (status = 'processing' AND locked_until < CURRENT_TIMESTAMP))
+                  AND attempts < %s
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, serial, event, username
+        """), (EVENT_LEASE_SECONDS, EVENT_MAX_ATTEMPTS))
+        row = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+    return row
+
+# Фиксация результата обработки события
+def finish_event(event_id, status_code, result):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql.SQL("""
+                UPDATE webhook_events
+                SET status = %s, processed_at = CURRENT_TIMESTAMP, locked_until = NULL,
+                    result_code = %s, error_message = %s
+                WHERE id = %s
+            """), (
+                'done' if status_code < 400 else 'failed',
+                status_code,
+                result.get('error'),
+                event_id
+            ))
+            conn.commit()
+            cursor.close()
+    except Exception as e:
+        logger.error(f"Ошибка обновления webhook_events: id={event_id}, error={e}")
+
+# Событие, у которого истекла аренда на последней попытке (воркер упал или завис), больше
+# не захватывается claim_event; без этого оно навсегда остаётся в 'processing'
+def fail_exhausted_events():
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql.SQL("""
+                UPDATE webhook_events
+                SET status = 'failed', processed_at = CURRENT_TIMESTAMP, locked_until = NULL,
+                    error_message = %s
+                WHERE status = 'processing' AND locked_until < CURRENT_TIMESTAMP AND attempts >= %s
+                RETURNING id
+            """), (f"Обработка не завершена за {EVENT_MAX_ATTEMPTS} попыток", EVENT_MAX_ATTEMPTS))
+            ids = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            cursor.close()
+        if ids:
+            logger.warning(f"События webhook_events с исчерпанными попытками помечены failed: {ids}")
+    except Exception as e:
+        logger.error(f"Ошибка завершения событий с исчерпанными попытками: {e}")
+
+# Цикл воркера: забираем события и прогоняем через MCRM -> listmonk
+def run_event_worker(stop):
+    next_sweep = 0
+    while not stop.is_set():
+        if time.monotonic() >= next_sweep:
+            fail_exhausted_events()
+            next_sweep = time.monotonic() + EVENT_LEASE_SECONDS
+        try:
+            row = claim_event()
+        except Exception as e:
+            logger.error(f"Ошибка получения события из webhook_events: {e}")
+            stop.wait(EVENT_POLL_INTERVAL)
+            continue
+
+        if row is None:
+            stop.wait(EVENT_POLL_INTERVAL)
+            continue
+
+        event_id, serial, event, user = row
+        logger.info(f"Фоновая обработка события: id={event_id}, serial={serial}, event={event}")
+        try:
+            result, status_code = process_cardcreate(serial, event, user or 'anonymous')
+        except Exception as e:
+            logger.error(f"Ошибка фоновой обработки события: id={event_id}, error={e}")
+            result, status_code = {"error": str(e)}, 500
+        if status_code == 409:
+            # Тот же serial обрабатывается в другом потоке: событие вернётся в работу по окончании аренды
+            logger.info(f"Событие отложено до окончания аренды: id={event_id}, serial={serial}")
+            continue
+        finish_event(event_id, status_code, result)
+
+# Создание партиций журналов заранее и удаление устаревших
+def run_maintenance(stop):
+    while not stop.is_set():
+        run_log_maintenance()
+        stop.wait(LOG_MAINTENANCE_INTERVAL)
+
+def start_workers(target, count, stop, name):
+    threads = []
+    for i in range(count):
+        thread = threading.Thread(target=target, args=(stop,), name=f"{name}-{i}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    logger.info(f"Запущено воркеров {name}: {count}")
+    return threads
+
+def main():
+    parser = argparse.ArgumentParser(description="Фоновые воркеры вебхука")
+    parser.add_argument('--events', action='store_true', help="обрабатывать события из webhook_events")
+    parser.add_argument('--concurrency', type=int, default=EVENT_WORKERS, help="количество потоков обработки событий")
+    parser.add_argument('--retry', action='store_true', help="обрабатывать retry_queue")
+    parser.add_argument('--retry-concurrency', type=int, default=RETRY_WORKERS, help="количество потоков обработки retry_queue")
+    parser.add_argument('--maintenance', action='store_true', help="обслуживать партиции журналов (создание и удаление)")
+    parser.add_argument('--outbox', action='store_true', help="отправлять в listmonk подписчиков из subscriber_outbox")
+    parser.add_argument('--metrics-port', type=int, default=WORKER_METRICS_PORT, help="порт /metrics воркера (0 - не отдавать)")
+    args = parser.parse_args()
+
+    if not args.events and not args.retry and not args.maintenance and not args.outbox:
+        parser.error("не выбран ни один тип воркеров")
+
+    total = (args.concurrency if args.events else 0) + (args.retry_concurrency if args.retry else 0)
+    if total > DB_POOL_MAX:
+        logger.warning(f"Потоков больше, чем соединений в пуле: threads={total}, DB_POOL_MAX={DB_POOL_MAX}")
+
+    init_db()
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    threads = []
+    if args.events:
+        threads += start_workers(run_event_worker, args.concurrency, stop, "events")
+    if args.retry:
+        threads += start_workers(process_retry_queue, args.retry_concurrency, stop, "retry")
+    if args.maintenance:
+        threads += start_workers(run_maintenance, 1, stop, "maintenance")
+    if args.outbox:
+        threads += start_workers(run_outbox_dispatcher, 1, stop, "outbox")
+
+    while not stop.is_set():
+        stop.wait(1)
+    logger.info("Остановка воркеров")
+    for thread in threads:
+        thread.join(timeout=30)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        logger.error(f"Ошибка при запуске воркеров: {e}")
+        sys.exit(1)